@@ -0,0 +1,238 @@
+# coding: utf-8
+"""
+In-process stand-in for the WeChat PC hook.
+
+FakeWechatPc / FakeWechatPcClient mimic the parts of wechatPc.WechatPc / WechatPcClient
+used by the channel and feed the registered OPCODE_* handlers with synthetic data.
+"""
+import asyncio
+import base64
+import json
+import random
+import struct
+import time
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from wechatPc.models.websocket import *
+
+PAGE_SIZE = 100
+
+
+def make_png(seed: int, size: int = 32) -> bytes:
+    """
+    Build a small valid PNG, distinct per seed
+    """
+    rng = random.Random(seed)
+    raw = b''.join(b'\x00' + bytes(rng.getrandbits(8) for _ in range(size * 3)) for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+class SyntheticAccount:
+    """
+    A generated account with `contacts` friends and `rooms` group chats
+    """
+
+    def __init__(self, contacts: int, rooms: int, members_per_room: int = 30, unnamed_ratio: float = 0.1,
+                 seed: int = 0):
+        rng = random.Random(seed)
+        self.friends: List[dict] = [{
+            'wxid': f'wxid_{i:06d}',
+            'nickname': f'Contact {i}',
+            'remark': f'Remark {i}' if i % 3 == 0 else '',
+            'headUrl': f'http://127.0.0.1:1/avatar/{i}.jpg',
+        } for i in range(contacts)]
+        self.rooms: List[dict] = []
+        for i in range(rooms):
+            members = rng.sample(range(contacts), min(members_per_room, contacts))
+            unnamed = rng.random() < unnamed_ratio
+            self.rooms.append({
+                'wxid': f'{10000000 + i}@chatroom',
+                'username': '' if unnamed else f'Room {i}',
+                'nickname': '',
+                'roomWxidList': '^G'.join(f'wxid_{m:06d}' for m in members),
+            })
+        self.entries = self.friends + self.rooms
+        self._pages: Optional[List[dict]] = None
+        self._index: Optional[Dict[str, dict]] = None
+
+    def find(self, wxid: str) -> Optional[dict]:
+        if self._index is None:
+            self._index = {entry['wxid']: entry for entry in self.entries}
+        entry = self._index.get(wxid, None)
+        return json.loads(json.dumps(entry)) if entry is not None else None
+
+    def pages(self) -> List[dict]:
+        if self._pages is None:
+            self._pages = self._paginate()
+        return self._pages
+
+    def _paginate(self) -> List[dict]:
+        total = len(self.entries)
+        return [{
+            'friendList': self.entries[i:i + PAGE_SIZE],
+            'total': total,
+            'page': i // PAGE_SIZE + 1,
+        } for i in range(0, total, PAGE_SIZE)]
+
+
+class FakeWechatPcClient:
+    def __init__(self, account: SyntheticAccount):
+        self.account = account
+        self.handlers: Dict[int, List[Callable]] = defaultdict(list)
+        self.sent: List[tuple] = []
+        self.on_sent: Optional[Callable[[str, str], None]] = None
+        self.send_delay = 0.0
+        self.contact_lookups = 0
+
+    def add_handler(self, opcode: int):
+        def decorator(func):
+            self.handlers[opcode].append(func)
+            return func
+
+        return decorator
+
+    async def dispatch(self, opcode: int, msg: dict):
+        for handler in self.handlers[opcode]:
+            await handler(msg)
+
+    async def open(self):
+        asyncio.ensure_future(self.dispatch(OPCODE_WECHAT_GET_LOGIN_STATUS, {'loginStatus': 1}))
+
+    async def get_friend_list(self, page: int = None):
+        pages = self.account.pages()
+
+        async def send_pages():
+            for p in pages if page is None else pages[page - 1:page]:
+                # Decoded from the websocket in real life, the channel never shares objects with the hook
+                await self.dispatch(OPCODE_FRIEND_LIST, json.loads(json.dumps(p)))
+
+        asyncio.ensure_future(send_pages())
+
+    async def get_contact(self, wxid: str):
+        self.contact_lookups += 1
+        await asyncio.sleep(self.send_delay)
+        return self.account.find(wxid)
+
+    async def send_text(self, wxid: str, content: str):
+        await asyncio.sleep(self.send_delay)
+        self.sent.append((wxid, content))
+        if self.on_sent:
+            self.on_sent(wxid, content)
+        return {'msgId': str(10 ** 12 + len(self.sent))}
+
+    async def at_room_member(self, room_id: str, wxid: str, nickname: str, message: str):
+        return await self.send_text(room_id, message)
+
+    async def send_image(self, wxid: str, path: str):
+        # The hook reads the file when sending it
+        with open(path, 'rb') as f:
+            while f.read(64 * 1024):
+                pass
+        return await self.send_text(wxid, path)
+
+    send_file = send_image
+
+
+class FakeWechatPc:
+    """
+    Drop-in for wechatPc.WechatPc, assign `FakeWechatPc.account` before the channel is built
+    """
+    account: SyntheticAccount = None
+    instances: List['FakeWechatPc'] = []
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.client: Optional[FakeWechatPcClient] = None
+        self.instances.append(self)
+
+    def register_client(self, client_id: str) -> FakeWechatPcClient:
+        self.client = FakeWechatPcClient(self.account)
+        return self.client
+
+    async def connect(self):
+        pass
+
+    async def run(self):
+        await asyncio.Event().wait()
+
+
+class MessageReplayer:
+    """
+    Replay a stream of incoming messages into the client handlers at a fixed rate
+    """
+
+    def __init__(self, account: SyntheticAccount, image_ratio: float = 0.1, group_ratio: float = 0.7,
+                 mention_ratio: float = 0.05, distinct_images: int = 20, voice_ratio: float = 0, app_ratio: float = 0,
+                 seed: int = 1):
+        self.account = account
+        self.image_ratio = image_ratio
+        self.voice_ratio = voice_ratio
+        self.app_ratio = app_ratio
+        self.group_ratio = group_ratio
+        self.mention_ratio = mention_ratio
+        self.rng = random.Random(seed)
+        self.images = ['data:image/png;base64,' + base64.b64encode(make_png(i)).decode()
+                       for i in range(distinct_images)]
+        # AMR headers with noise, enough for the channel to tell the codec. Not randbytes, it needs Python 3.9
+        noise = [random.Random(i).getrandbits(8000 * 8).to_bytes(8000, 'little') for i in range(distinct_images)]
+        self.voices = ['data:audio/amr;base64,' + base64.b64encode(b'#!AMR\n' + n).decode() for n in noise]
+        # Shared articles, the same few are forwarded to many rooms
+        self.app_msgs = [f'<?xml version="1.0"?><msg><appmsg appid="" sdkver="0"><title>Article {i}</title>'
+                         f'<des>Summary of article {i}</des><type>5</type><url>https://example.com/{i}?a=1&amp;b=2</url>'
+                         f'<thumburl>https://example.com/{i}.jpg</thumburl>{"<extra>x</extra>" * 200}</appmsg>'
+                         f'<fromusername>gh_{i}</fromusername></msg>'
+                         for i in range(distinct_images)]
+
+    def make_message(self, seq: int) -> dict:
+        rng = self.rng
+        sender = rng.choice(self.account.friends)
+        msg = {'wxid': sender['wxid'], 'isOwner': 0, 'roomId': '', 'msgType': 1,
+               'content': f'message {seq}', 'msgId': str(seq + 1)}
+        if self.account.rooms and rng.random() < self.group_ratio:
+            room = rng.choice(self.account.rooms)
+            msg['roomId'] = room['wxid']
+            msg['wxid'] = rng.choice(room['roomWxidList'].split('^G'))
+            if rng.random() < self.mention_ratio:
+                msg['content'] = f'@me {msg["content"]}'
+        if rng.random() < self.image_ratio:
+            msg['msgType'] = 3
+            msg['content'] = ''
+            msg['imageFile'] = {'base64Content': rng.choice(self.images)}
+        elif rng.random() < self.voice_ratio:
+            msg['msgType'] = 34
+            msg['content'] = ''
+            msg['voiceFile'] = {'base64Content': rng.choice(self.voices)}
+        elif rng.random() < self.app_ratio:
+            msg['msgType'] = 49
+            msg['content'] = rng.choice(self.app_msgs)
+        return msg
+
+    async def replay(self, client: FakeWechatPcClient, count: int, rate: float,
+                     on_dispatch: Callable[[dict], None], duplicate_ratio: float = 0):
+        """
+        :param rate: Messages per second, 0 to send as fast as the handlers accept them
+        :param on_dispatch: Called right before each message is handed to the handlers
+        :param duplicate_ratio: Share of messages sent a second time right after, like a glitching hook.
+                                Duplicates are not passed to `on_dispatch`.
+        """
+        self.duplicates = 0
+        start = time.perf_counter()
+        for seq in range(count):
+            if rate:
+                delay = start + seq / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            msg = self.make_message(seq)
+            duplicate = dict(msg) if duplicate_ratio and self.rng.random() < duplicate_ratio else None
+            on_dispatch(msg)
+            await client.dispatch(OPCODE_MESSAGE_RECEIVE, msg)
+            if duplicate is not None:
+                self.duplicates += 1
+                await client.dispatch(OPCODE_MESSAGE_RECEIVE, duplicate)
@@ -0,0 +1,279 @@
+# coding: utf-8
+"""
+Offline benchmark of WechatPcChannel against the in-process fake hook and a stub master.
+
+    python benchmark/run_benchmark.py --contacts 8000 --rooms 500 --messages 5000 --rate 500
+
+Reports friend list load time, incoming throughput and end-to-end latency, outbound
+send throughput and memory usage.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Deque, Dict, List
+
+import yaml
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from ehforwarderbot import coordinator, Message, MsgType  # noqa: E402
+from ehforwarderbot import utils as efb_utils  # noqa: E402
+
+import efb_wechat_pc_slave  # noqa: E402
+from efb_wechat_pc_slave import WechatPcChannel  # noqa: E402
+from fake_hook import FakeWechatPc, MessageReplayer, SyntheticAccount, make_png  # noqa: E402
+
+
+class StubMaster:
+    """
+    Minimal master channel recording when each message arrives
+    """
+    channel_id = "bench.master"
+    channel_name = "Benchmark master"
+    channel_emoji = "📊"
+    instance_id = None
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.pending: Dict[str, Deque[float]] = collections.defaultdict(collections.deque)
+        self.latencies: List[float] = []
+        self.out_of_order = 0
+        self.received = 0
+        self.statuses = 0
+
+    def dispatched(self, msg: dict):
+        self.pending[msg['roomId'] or msg['wxid']].append(time.perf_counter())
+
+    def send_message(self, msg: Message) -> Message:
+        if self.delay:
+            time.sleep(self.delay)
+        now = time.perf_counter()
+        queue = self.pending.get(msg.chat.uid, None)
+        # Replayed text messages are single lines, merged ones have a line per message
+        for _ in range(msg.text.count('\n') + 1 if msg.type == MsgType.Text else 1):
+            if queue:
+                self.latencies.append(now - queue.popleft())
+            else:
+                self.out_of_order += 1
+        if msg.file:
+            msg.file.close()
+        self.received += 1
+        return msg
+
+    def send_status(self, status):
+        self.statuses += 1
+
+    def get_message_by_id(self, chat, msg_id):
+        return None
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def prepare_profile(data_path: Path, args: argparse.Namespace, instance_ids: List[str] = (None,)):
+    os.environ['EFB_DATA_PATH'] = str(data_path)
+    coordinator.profile = "bench"
+    for instance_id in instance_ids:
+        channel_id = WechatPcChannel.channel_id + (f"#{instance_id}" if instance_id else "")
+        write_config(efb_utils.get_config_path(channel_id), args)
+
+
+def write_config(config_path: Path, args: argparse.Namespace):
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    with config_path.open('w') as f:
+        yaml.dump({
+            'uri': 'ws://127.0.0.1:0',
+            # Replayed mentions are written as @me
+            'self_nickname': 'me',
+            'send_rate': 0,
+            'avatar_prefetch': 0,
+            'metrics': {'enabled': args.metrics},
+            'ingest': {'overflow': args.overflow, 'max_size': args.ingest_size, 'workers': args.ingest_workers},
+            'coalesce': {'window': args.coalesce},
+        }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--contacts', type=int, default=8000)
+    parser.add_argument('--rooms', type=int, default=500)
+    parser.add_argument('--members', type=int, default=30, help="members per room")
+    parser.add_argument('--messages', type=int, default=5000, help="incoming messages to replay")
+    parser.add_argument('--rate', type=float, default=0, help="incoming messages per second, 0 for unlimited")
+    parser.add_argument('--image-ratio', type=float, default=0.1)
+    parser.add_argument('--mention-ratio', type=float, default=0.05)
+    parser.add_argument('--voice-ratio', type=float, default=0)
+    parser.add_argument('--duplicate-ratio', type=float, default=0,
+                        help="share of incoming messages the hook sends twice")
+    parser.add_argument('--app-ratio', type=float, default=0, help="share of links among incoming messages")
+    parser.add_argument('--sends', type=int, default=1000, help="outbound messages from the master")
+    parser.add_argument('--media-sends', type=int, default=0, help="photos sent from the master")
+    parser.add_argument('--distinct-media', type=int, default=5, help="distinct photos among them")
+    parser.add_argument('--send-delay', type=float, default=0.002, help="simulated hook round trip in seconds")
+    parser.add_argument('--master-delay', type=float, default=0, help="simulated master delivery time in seconds")
+    parser.add_argument('--overflow', choices=('block', 'spill', 'drop'), default='block',
+                        help="overflow policy of the ingest queue")
+    parser.add_argument('--ingest-size', type=int, default=1000)
+    parser.add_argument('--ingest-workers', type=int, default=2)
+    parser.add_argument('--coalesce', type=float, default=0, help="coalescing window of text messages in seconds")
+    parser.add_argument('--accounts', type=int, default=1,
+                        help="channel instances in the process, extra ones are used to measure memory per account")
+    parser.add_argument('--data-path', type=Path, default=None, help="EFB data path, a temp dir by default")
+    parser.add_argument('--metrics', action='store_true', help="enable channel metrics and print the summary")
+    args = parser.parse_args()
+
+    data_path = args.data_path or Path(tempfile.mkdtemp(prefix="efb-wechat-pc-bench-"))
+    extra_ids = [f"bench{i}" for i in range(2, args.accounts + 1)]
+    prepare_profile(data_path, args, [None] + extra_ids)
+    tracemalloc.start()
+
+    account = SyntheticAccount(args.contacts, args.rooms, args.members)
+    FakeWechatPc.account = account
+    efb_wechat_pc_slave.WechatPc = FakeWechatPc
+
+    master = StubMaster(args.master_delay)
+    coordinator.master = master
+    coordinator.middlewares = []
+    base_traced, _ = tracemalloc.get_traced_memory()
+
+    results = collections.OrderedDict()
+
+    start = time.perf_counter()
+    channel = WechatPcChannel()
+    results['startup'] = f"{(time.perf_counter() - start) * 1000:.1f} ms"
+    channel.connection.logged_in.wait(timeout=60)
+    results['login'] = f"{(time.perf_counter() - start) * 1000:.1f} ms"
+    client = channel.client
+    client.send_delay = args.send_delay
+
+    start = time.perf_counter()
+    channel.update_friend_info()
+    results['friend list load'] = f"{(time.perf_counter() - start) * 1000:.1f} ms ({len(account.entries)} entries)"
+    traced, _ = tracemalloc.get_traced_memory()
+    results['memory after friend list'] = f"{(traced - base_traced) / 1024 / 1024:.1f} MiB traced by the channel"
+    start = time.perf_counter()
+    chats = channel.get_chats()
+    traced, _ = tracemalloc.get_traced_memory()
+    results['get_chats'] = f"{(time.perf_counter() - start) * 1000:.1f} ms ({len(chats)} chats), " \
+                           f"{(traced - base_traced) / 1024 / 1024:.1f} MiB traced by the channel"
+
+    # Incoming messages
+    replayer = MessageReplayer(account, image_ratio=args.image_ratio, mention_ratio=args.mention_ratio,
+                               voice_ratio=args.voice_ratio, app_ratio=args.app_ratio)
+    start = time.perf_counter()
+    asyncio.run_coroutine_threadsafe(
+        replayer.replay(client, args.messages, args.rate, master.dispatched, args.duplicate_ratio),
+        channel.loop).result()
+    dispatched = time.perf_counter() - start
+    deadline = start + max(60.0, args.messages * (args.master_delay + 0.01))
+    while master.received + channel.coalescer.merged + channel.ingest.dropped < args.messages \
+            and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    results['incoming'] = f"{master.received}/{args.messages} delivered in {elapsed:.2f} s " \
+                          f"({master.received / elapsed:.0f} msg/s, dispatch {dispatched:.2f} s)"
+    if master.latencies:
+        results['incoming latency'] = f"p50 {percentile(master.latencies, 0.5) * 1000:.2f} ms, " \
+                                      f"p99 {percentile(master.latencies, 0.99) * 1000:.2f} ms, " \
+                                      f"mean {statistics.mean(master.latencies) * 1000:.2f} ms"
+    if replayer.duplicates:
+        results['duplicates'] = f"{channel.dedup.hits}/{replayer.duplicates} dropped"
+    if channel.coalescer.merged:
+        results['coalesced'] = f"{channel.coalescer.merged} messages merged into others"
+    if channel.ingest.dropped or channel.ingest.spilled:
+        results['overflow'] = f"{channel.ingest.dropped} dropped, {channel.ingest.spilled} spilled"
+    if master.out_of_order:
+        results['unmatched deliveries'] = str(master.out_of_order)
+
+    # Outbound messages
+    targets = [chat for chat in chats][:50] or chats
+    sent = threading.Event()
+    sent_count = 0
+
+    def on_sent(wxid: str, content: str):
+        nonlocal sent_count
+        sent_count += 1
+        if sent_count >= args.sends:
+            sent.set()
+
+    client.on_sent = on_sent
+    call_times = []
+    start = time.perf_counter()
+    for i in range(args.sends):
+        msg = Message(type=MsgType.Text, text=f"outbound {i}", chat=targets[i % len(targets)],
+                      deliver_to=channel)
+        call_start = time.perf_counter()
+        channel.send_message(msg)
+        call_times.append(time.perf_counter() - call_start)
+    sent.wait(timeout=max(60.0, args.sends * args.send_delay * 2))
+    elapsed = time.perf_counter() - start
+    results['outbound'] = f"{sent_count}/{args.sends} sent in {elapsed:.2f} s ({sent_count / elapsed:.0f} msg/s)"
+    results['send_message call'] = f"p50 {percentile(call_times, 0.5) * 1000:.3f} ms, " \
+                                   f"p99 {percentile(call_times, 0.99) * 1000:.3f} ms"
+
+    if args.media_sends:
+        # Photos from the master, written to temp files like a master channel does
+        photos = []
+        for i in range(args.distinct_media):
+            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+                f.write(make_png(i, 512))
+                photos.append(Path(f.name))
+        sent.clear()
+        sent_count = 0
+        args.sends = args.media_sends
+        start = time.perf_counter()
+        for i in range(args.media_sends):
+            path = photos[i % len(photos)]
+            msg = Message(type=MsgType.Image, text='', chat=targets[i % len(targets)], deliver_to=channel,
+                          file=path.open('rb'), path=path, mime='image/png')
+            channel.send_message(msg)
+            msg.file.close()
+        sent.wait(timeout=max(60.0, args.media_sends * args.send_delay * 2))
+        elapsed = time.perf_counter() - start
+        results['outbound media'] = f"{sent_count}/{args.media_sends} photos ({photos[0].stat().st_size // 1024} KiB) " \
+                                    f"sent in {elapsed:.2f} s ({sent_count / elapsed:.0f} msg/s), " \
+                                    f"{channel.outbound_media.deduplicated} deduplicated"
+        for path in photos:
+            path.unlink()
+
+    if extra_ids:
+        # Extra accounts share the event loop and HTTP pool, load the same friend list
+        base, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        extra = []
+        for instance_id in extra_ids:
+            extra.append(WechatPcChannel(instance_id))
+            extra[-1].connection.logged_in.wait(timeout=60)
+            extra[-1].get_chats()
+        traced, _ = tracemalloc.get_traced_memory()
+        results['extra accounts'] = f"{len(extra)} started in {time.perf_counter() - start:.2f} s, " \
+                                    f"{(traced - base) / len(extra) / 1024 / 1024:.2f} MiB traced per account"
+
+    traced, peak = tracemalloc.get_traced_memory()
+    results['memory'] = f"{traced / 1024 / 1024:.1f} MiB traced, {peak / 1024 / 1024:.1f} MiB peak, " \
+                        f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB"
+
+    width = max(len(k) for k in results)
+    for key, value in results.items():
+        print(f"{key:<{width}}  {value}")
+    if args.metrics:
+        print()
+        print(channel.metrics.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# coding: utf-8
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+logger = logging.getLogger(__name__)
+
+# Types of <appmsg>
+APP_MSG_MUSIC = 3
+APP_MSG_LINK = 5
+APP_MSG_FILE = 6
+APP_MSG_RECORD = 19
+APP_MSG_MINI_PROGRAM = 33
+APP_MSG_MINI_PROGRAM_SHARE = 36
+APP_MSG_QUOTE = 57
+
+CHUNK_SIZE = 16 * 1024
+
+# Element paths below the root <msg> that are extracted, anything else is dropped while parsing
+FIELDS = {
+    'appmsg/type': 'type',
+    'appmsg/title': 'title',
+    'appmsg/des': 'description',
+    'appmsg/url': 'url',
+    'appmsg/thumburl': 'thumb_url',
+    'appmsg/sourcedisplayname': 'source',
+    'appmsg/appattach/totallen': 'file_size',
+    'appmsg/appattach/fileext': 'file_ext',
+    'appmsg/refermsg/svrid': 'quote_id',
+    'appmsg/refermsg/fromusr': 'quote_from',
+    'appmsg/refermsg/chatusr': 'quote_sender',
+    'appmsg/refermsg/displayname': 'quote_name',
+    'appmsg/refermsg/content': 'quote_text',
+}
+
+
+class AppMessage(NamedTuple):
+    type: int
+    title: str
+    description: str
+    url: str
+    thumb_url: str
+    source: str
+    file_ext: str
+    file_size: int
+    # WeChat message id of the quoted message, for APP_MSG_QUOTE
+    quote_id: Optional[str]
+    # wxid of who sent the quoted message
+    quote_sender: str
+    quote_name: str
+    quote_text: str
+    # Whether the payload was larger than the cap and only its start was parsed
+    truncated: bool
+
+
+def _int(value: Optional[str]) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_app_msg(content: str, max_length: int = 256 * 1024) -> Optional[AppMessage]:
+    """
+    Extract the fields of an app message (link, file, mini program, chat record, quote) from its XML.
+    The XML is fed to an incremental parser in chunks, elements are discarded as soon as they are closed
+    and parsing stops after </appmsg> or `max_length` characters, so no tree of the payload is ever built.
+    :param content: The content of the message, in rooms prefixed by the sender's wxid
+    :param max_length: Characters parsed at most, the fields are usually at the start of the payload
+    :return: None if it's no app message
+    """
+    start = content.find('<')
+    if start < 0:
+        return None
+    parser = XMLPullParser(events=('start', 'end'))
+    path = []
+    fields: Dict[str, str] = {}
+    end = min(len(content), start + max_length)
+    done = False
+    try:
+        for offset in range(start, end, CHUNK_SIZE):
+            parser.feed(content[offset:min(offset + CHUNK_SIZE, end)])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    path.append(element.tag)
+                    continue
+                key = '/'.join(path[1:])
+                path.pop()
+                if key in FIELDS and FIELDS[key] not in fields:
+                    fields[FIELDS[key]] = (element.text or '').strip()
+                element.clear()
+                if key == 'appmsg':
+                    done = True
+                    break
+            if done:
+                break
+    except ParseError as e:
+        if not fields:
+            logger.debug(f"Not an app message: {e}")
+            return None
+        done = True
+    if not fields.get('type', None) and not fields.get('title', None):
+        return None
+    return AppMessage(type=_int(fields.get('type', None)),
+                      title=fields.get('title', ''),
+                      description=fields.get('description', ''),
+                      url=fields.get('url', ''),
+                      thumb_url=fields.get('thumb_url', ''),
+                      source=fields.get('source', ''),
+                      file_ext=fields.get('file_ext', ''),
+                      file_size=_int(fields.get('file_size', None)),
+                      quote_id=fields.get('quote_id', None) or None,
+                      # The chat in private chats, the member in rooms
+                      quote_sender=fields.get('quote_sender', None) or fields.get('quote_from', ''),
+                      quote_name=fields.get('quote_name', ''),
+                      quote_text=fields.get('quote_text', ''),
+                      truncated=not done and end < len(content))
+
+
+class AppMsgParser:
+    """
+    `parse_app_msg` with the results of the last `max_entries` distinct payloads memoized by their hash,
+    articles and mini programs are often forwarded to many rooms at once.
+    """
+
+    def __init__(self, max_length: int = 256 * 1024, max_entries: int = 1024):
+        self.max_length = max_length
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._parsed: 'OrderedDict[str, Optional[AppMessage]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._parsed)
+
+    def parse(self, content: str) -> Optional[AppMessage]:
+        key = hashlib.sha1(content.encode('utf-8', 'surrogatepass')).hexdigest()
+        with self._lock:
+            if key in self._parsed:
+                self.hits += 1
+                self._parsed.move_to_end(key)
+                return self._parsed[key]
+        self.misses += 1
+        parsed = parse_app_msg(content, self.max_length)
+        with self._lock:
+            self._parsed[key] = parsed
+            while len(self._parsed) > self.max_entries:
+                self._parsed.popitem(last=False)
+        return parsed
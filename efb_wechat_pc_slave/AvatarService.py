@@ -0,0 +1,143 @@
+# coding: utf-8
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .MediaCache import MediaCache
+from .utils import write_response
+
+logger = logging.getLogger(__name__)
+
+
+class _Validator(NamedTuple):
+    key: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    checked: float
+
+
+class AvatarService:
+    """
+    Fetch chat pictures through a pooled HTTP session.
+    Pictures are kept in the media cache and indexed by URL, stale ones are revalidated
+    with ETag / Last-Modified. Concurrent requests for one URL share a single download.
+    """
+
+    def __init__(self, cache: MediaCache, max_age: float = 24 * 3600, pool_size: int = 8,
+                 retry: int = 3, timeout: float = 10, prefetch_workers: int = 4,
+                 session: requests.Session = None):
+        """
+        :param session: Optional, a session shared with others, pool_size and retry are ignored then
+        """
+        self.cache = cache
+        self.max_age = max_age
+        self.timeout = timeout
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.revalidated = 0
+        self._index: 'OrderedDict[str, _Validator]' = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix="wechatPc-avatar")
+
+    def get(self, url: str) -> BinaryIO:
+        """
+        Get the picture behind the URL
+        Remember to close the file once you are done with the file!
+        :param url: The URL of the picture
+        :return: A read handle of the cached picture
+        """
+        with self._lock:
+            future = self._inflight.get(url, None)
+            owner = future is None
+            if owner:
+                future = self._inflight[url] = Future()
+        if owner:
+            try:
+                future.set_result(self._fetch(url))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self._inflight.pop(url, None)
+        cached = self.cache.open(future.result())
+        if cached is None:
+            # Evicted in the meantime
+            cached = self.cache.open(self._fetch(url, force=True))
+        return cached.file
+
+    def prefetch(self, urls: Iterable[str], limit: int):
+        """
+        Warm up the cache in background
+        :param urls: The picture URLs, in order of priority
+        :param limit: The max number of pictures to fetch
+        """
+        count = 0
+        for url in urls:
+            if count >= limit:
+                break
+            if not url or self._is_fresh(self._index.get(url, None)):
+                continue
+            self._executor.submit(self._prefetch_one, url)
+            count += 1
+        if count:
+            logger.debug(f"Prefetching {count} avatars")
+
+    def _prefetch_one(self, url: str):
+        try:
+            self.get(url).close()
+        except Exception as e:
+            logger.debug(f"Failed to prefetch {url}: {e}")
+
+    def _is_fresh(self, validator: Optional[_Validator]) -> bool:
+        return validator is not None and validator.key in self.cache and \
+            time.time() - validator.checked < self.max_age
+
+    def _fetch(self, url: str, force: bool = False) -> str:
+        """
+        Download the picture unless the cached copy is still valid
+        :return: The media cache key of the picture
+        """
+        validator = self._index.get(url, None)
+        if not force and self._is_fresh(validator):
+            return validator.key
+        headers = {}
+        if not force and validator is not None and validator.key in self.cache:
+            if validator.etag:
+                headers['If-None-Match'] = validator.etag
+            if validator.last_modified:
+                headers['If-Modified-Since'] = validator.last_modified
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 304 and headers:
+                self.revalidated += 1
+                self._remember(url, validator._replace(checked=time.time()))
+                return validator.key
+            r.raise_for_status()
+            cached = self.cache.store(lambda f: write_response(r, f))
+            cached.file.close()
+            self._remember(url, _Validator(cached.key, r.headers.get('ETag', None),
+                                           r.headers.get('Last-Modified', None), time.time()))
+        return cached.key
+
+    def _remember(self, url: str, validator: _Validator):
+        with self._lock:
+            self._index[url] = validator
+            self._index.move_to_end(url)
+            while len(self._index) > self.cache.max_entries:
+                self._index.popitem(last=False)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        if self._owns_session:
+            self.session.close()
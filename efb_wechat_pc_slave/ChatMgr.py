@@ -12,10 +12,14 @@ logger = logging.getLogger(__name__)
 
 
 class ChatMgr:
-    slave_channel = None
+    """
+    Build EFB chat objects belonging to one channel instance
+    """
 
-    @staticmethod
-    def build_efb_chat_as_group(group: EFBGroupChat,
+    def __init__(self, slave_channel: SlaveChannel):
+        self.slave_channel = slave_channel
+
+    def build_efb_chat_as_group(self, group: EFBGroupChat,
                                 members: Optional[List[EFBGroupMember]] = None) -> GroupChat:
         """
         Build EFB GroupChat object from EFBGroupChat Dict
@@ -25,7 +29,7 @@ class ChatMgr:
                         Each object in members (if not None) must follow the syntax of GroupChat.add_members
         """
         efb_chat: GroupChat = GroupChat(
-            channel=ChatMgr.slave_channel,
+            channel=self.slave_channel,
             **group
         )
         if members:
@@ -35,15 +39,14 @@ class ChatMgr:
                 )
         return efb_chat
 
-    @staticmethod
-    def build_efb_chat_as_private(private: EFBPrivateChat) -> PrivateChat:
+    def build_efb_chat_as_private(self, private: EFBPrivateChat) -> PrivateChat:
         """
         Build EFB PrivateChat object from EFBPrivateChat
         :return: GroupChat from group_id
         :param private: EFBPrivateChat object, see CustomTypes.py
         """
         efb_chat: PrivateChat = PrivateChat(
-            channel=ChatMgr.slave_channel,
+            channel=self.slave_channel,
             **private
         )
         return efb_chat
@@ -64,7 +67,6 @@ class ChatMgr:
         )
         return efb_chat
 
-    @staticmethod
-    def build_efb_chat_as_system_user(chat: EFBSystemUser):
-        return SystemChat(channel=ChatMgr.slave_channel,
-                          **chat)
\ No newline at end of file
+    def build_efb_chat_as_system_user(self, chat: EFBSystemUser):
+        return SystemChat(channel=self.slave_channel,
+                          **chat)
@@ -0,0 +1,49 @@
+# coding: utf-8
+import asyncio
+import logging
+from typing import Dict, Callable, Awaitable, Any
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSequencer:
+    """
+    Keep delivery order per chat while letting the preparation of messages run concurrently.
+    Each submitted job is delivered only after the previous job of the same chat was delivered (or failed).
+    """
+
+    def __init__(self):
+        self._tails: Dict[str, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._tails)
+
+    def submit(self, key: str, produce: Awaitable, deliver: Callable[[Any], Any],
+               on_error: Callable[[], Any] = None) -> asyncio.Future:
+        """
+        :param key: The ordering key, usually the chat uid
+        :param produce: Awaitable of the value to be delivered, it starts running right away
+        :param deliver: Called with the produced value in order of submission, may be a coroutine function
+        :param on_error: Optional, called when producing or delivering the value failed
+        :return: A future that is done once the value is delivered
+        """
+        previous = self._tails.get(key, None)
+        produced = asyncio.ensure_future(produce)
+
+        async def step():
+            try:
+                if previous is not None:
+                    await asyncio.wait([previous])
+                result = await produced
+                result = deliver(result)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception(f"Failed to deliver message of {key}")
+                if on_error is not None:
+                    on_error()
+
+        tail = asyncio.ensure_future(step())
+        self._tails[key] = tail
+        tail.add_done_callback(lambda f: self._tails.pop(key, None) if self._tails.get(key, None) is f else None)
+        return tail
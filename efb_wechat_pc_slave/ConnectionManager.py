@@ -0,0 +1,129 @@
+# coding: utf-8
+import asyncio
+import logging
+import random
+import threading
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+STATE_DISCONNECTED = 'disconnected'
+STATE_CONNECTING = 'connecting'
+STATE_LOGIN_PENDING = 'login_pending'
+STATE_LOGGED_IN = 'logged_in'
+
+
+class ConnectionManager:
+    """
+    Connection and login state of the hook, driven in background on the event loop so the
+    channel can be constructed without waiting for the hook or for someone to scan the QR code.
+
+        disconnected -> connecting -> login_pending -> logged_in
+
+    `connect` opens the websocket, `serve` reads from it until it's closed and `open_client`
+    asks the hook for the login status. The login status reported by the hook is fed
+    back through `on_login_status`.
+    When connecting fails or the connection drops, it's retried after a jittered exponential
+    backoff between `initial_delay` and `max_delay` seconds, reset once logged in again.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop,
+                 connect: Callable[[], Awaitable], serve: Callable[[], Awaitable],
+                 open_client: Callable[[], Awaitable],
+                 on_state_change: Callable[[str, str], None] = None,
+                 initial_delay: float = 1, max_delay: float = 60):
+        """
+        :param on_state_change: Called on the event loop with the old and new state
+        """
+        self.loop = loop
+        self.connect = connect
+        self.serve = serve
+        self.open_client = open_client
+        self.on_state_change = on_state_change
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.state = STATE_DISCONNECTED
+        self.logged_in = threading.Event()
+        self.reconnects = 0
+        self._attempt = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Start connecting, may be called from any thread
+        """
+        self.loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        """
+        Stop reconnecting, may be called from any thread
+        """
+        self.loop.call_soon_threadsafe(lambda: self._task is not None and self._task.cancel())
+
+    def backoff(self) -> float:
+        delay = min(self.max_delay, self.initial_delay * 2 ** self._attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        old, self.state = self.state, state
+        if state == STATE_LOGGED_IN:
+            self._attempt = 0
+            self.logged_in.set()
+        else:
+            self.logged_in.clear()
+        logger.info(f"Connection state: {old} -> {state}")
+        if self.on_state_change is not None:
+            try:
+                self.on_state_change(old, state)
+            except Exception:
+                logger.exception("Failed to handle connection state change")
+
+    def on_login_status(self, logged_in: bool):
+        """
+        Handle the login status reported by the hook
+        """
+        if self.state == STATE_DISCONNECTED or self.state == STATE_CONNECTING:
+            return
+        self._set_state(STATE_LOGGED_IN if logged_in else STATE_LOGIN_PENDING)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._connect_once()
+                delay = self.backoff()
+                self._attempt += 1
+                logger.info(f"Reconnecting to the hook in {delay:.1f} s")
+                await asyncio.sleep(delay)
+                self.reconnects += 1
+        finally:
+            self._set_state(STATE_DISCONNECTED)
+
+    async def _connect_once(self):
+        self._set_state(STATE_CONNECTING)
+        try:
+            await self.connect()
+        except Exception as e:
+            logger.error(f"Failed to connect to the hook: {e!r}")
+            self._set_state(STATE_DISCONNECTED)
+            return
+        self._set_state(STATE_LOGIN_PENDING)
+        serving = self.loop.create_task(self.serve())
+        try:
+            try:
+                await self.open_client()
+            except Exception as e:
+                logger.error(f"Failed to open the client: {e!r}")
+            await serving
+            logger.warning("Connection to the hook closed")
+        except asyncio.CancelledError:
+            serving.cancel()
+            raise
+        except Exception as e:
+            logger.error(f"Connection to the hook failed: {e!r}")
+        self._set_state(STATE_DISCONNECTED)
@@ -0,0 +1,102 @@
+# coding: utf-8
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Tuple, Iterable, Dict, Mapping
+
+from .ContactRecord import ContactRecord
+from .CustomTypes import EFBGroupChat, EFBPrivateChat
+
+logger = logging.getLogger(__name__)
+
+
+class ContactCache:
+    """
+    SQLite backed snapshot of the contact store, so that the chat list can be served
+    right after a restart while the live friend list is still being paged in.
+    The schema version is kept in PRAGMA user_version, a mismatching cache is discarded.
+    """
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path))
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            if version:
+                logger.info("Contact cache schema %s is outdated, rebuilding", version)
+            conn.executescript(f"""
+                DROP TABLE IF EXISTS friends;
+                DROP TABLE IF EXISTS chats;
+                CREATE TABLE friends (wxid TEXT PRIMARY KEY, data TEXT NOT NULL);
+                CREATE TABLE chats (uid TEXT PRIMARY KEY, is_group INTEGER NOT NULL,
+                                    name TEXT, alias TEXT);
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+            """)
+        return conn
+
+    def load(self) -> Tuple[List[dict], List[EFBPrivateChat]]:
+        """
+        Load the cached contact tables
+        :return: Raw friend dicts and chat entities, both empty if there's no usable cache
+        """
+        if not self.path.exists():
+            return [], []
+        with self._lock:
+            try:
+                conn = self._connect()
+                try:
+                    friends = [json.loads(data) for data, in conn.execute("SELECT data FROM friends")]
+                    entities = []
+                    for uid, is_group, name, alias in conn.execute("SELECT uid, is_group, name, alias FROM chats"):
+                        if is_group:
+                            entities.append(EFBGroupChat(uid=uid, name=name))
+                        else:
+                            entities.append(EFBPrivateChat(uid=uid, name=name, alias=alias))
+                finally:
+                    conn.close()
+            except (sqlite3.Error, ValueError) as e:
+                logger.warning(f"Failed to load contact cache {self.path}: {e}")
+                return [], []
+        return friends, entities
+
+    def save(self, friends: Dict[str, ContactRecord], entities: Mapping[str, EFBPrivateChat],
+             changed: Iterable[str] = None, removed: Iterable[str] = ()):
+        """
+        Write the contact tables to disk
+        :param friends: Contact records indexed by wxid
+        :param entities: Chat entities indexed by uid
+        :param changed: Ids to write, the whole table is rewritten when None
+        :param removed: Ids to delete
+        """
+        with self._lock:
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        if changed is None:
+                            conn.execute("DELETE FROM friends")
+                            conn.execute("DELETE FROM chats")
+                            changed = friends.keys() | entities.keys()
+                        else:
+                            conn.executemany("DELETE FROM friends WHERE wxid = ?", ((i,) for i in removed))
+                            # Rooms that are not named yet have no entity, drop their outdated row as well
+                            conn.executemany("DELETE FROM chats WHERE uid = ?",
+                                             ((i,) for i in set(removed) | set(changed) if i not in entities))
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO friends VALUES (?, ?)",
+                            ((i, json.dumps(friends[i].to_dict(), ensure_ascii=False)) for i in changed if i in friends))
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?)",
+                            ((i, int(not isinstance(entity, EFBPrivateChat)), entity.get('name', ''),
+                              entity.get('alias', None))
+                             for i, entity in ((i, entities[i]) for i in changed if i in entities)))
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to save contact cache {self.path}: {e}")
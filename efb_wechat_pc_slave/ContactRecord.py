@@ -0,0 +1,115 @@
+# coding: utf-8
+import sys
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+ROOM_MEMBER_SEPARATOR = '^G'
+
+
+class WxidTable:
+    """
+    Interned wxids numbered in the order they are first seen, room member lists are stored as arrays of these numbers.
+    The table only grows, so numbers stay valid across contact snapshots.
+    """
+    __slots__ = ('ids', 'index')
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.index: Dict[str, int] = {}
+
+    def intern(self, wxid: str) -> int:
+        number = self.index.get(wxid, None)
+        if number is None:
+            wxid = sys.intern(wxid)
+            number = self.index[wxid] = len(self.ids)
+            self.ids.append(wxid)
+        return number
+
+    def __getitem__(self, number: int) -> str:
+        return self.ids[number]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ContactRecord:
+    """
+    The fields of a friend list entry the channel uses, anything else sent by the hook is dropped.
+    `get` accepts the keys of the raw entry, so a record can be read like the dict it was built from.
+    """
+    __slots__ = ('wxid', 'nickname', 'remark', 'username', 'head_url', 'members', 'table')
+
+    def __init__(self, wxid: str, nickname: str = '', remark: str = '', username: str = '', head_url: str = '',
+                 members: Optional[array] = None, table: Optional[WxidTable] = None):
+        """
+        :param members: Numbers of the room members in `table`, None for anything but rooms
+        """
+        self.wxid = sys.intern(wxid)
+        self.nickname = nickname
+        self.remark = remark
+        self.username = username
+        self.head_url = head_url
+        self.members = members
+        self.table = table
+
+    @classmethod
+    def from_dict(cls, friend: dict, table: WxidTable) -> 'ContactRecord':
+        """
+        :param friend: Raw friend list entry, must have a wxid
+        :param table: Where room members are interned
+        """
+        members = None
+        room_wxid_list = friend.get('roomWxidList', None)
+        if room_wxid_list:
+            members = array('I', (table.intern(wxid) for wxid in room_wxid_list.split(ROOM_MEMBER_SEPARATOR) if wxid))
+        return cls(friend['wxid'],
+                   nickname=friend.get('nickname', None) or '',
+                   remark=friend.get('remark', None) or '',
+                   username=friend.get('username', None) or '',
+                   head_url=friend.get('headUrl', None) or '',
+                   members=members, table=table)
+
+    @property
+    def member_ids(self) -> Tuple[str, ...]:
+        if not self.members:
+            return ()
+        ids = self.table.ids
+        return tuple(ids[number] for number in self.members)
+
+    def get(self, key: str, default=None):
+        """
+        Read a field by its key in the raw friend list entry
+        """
+        if key == 'wxid':
+            return self.wxid
+        if key == 'nickname':
+            return self.nickname
+        if key == 'remark':
+            return self.remark
+        if key == 'username':
+            return self.username
+        if key == 'headUrl':
+            return self.head_url
+        if key == 'roomWxidList':
+            return ROOM_MEMBER_SEPARATOR.join(self.member_ids)
+        return default
+
+    def to_dict(self) -> dict:
+        friend = {'wxid': self.wxid, 'nickname': self.nickname, 'remark': self.remark,
+                  'username': self.username, 'headUrl': self.head_url}
+        if self.members:
+            friend['roomWxidList'] = ROOM_MEMBER_SEPARATOR.join(self.member_ids)
+        return friend
+
+    def __eq__(self, other):
+        if not isinstance(other, ContactRecord):
+            return NotImplemented
+        return self.wxid == other.wxid and self.nickname == other.nickname and self.remark == other.remark and \
+            self.username == other.username and self.head_url == other.head_url and \
+            (self.members == other.members if self.table is other.table else self.member_ids == other.member_ids)
+
+    def __hash__(self):
+        return hash(self.wxid)
+
+    def __repr__(self):
+        return f"ContactRecord({self.wxid!r}, nickname={self.nickname!r})"
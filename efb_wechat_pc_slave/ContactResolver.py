@@ -0,0 +1,122 @@
+# coding: utf-8
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from .ContactStore import ContactStore, ContactDiff
+
+logger = logging.getLogger(__name__)
+
+
+class ContactResolver:
+    """
+    Look up single contacts missing from the contact store, e.g. strangers or rooms created since the last refresh,
+    instead of reloading the whole friend list.
+
+    Concurrent lookups of the same id share one request. An id the hook did not know is not asked for again
+    until `negative_ttl` seconds passed. The hook answers in the return value of `fetch`, or with
+    `replies_by_message` in a message of its own that is passed to `on_contact`.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, store: ContactStore,
+                 fetch: Optional[Callable[[str], Awaitable]],
+                 on_resolved: Callable[[ContactDiff], None] = None, replies_by_message: bool = False,
+                 timeout: float = 10, negative_ttl: float = 300, max_negative: int = 10000):
+        """
+        :param fetch: Asks the hook for one contact, None if the hook can't, then every lookup misses
+        :param on_resolved: Called on the event loop with the diff of each contact added to the store
+        """
+        self.loop = loop
+        self.store = store
+        self.fetch = fetch
+        self.on_resolved = on_resolved
+        self.replies_by_message = replies_by_message
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        self.lookups = 0
+        self.misses = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._replies: Dict[str, asyncio.Future] = {}
+        self._negative: 'OrderedDict[str, float]' = OrderedDict()
+
+    def is_known_missing(self, wxid: str) -> bool:
+        expires = self._negative.get(wxid, None)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            self._negative.pop(wxid, None)
+            return False
+        return True
+
+    async def resolve(self, wxid: str, refresh: bool = False) -> bool:
+        """
+        Make sure a contact is in the store, must be called on the event loop
+        :param refresh: Look up the contact even if it's known, e.g. a room whose member list is stale
+        :return: Whether the contact is known now
+        """
+        if wxid in self.store and not refresh:
+            return True
+        if self.fetch is None or self.is_known_missing(wxid):
+            return False
+        lookup = self._inflight.get(wxid, None)
+        if lookup is None:
+            lookup = self._inflight[wxid] = self.loop.create_task(self._lookup(wxid))
+        return await asyncio.shield(lookup)
+
+    def resolve_threadsafe(self, wxid: str, timeout: float = None) -> bool:
+        """
+        `resolve` from another thread, waits at most `timeout` seconds
+        """
+        if wxid in self.store:
+            return True
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                # Waiting here would block the lookup itself
+                return False
+        except RuntimeError:
+            pass
+        try:
+            return asyncio.run_coroutine_threadsafe(self.resolve(wxid), self.loop).result(timeout)
+        except Exception as e:
+            logger.debug(f"Looking up contact {wxid} failed: {e!r}")
+            return False
+
+    def on_contact(self, friend: dict):
+        """
+        Handle a contact sent by the hook in reply to a lookup
+        """
+        reply = self._replies.get(friend.get('wxid', None), None)
+        if reply is not None and not reply.done():
+            reply.set_result(friend)
+
+    async def _lookup(self, wxid: str) -> bool:
+        self.lookups += 1
+        reply = self._replies[wxid] = self.loop.create_future()
+        try:
+            friend = await asyncio.wait_for(self._request(wxid, reply), self.timeout)
+            if isinstance(friend, dict) and friend.get('wxid', None) == wxid:
+                diff = self.store.apply_contact(friend)
+                if diff and self.on_resolved is not None:
+                    self.on_resolved(diff)
+                return True
+        except asyncio.TimeoutError:
+            logger.debug(f"Looking up contact {wxid} timed out")
+        except Exception as e:
+            logger.warning(f"Failed to look up contact {wxid}: {e!r}")
+        finally:
+            self._inflight.pop(wxid, None)
+            self._replies.pop(wxid, None)
+        self.misses += 1
+        self._negative[wxid] = time.monotonic() + self.negative_ttl
+        while len(self._negative) > self.max_negative:
+            self._negative.popitem(last=False)
+        return False
+
+    async def _request(self, wxid: str, reply: asyncio.Future):
+        friend = await self.fetch(wxid)
+        if isinstance(friend, dict) or not self.replies_by_message:
+            return friend
+        return await reply
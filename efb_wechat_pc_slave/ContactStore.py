@@ -0,0 +1,385 @@
+# coding: utf-8
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Optional, List, Collection, NamedTuple, Set, Tuple, Iterator
+
+from ehforwarderbot import Chat
+
+from .ChatMgr import ChatMgr
+from .ContactRecord import ContactRecord, WxidTable, ROOM_MEMBER_SEPARATOR
+from .CustomTypes import EFBGroupChat, EFBGroupMember, EFBPrivateChat
+
+logger = logging.getLogger(__name__)
+
+ROOM_SUFFIX = '@chatroom'
+
+
+class ContactDiff(NamedTuple):
+    added: Set[str]
+    changed: Set[str]
+    removed: Set[str]
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self):
+        return f"+{len(self.added)} ~{len(self.changed)} -{len(self.removed)}"
+
+
+def is_room(wxid: str) -> bool:
+    return ROOM_SUFFIX in wxid
+
+
+def is_unnamed_room(record: ContactRecord) -> bool:
+    """
+    Rooms without a given name are named after their members
+    """
+    return not record.username and not record.nickname and record.members is not None and \
+        len(record.members) > 1 and is_room(record.wxid)
+
+
+def split_room_members(room_wxid_list: str) -> Tuple[str, ...]:
+    """
+    Split the roomWxidList string given by the hook
+    :param room_wxid_list: Member wxids joined by ^G
+    :return: Tuple of member wxids
+    """
+    if not room_wxid_list:
+        return ()
+    return tuple(wxid for wxid in room_wxid_list.split(ROOM_MEMBER_SEPARATOR) if wxid)
+
+
+class _Snapshot:
+    """
+    A view of the contact tables.
+    Chats are built from the records when first asked for, and rooms without a name are named then.
+    Once published, a snapshot only changes by adding those, readers can hold on to it without locking.
+    """
+    __slots__ = ('records', 'room_names', 'chats', 'chat_list', 'populated')
+
+    def __init__(self,
+                 records: Dict[str, ContactRecord] = None,
+                 room_names: Dict[str, str] = None,
+                 chats: Dict[str, Chat] = None,
+                 populated: Set[str] = None):
+        self.records: Dict[str, ContactRecord] = records or {}
+        # Names made up from the members of rooms without a given name
+        self.room_names: Dict[str, str] = room_names or {}
+        self.chats: Dict[str, Chat] = chats or {}
+        self.chat_list: Optional[Tuple[Chat, ...]] = None
+        # Rooms whose GroupChat has its members added
+        self.populated: Set[str] = populated or set()
+
+
+class _EntityView(Mapping):
+    """
+    Chat entities of a snapshot built as they are read, rooms that were not named yet are left out
+    """
+
+    def __init__(self, store: 'ContactStore', snapshot: _Snapshot):
+        self.store = store
+        self.snapshot = snapshot
+
+    def __getitem__(self, uid: str) -> EFBPrivateChat:
+        if uid not in self:
+            raise KeyError(uid)
+        return self.store._entity(self.snapshot, self.snapshot.records[uid])
+
+    def __contains__(self, uid):
+        record = self.snapshot.records.get(uid, None)
+        return record is not None and (not is_unnamed_room(record) or uid in self.snapshot.room_names)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([uid for uid in self.snapshot.records if uid in self])
+
+    def __len__(self):
+        return sum(1 for uid in self.snapshot.records if uid in self)
+
+
+class ContactStore:
+    """
+    Indexed store of contacts and chats fed by OPCODE_FRIEND_LIST pages.
+
+    Pages are staged as they arrive. Once every page of a refresh is received they are turned into
+    compact records, reusing the records and Chat objects of entries that did not change, and
+    published as a new snapshot in a single assignment, so readers never observe a half-built list.
+    EFB chats are only built when asked for.
+    """
+
+    def __init__(self, chat_mgr: ChatMgr, max_looked_up: int = 5000):
+        """
+        :param max_looked_up: Contacts looked up one by one (see `apply_contact`) kept across refreshes
+        """
+        self.chat_mgr = chat_mgr
+        self.max_looked_up = max_looked_up
+        self.table = WxidTable()
+        self._snapshot: _Snapshot = _Snapshot()
+        self._lock = threading.Lock()
+        self._staging: Dict[int, List[dict]] = {}
+        self._staging_total: int = 0
+        self._committed_digests: Dict[int, bytes] = {}
+        # Looked up contacts, strangers and rooms not saved to contacts are never in the friend list
+        self._looked_up: 'OrderedDict[str, ContactRecord]' = OrderedDict()
+        self._resolve_lock = threading.RLock()
+        self.ready = threading.Event()
+
+    # region Readers
+
+    def __len__(self):
+        return len(self._snapshot.records)
+
+    def __contains__(self, wxid: str):
+        return wxid in self._snapshot.records
+
+    def get_friend_info(self, item: str, wxid: str) -> Optional[str]:
+        """
+        :param item: Key of the field in the raw friend list entry, e.g. nickname or headUrl
+        """
+        record = self._snapshot.records.get(wxid, None)
+        if record is None:
+            return None
+        return record.get(item, None)
+
+    def get_entity(self, uid: str) -> Optional[EFBPrivateChat]:
+        snapshot = self._snapshot
+        record = snapshot.records.get(uid, None)
+        if record is None:
+            return None
+        return self._entity(snapshot, record)
+
+    def get_chat(self, uid: str) -> Optional[Chat]:
+        """
+        Get a chat, rooms are named and populated with their members on first access
+        """
+        snapshot = self._snapshot
+        chat = snapshot.chats.get(uid, None)
+        if chat is None:
+            record = snapshot.records.get(uid, None)
+            if record is None:
+                return None
+            chat = self._build_chat(snapshot, record)
+        if uid not in snapshot.populated and is_room(uid):
+            self._populate_room(snapshot, uid, chat)
+        return chat
+
+    def get_chats(self) -> Collection[Chat]:
+        snapshot = self._snapshot
+        if snapshot.chat_list is None:
+            with self._resolve_lock:
+                chats = snapshot.chats
+                snapshot.chat_list = tuple(chats.get(uid, None) or self._build_chat(snapshot, record)
+                                           for uid, record in snapshot.records.items())
+        return snapshot.chat_list
+
+    def is_room_member(self, room_id: str, wxid: str) -> Optional[bool]:
+        """
+        :return: Whether wxid is in the member list of the room, None if the room or its members are unknown
+        """
+        record = self._snapshot.records.get(room_id, None)
+        if record is None or not record.members:
+            return None
+        number = record.table.index.get(wxid, None)
+        return number is not None and number in record.members
+
+    def export(self) -> Tuple[Dict[str, ContactRecord], Mapping]:
+        """
+        :return: The contact records and chat entities of the current snapshot, both indexed by id.
+                 Entities are built as they are read, rooms that were not named yet have none.
+        """
+        snapshot = self._snapshot
+        return snapshot.records, _EntityView(self, snapshot)
+
+    # endregion
+
+    # region Writers
+
+    def restore(self, friend_list: List[dict], entities: List[EFBPrivateChat]):
+        """
+        Publish a snapshot loaded from the contact cache, the next complete refresh is diffed against it.
+        :param friend_list: Raw friend dicts
+        :param entities: Chat entities built from them, only the names made up for rooms are taken
+        """
+        records: Dict[str, ContactRecord] = {}
+        for friend in friend_list:
+            if 'wxid' in friend:
+                record = ContactRecord.from_dict(friend, self.table)
+                records[record.wxid] = record
+        room_names: Dict[str, str] = {}
+        for entity in entities:
+            record = records.get(entity['uid'], None)
+            if record is not None and is_unnamed_room(record) and entity.get('name', None):
+                room_names[record.wxid] = entity['name']
+        self._snapshot = _Snapshot(records, room_names)
+        if records:
+            self.ready.set()
+
+    def begin_refresh(self):
+        """
+        Drop pages staged by an earlier, unfinished refresh
+        """
+        with self._lock:
+            self._staging = {}
+            self._staging_total = 0
+
+    def missing_pages(self) -> List[int]:
+        with self._lock:
+            return [p for p in range(1, self._staging_total + 1) if p not in self._staging]
+
+    def apply_page(self, page: int, total_pages: int, friend_list: List[dict]) -> Optional[ContactDiff]:
+        """
+        Merge one page of the friend list. Pages may arrive in any order, a page received twice replaces the first copy.
+        :param page: 1-based page number reported by the hook
+        :param total_pages: Number of pages in this refresh
+        :param friend_list: Raw friend dicts of this page
+        :return: The diff against the previous snapshot once the last page has been applied, None otherwise
+        """
+        with self._lock:
+            if total_pages != self._staging_total:
+                # The size of the list changed, anything staged before is stale
+                self._staging = {}
+                self._staging_total = total_pages
+            self._staging[page] = friend_list
+            if len(self._staging) < max(total_pages, 1):
+                return None
+            pages = self._staging
+            self._staging = {}
+            self._staging_total = 0
+        # Only digests of the pages are kept to tell whether the next refresh changed anything
+        digests = {p: hashlib.sha1(json.dumps(friends, sort_keys=True).encode()).digest()
+                   for p, friends in pages.items()}
+        with self._lock:
+            unchanged = digests == self._committed_digests
+            self._committed_digests = digests
+        if unchanged and self.ready.is_set():
+            # Same total and identical pages, nothing to rebuild
+            diff = ContactDiff(set(), set(), set())
+            logger.debug("Contact store unchanged")
+            return diff
+        return self._commit([friend for p in sorted(pages) for friend in pages[p]])
+
+    def _commit(self, friend_list: List[dict]) -> ContactDiff:
+        old = self._snapshot
+        records: Dict[str, ContactRecord] = {}
+        for friend in friend_list:
+            if 'wxid' not in friend:
+                continue
+            record = ContactRecord.from_dict(friend, self.table)
+            old_record = old.records.get(record.wxid, None)
+            # Unchanged entries keep the old record, which is then told apart by identity
+            records[record.wxid] = old_record if old_record == record else record
+
+        with self._resolve_lock:
+            # Contacts may have been looked up meanwhile
+            old = self._snapshot
+            for wxid, record in list(self._looked_up.items()):
+                if wxid in records:
+                    del self._looked_up[wxid]
+                else:
+                    records[wxid] = record
+            added = set(records.keys() - old.records.keys())
+            removed = set(old.records.keys() - records.keys())
+            changed = {wxid for wxid, record in records.items()
+                       if wxid in old.records and old.records[wxid] is not record and old.records[wxid] != record}
+            # Keep whatever was built for entries that did not change
+            kept = [uid for uid in old.chats if uid in records and uid not in changed]
+            chats = {uid: old.chats[uid] for uid in kept}
+            populated = {uid for uid in kept if uid in old.populated}
+            room_names = {uid: name for uid, name in old.room_names.items()
+                          if uid in records and uid not in changed}
+            self._snapshot = _Snapshot(records, room_names, chats, populated)
+        self.ready.set()
+        diff = ContactDiff(added, changed, removed)
+        logger.debug("Contact store updated: %s", diff)
+        return diff
+
+    def apply_contact(self, friend: dict) -> ContactDiff:
+        """
+        Add or update a single contact looked up on its own, without waiting for a refresh.
+        :param friend: Raw friend dict as in a friend list page
+        :return: The diff against the previous snapshot
+        """
+        record = ContactRecord.from_dict(friend, self.table)
+        wxid = record.wxid
+        with self._resolve_lock:
+            old = self._snapshot
+            old_record = old.records.get(wxid, None)
+            if old_record == record:
+                return ContactDiff(set(), set(), set())
+            self._looked_up[wxid] = record
+            self._looked_up.move_to_end(wxid)
+            while len(self._looked_up) > self.max_looked_up:
+                self._looked_up.popitem(last=False)
+            # Published as a new snapshot like a refresh, a snapshot is never resized under its readers
+            records = dict(old.records)
+            records[wxid] = record
+            chats = {uid: chat for uid, chat in old.chats.items() if uid != wxid}
+            room_names = {uid: name for uid, name in old.room_names.items() if uid != wxid}
+            self._snapshot = _Snapshot(records, room_names, chats, old.populated - {wxid})
+        if old_record is None:
+            return ContactDiff({wxid}, set(), set())
+        return ContactDiff(set(), {wxid}, set())
+
+    def _entity(self, snapshot: _Snapshot, record: ContactRecord) -> EFBPrivateChat:
+        if not is_room(record.wxid):
+            return EFBPrivateChat(
+                uid=record.wxid,
+                name=record.nickname,
+                alias=record.remark
+            )
+        return EFBGroupChat(
+            uid=record.wxid,
+            name=self._room_name(snapshot, record)
+        )
+
+    def _build_chat(self, snapshot: _Snapshot, record: ContactRecord) -> Chat:
+        with self._resolve_lock:
+            chat = snapshot.chats.get(record.wxid, None)
+            if chat is not None:
+                return chat
+            entity = self._entity(snapshot, record)
+            if is_room(record.wxid):
+                chat = self.chat_mgr.build_efb_chat_as_group(entity)
+            else:
+                chat = self.chat_mgr.build_efb_chat_as_private(entity)
+            snapshot.chats[record.wxid] = chat
+            return chat
+
+    def _populate_room(self, snapshot: _Snapshot, uid: str, chat: Chat):
+        """
+        Add the known members of a room to its GroupChat
+        """
+        with self._resolve_lock:
+            if uid in snapshot.populated:
+                return
+            records = snapshot.records
+            record = records.get(uid, None)
+            for wxid in record.member_ids if record is not None else ():
+                member = records.get(wxid, None)
+                ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
+                    name=(member.nickname if member else None) or wxid,
+                    alias=(member.remark or None) if member else None,
+                    uid=wxid
+                ))
+            snapshot.populated.add(uid)
+
+    def _room_name(self, snapshot: _Snapshot, record: ContactRecord) -> str:
+        group_name = record.username or record.nickname
+        if group_name:
+            return group_name
+        if not is_unnamed_room(record):
+            return record.wxid
+        name = snapshot.room_names.get(record.wxid, None)
+        if name is None:
+            # No name was given to the group, use member names as a temp name
+            records = snapshot.records
+            name = '、'.join(records[wxid].username or records[wxid].nickname
+                            for wxid in record.member_ids if wxid in records)
+            with self._resolve_lock:
+                name = snapshot.room_names.setdefault(record.wxid, name)
+        return name or record.wxid
+
+    # endregion
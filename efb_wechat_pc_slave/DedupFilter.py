@@ -0,0 +1,84 @@
+# coding: utf-8
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from .MessageIndex import wechat_msg_id
+
+
+# Fields of a raw message that tell it apart from another one without an id, anything else (e.g. a timestamp)
+# may differ when the hook sends a message again
+FINGERPRINT_KEYS = ('wxid', 'roomId', 'msgType', 'content')
+
+
+def fingerprint(msg: dict) -> str:
+    """
+    Hash of the sender, chat, type and content of a raw message, for messages without an id
+    """
+    digest = hashlib.sha1()
+    for key in FINGERPRINT_KEYS:
+        digest.update(str(msg.get(key, '')).encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DedupFilter:
+    """
+    Recognize messages the hook sent more than once, e.g. after a reconnect.
+
+    Messages are remembered by their WeChat id for `window` seconds, messages without an id by a fingerprint
+    of their sender, chat, type and content for `fingerprint_window` seconds, `window` by default.
+    A shorter `fingerprint_window` lets the same text sent twice on purpose through, at the cost of
+    missing duplicates sent again after a longer reconnect.
+    At most `max_entries` messages are remembered, oldest first out. Not thread safe, used on the event loop.
+    """
+
+    def __init__(self, window: float = 600, fingerprint_window: Optional[float] = None, max_entries: int = 20000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param clock: Current time in seconds, the windows are measured with it
+        """
+        self.window = window
+        self.fingerprint_window = window if fingerprint_window is None else fingerprint_window
+        self.max_entries = max_entries
+        self.clock = clock
+        self.checked = 0
+        self.hits = 0
+        # Key -> when it's forgotten
+        self._seen: 'OrderedDict[str, float]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def is_duplicate(self, msg: dict) -> bool:
+        """
+        Check a received message and remember it
+        :return: Whether the same message was seen within the window
+        """
+        self.checked += 1
+        if self.remember(msg):
+            self.hits += 1
+            return True
+        return False
+
+    def remember(self, msg: dict) -> bool:
+        """
+        Remember a message without counting it, e.g. one that is replayed from the journal
+        :return: Whether it was remembered already
+        """
+        now = self.clock()
+        wechat_id = wechat_msg_id(msg)
+        if wechat_id is not None:
+            key, window = f"id:{wechat_id}", self.window
+        else:
+            key, window = f"fp:{fingerprint(msg)}", self.fingerprint_window
+        expires = self._seen.pop(key, None)
+        self._seen[key] = now + window
+        self._expire(now)
+        return expires is not None and expires > now
+
+    def _expire(self, now: float):
+        # Mostly in order of expiry, entries behind a later one are checked on lookup
+        while self._seen and (len(self._seen) > self.max_entries or next(iter(self._seen.values())) <= now):
+            self._seen.popitem(last=False)
@@ -0,0 +1,124 @@
+# coding: utf-8
+import asyncio
+import inspect
+import logging
+from typing import Dict, Optional
+
+from wechatPc import WechatPcClient
+
+from .ContactStore import ContactStore, ContactDiff
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+
+
+class FriendListPager:
+    """
+    Drive friend list refreshes and feed the pages into the contact store.
+
+    When the client can request a single page, the first page is fetched to learn the
+    page count and the rest is requested with up to `concurrency` pages in flight, each
+    page with its own timeout and retries. Otherwise the whole list is requested and
+    re-requested when no page arrives for `page_timeout` seconds.
+    Concurrent callers of `refresh` share the refresh in progress.
+    """
+
+    def __init__(self, client: WechatPcClient, store: ContactStore, concurrency: int = 4,
+                 page_timeout: float = 10, retries: int = 3):
+        self.client = client
+        self.store = store
+        self.concurrency = concurrency
+        self.page_timeout = page_timeout
+        self.retries = retries
+        self.pages_received = 0
+        self._per_page = self._supports_page_request(client)
+        self._page_events: Dict[int, asyncio.Event] = {}
+        self._complete: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _supports_page_request(client: WechatPcClient) -> bool:
+        try:
+            return 'page' in inspect.signature(client.get_friend_list).parameters
+        except (TypeError, ValueError):
+            return False
+
+    def on_page(self, msg: dict) -> Optional[ContactDiff]:
+        """
+        Handle an OPCODE_FRIEND_LIST message
+        :return: The diff once the list is complete, None otherwise
+        """
+        total = int(msg['total'])
+        total_page = (total + PAGE_SIZE - 1) // PAGE_SIZE
+        page = int(msg['page'])
+        self.pages_received += 1
+        diff = self.store.apply_page(page, total_page, msg['friendList'])
+        event = self._page_events.get(page, None)
+        if event is not None:
+            event.set()
+        if diff is not None and self._complete is not None and not self._complete.done():
+            self._complete.set_result(diff)
+        return diff
+
+    async def refresh(self) -> ContactDiff:
+        """
+        Reload the friend list
+        :return: The diff against the previous list
+        """
+        if self._complete is not None and not self._complete.done():
+            return await asyncio.shield(self._complete)
+        self._complete = complete = asyncio.get_event_loop().create_future()
+        self.store.begin_refresh()
+        try:
+            if self._per_page:
+                await self._refresh_pages()
+            else:
+                await self._refresh_whole()
+        except Exception as e:
+            if not complete.done():
+                complete.set_exception(e)
+        finally:
+            self._page_events.clear()
+        if not complete.done():
+            complete.set_exception(TimeoutError("Friend list refresh timed out"))
+        return await complete
+
+    async def _refresh_whole(self):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logger.info(f"Friend list stalled, requesting again ({attempt}/{self.retries})")
+            await self.client.get_friend_list()
+            while True:
+                seen = self.pages_received
+                done, _ = await asyncio.wait([self._complete], timeout=self.page_timeout)
+                if done:
+                    return
+                if self.pages_received == seen:
+                    break
+
+    async def _request_page(self, page: int):
+        event = self._page_events[page] = asyncio.Event()
+        for attempt in range(self.retries + 1):
+            if self._complete.done():
+                return
+            if attempt:
+                logger.debug(f"Page {page} of the friend list timed out, requesting again ({attempt}/{self.retries})")
+            await self.client.get_friend_list(page=page)
+            try:
+                await asyncio.wait_for(event.wait(), self.page_timeout)
+                return
+            except asyncio.TimeoutError:
+                pass
+        raise TimeoutError(f"Page {page} of the friend list timed out")
+
+    async def _refresh_pages(self):
+        await self._request_page(1)
+        if self._complete.done():
+            return
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(page: int):
+            async with slots:
+                await self._request_page(page)
+
+        await asyncio.gather(*(fetch(page) for page in self.store.missing_pages()))
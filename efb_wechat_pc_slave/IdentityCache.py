@@ -0,0 +1,116 @@
+# coding: utf-8
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from ehforwarderbot import Chat
+from ehforwarderbot.chat import ChatMember, GroupChat
+
+from .ChatMgr import ChatMgr
+from .ContactStore import ContactStore, is_room
+from .CustomTypes import EFBGroupChat, EFBGroupMember, EFBPrivateChat
+
+logger = logging.getLogger(__name__)
+
+
+class IdentityCache:
+    """
+    Resolve (room, wxid) of incoming messages to EFB Chat / ChatMember objects.
+    Resolved objects are reused for every later message until the contact store
+    reports a change of the chat or member through `invalidate`.
+    """
+
+    def __init__(self, contacts: ContactStore, max_members: int = 20000,
+                 on_unknown_member: Callable[[str, str], None] = None):
+        """
+        :param on_unknown_member: Called with room id and wxid of a sender missing from the member list of the room
+        """
+        self.contacts = contacts
+        self.max_members = max_members
+        self.on_unknown_member = on_unknown_member
+        self.hits = 0
+        self.misses = 0
+        self._chats: Dict[str, Chat] = {}
+        self._members: 'OrderedDict[Tuple[str, str], ChatMember]' = OrderedDict()
+        self._rooms_of: Dict[str, Set[str]] = {}
+
+    def resolve(self, wxid: str, room_id: Optional[str] = None) -> Tuple[Chat, ChatMember]:
+        """
+        :param wxid: The sender
+        :param room_id: The room the message was sent in, None or empty for private messages
+        :return: The chat and the author of the message
+        """
+        if not room_id:
+            chat = self._chats.get(wxid, None)
+            if chat is None:
+                self.misses += 1
+                chat = self._chats[wxid] = self._build_private(wxid)
+            else:
+                self.hits += 1
+            return chat, chat.other
+
+        key = (room_id, wxid)
+        member = self._members.get(key, None)
+        if member is not None:
+            self.hits += 1
+            self._members.move_to_end(key)
+            return member.chat, member
+        self.misses += 1
+        chat = self._chats.get(room_id, None)
+        if chat is None:
+            chat = self._chats[room_id] = self._build_group(room_id)
+        if self.on_unknown_member is not None and self.contacts.is_room_member(room_id, wxid) is False:
+            self.on_unknown_member(room_id, wxid)
+        member = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
+            name=self.contacts.get_friend_info('nickname', wxid),
+            alias=self.contacts.get_friend_info('remark', wxid),
+            uid=wxid
+        ))
+        self._members[key] = member
+        self._rooms_of.setdefault(wxid, set()).add(room_id)
+        while len(self._members) > self.max_members:
+            (old_room, old_wxid), _ = self._members.popitem(last=False)
+            self._forget_room(old_wxid, old_room)
+        return chat, member
+
+    def _build_private(self, wxid: str) -> Chat:
+        chat = self.contacts.get_chat(wxid)
+        if chat is not None:
+            return chat
+        return self.contacts.chat_mgr.build_efb_chat_as_private(EFBPrivateChat(
+            uid=wxid,
+            name=wxid
+        ))
+
+    def _build_group(self, room_id: str) -> GroupChat:
+        chat = self.contacts.get_chat(room_id)
+        if chat is not None:
+            return chat
+        return self.contacts.chat_mgr.build_efb_chat_as_group(EFBGroupChat(
+            uid=room_id,
+            name=room_id
+        ))
+
+    def _forget_room(self, wxid: str, room_id: str):
+        rooms = self._rooms_of.get(wxid, None)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self._rooms_of[wxid]
+
+    def invalidate(self, ids: Iterable[str]):
+        """
+        Drop everything resolved for the given chats or members
+        :param ids: wxids of contacts or rooms that changed
+        """
+        stale = set(ids)
+        for uid in stale:
+            self._chats.pop(uid, None)
+            for room_id in self._rooms_of.pop(uid, ()):
+                member = self._members.pop((room_id, uid), None)
+                if member is not None and member in member.chat.members:
+                    member.chat.members.remove(member)
+        if any(is_room(uid) for uid in stale):
+            for key in [key for key in self._members if key[0] in stale]:
+                self._forget_room(key[1], key[0])
+                del self._members[key]
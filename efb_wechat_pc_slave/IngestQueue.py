@@ -0,0 +1,215 @@
+# coding: utf-8
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Any
+
+from ehforwarderbot import Message
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_SPILL = 'spill'
+OVERFLOW_DROP = 'drop'
+
+
+class _SpillFile:
+    """
+    FIFO of raw hook messages in a JSON lines file
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._reader = None
+        self.count = 0
+        if path.exists():
+            with path.open('rb') as f:
+                self.count = sum(1 for line in f if line.strip())
+
+    def __len__(self):
+        return self.count
+
+    def append(self, msg: dict):
+        with self.path.open('a', encoding='utf-8') as f:
+            f.write(json.dumps(msg, ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def pop(self) -> Optional[dict]:
+        if not self.count:
+            return None
+        if self._reader is None:
+            self._reader = self.path.open('r', encoding='utf-8')
+        line = self._reader.readline()
+        while line and not line.strip():
+            line = self._reader.readline()
+        self.count -= 1
+        if not self.count:
+            self._reader.close()
+            self._reader = None
+            self.path.unlink()
+        return json.loads(line) if line else None
+
+
+class IngestQueue:
+    """
+    Bounded hand-over between the websocket handler and delivery to the master.
+
+    A message takes a slot when admitted and frees it once a delivery worker handed it to the master.
+    When all slots are taken, the overflow policy applies:
+        block: the handler waits for a free slot, so no more frames are read from the hook
+        spill: the raw message is appended to a file and processed once slots free up again
+        drop:  the message is dropped, and a notice is sent to the chat with its next message
+    Each chat is mapped to one worker so messages of a chat are delivered in order.
+    With `resume_spill` off, messages spilled in the last run are discarded instead of
+    replayed, for when they are recovered from elsewhere.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, deliver: Callable[[Message], Any],
+                 workers: int = 2, max_size: int = 1000, overflow: str = OVERFLOW_BLOCK,
+                 spill_path: Path = None,
+                 replay: Callable[[dict], Awaitable] = None,
+                 drop_notice: Callable[[Message, int], Message] = None,
+                 resume_spill: bool = True,
+                 on_failed: Callable[[Message], Any] = None):
+        """
+        :param on_failed: Called on the event loop with a message the master did not accept
+        """
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_SPILL, OVERFLOW_DROP):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        if overflow == OVERFLOW_SPILL and (spill_path is None or replay is None):
+            raise ValueError("spill_path and replay are required to spill messages")
+        self.loop = loop
+        self.deliver = deliver
+        self.max_size = max_size
+        self.overflow = overflow
+        self.replay = replay
+        self.drop_notice = drop_notice
+        self.on_failed = on_failed
+        self.pending = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._slots = asyncio.Semaphore(max_size)
+        self._dropped_per_chat: Dict[str, int] = {}
+        if not resume_spill and spill_path is not None and spill_path.exists():
+            spill_path.unlink()
+        self._spill = _SpillFile(spill_path) if overflow == OVERFLOW_SPILL else None
+        self._replaying = False
+        self._queues: List[queue.Queue] = []
+        self._workers: List[threading.Thread] = []
+        for i in range(max(workers, 1)):
+            q = queue.Queue()
+            self._queues.append(q)
+            worker = threading.Thread(target=self._work, args=(q,), name=f"wechatPc-ingest-{i}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+        if self._spill:
+            # Left over from the last run
+            loop.call_soon_threadsafe(self._start_replay)
+
+    @property
+    def spill_size(self) -> int:
+        return len(self._spill) if self._spill else 0
+
+    async def admit(self, msg: dict) -> bool:
+        """
+        Take a slot for a raw hook message before processing it
+        :return: False if the message was spilled or dropped and must not be processed now
+        """
+        if self.overflow == OVERFLOW_BLOCK:
+            await self._slots.acquire()
+            return True
+        if self.overflow == OVERFLOW_SPILL:
+            if self._spill or self._slots.locked():
+                # Keep the order, once spilling started everything goes through the spill file
+                self._spill.append(msg)
+                self.spilled += 1
+                self._start_replay()
+                return False
+            await self._slots.acquire()
+            return True
+        if self._slots.locked():
+            key = msg.get('roomId', None) or msg.get('wxid', '')
+            self._dropped_per_chat[key] = self._dropped_per_chat.get(key, 0) + 1
+            self.dropped += 1
+            return False
+        await self._slots.acquire()
+        return True
+
+    def release(self):
+        """
+        Give back a slot of an admitted message that will not be put into the queue
+        """
+        self._slots.release()
+
+    def put(self, key: str, efb_msg: Message, slots: int = 1):
+        """
+        Queue an admitted message for delivery
+        :param key: The ordering key, usually the chat uid
+        :param slots: The slots held by the message, more than one if it merges admitted messages,
+            0 for notices and statuses that were not admitted
+        """
+        q = self._queues[zlib.crc32(key.encode()) % len(self._queues)]
+        dropped = self._dropped_per_chat.pop(key, 0)
+        if dropped and self.drop_notice:
+            q.put((self.drop_notice(efb_msg, dropped), 0))
+        self.pending += slots
+        q.put((efb_msg, slots))
+
+    def _start_replay(self):
+        if not self._replaying and self._spill:
+            self._replaying = True
+            self.loop.create_task(self._replay_spill())
+
+    async def _replay_spill(self):
+        try:
+            while self._spill:
+                await self._slots.acquire()
+                msg = self._spill.pop()
+                if msg is None:
+                    self._slots.release()
+                    continue
+                try:
+                    await self.replay(msg)
+                except Exception:
+                    logger.exception("Failed to replay spilled message")
+        finally:
+            self._replaying = False
+
+    def _work(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            efb_msg, slots = item
+            try:
+                self.deliver(efb_msg)
+            except Exception:
+                logger.exception("Failed to deliver message to master")
+                if self.on_failed is not None:
+                    self.loop.call_soon_threadsafe(self.on_failed, efb_msg)
+            finally:
+                if slots:
+                    self.loop.call_soon_threadsafe(self._delivered, slots)
+
+    def _delivered(self, slots: int):
+        self.pending -= slots
+        for _ in range(slots):
+            self._slots.release()
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stop the workers once they delivered what is queued
+        :param timeout: Seconds to wait for them in total, None to wait as long as it takes
+        :return: Whether all workers stopped in time
+        """
+        for q in self._queues:
+            q.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not any(worker.is_alive() for worker in self._workers)
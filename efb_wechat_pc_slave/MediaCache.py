@@ -0,0 +1,175 @@
+# coding: utf-8
+import contextlib
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional, Union, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(NamedTuple):
+    path: Path
+    size: int
+    mime: Optional[str]
+    accessed: float
+
+
+class CachedMedia(NamedTuple):
+    file: BinaryIO
+    mime: Optional[str]
+    key: str
+
+
+class _HashingWriter:
+    """
+    File-like wrapper that hashes everything written through it
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, item):
+        return getattr(self.file, item)
+
+
+class MediaCache:
+    """
+    Content-addressed store for media files, bounded by total size and entry count.
+    Entries are evicted in LRU order, and dropped once not accessed for `ttl` seconds.
+    Each hit returns a freshly opened handle, so the receiver may close it freely.
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 256 * 1024 * 1024, max_entries: int = 4096,
+                 ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        # Striped locks so that concurrent misses of the same key are written only once
+        self._key_locks = [threading.Lock() for _ in range(32)]
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def key(data: Union[str, bytes]) -> str:
+        """
+        Get the cache key of some content
+        :param data: The content, str is encoded as UTF-8
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def _scan(self):
+        """
+        Rebuild the index from the files left by a previous run, oldest first
+        """
+        found = []
+        for file in self.path.iterdir():
+            if not file.is_file() or file.name.startswith('.'):
+                continue
+            stat = file.stat()
+            mime = mimetypes.guess_type(file.name)[0]
+            found.append((file.name.split('.', 1)[0], _Entry(file, stat.st_size, mime, stat.st_mtime)))
+        for key, entry in sorted(found, key=lambda i: i[1].accessed):
+            self._entries[key] = entry
+            self.size += entry.size
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        while self._entries and (self.size > self.max_bytes or len(self._entries) > self.max_entries or
+                                 now - next(iter(self._entries.values())).accessed > self.ttl):
+            key, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            with contextlib.suppress(OSError):
+                entry.path.unlink()
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key, None)
+        return entry is not None and time.time() - entry.accessed <= self.ttl
+
+    def open(self, key: str) -> Optional[CachedMedia]:
+        """
+        Open a cached file
+        :param key: The cache key
+        :return: A new read handle of the file, or None if it's not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None or time.time() - entry.accessed > self.ttl:
+                self.misses += 1
+                return None
+            try:
+                file = entry.path.open('rb')
+            except OSError:
+                self._entries.pop(key)
+                self.size -= entry.size
+                self.misses += 1
+                return None
+            self._entries[key] = entry._replace(accessed=time.time())
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return CachedMedia(file, entry.mime, key)
+
+    def store(self, write: Callable[[BinaryIO], Optional[str]], key: str = None) -> CachedMedia:
+        """
+        Write a new file into the cache.
+        :param write: Writes the content into the given file and returns its MIME type
+        :param key: The cache key, hash of the written content when not given
+        :return: A read handle of the cached file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.path), prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer = _HashingWriter(f)
+                mime = write(writer)
+            if key is None:
+                key = writer.hash.hexdigest()
+            path = self.path / (key + ((mimetypes.guess_extension(mime) or '') if mime else ''))
+            os.replace(tmp_path, str(path))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+            raise
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+                if old.path != path:
+                    with contextlib.suppress(OSError):
+                        old.path.unlink()
+            entry = _Entry(path, path.stat().st_size, mime, time.time())
+            self._entries[key] = entry
+            self.size += entry.size
+            file = path.open('rb')
+            self._evict()
+        return CachedMedia(file, mime, key)
+
+    def get_or_store(self, key: str, write: Callable[[BinaryIO], Optional[str]]) -> CachedMedia:
+        """
+        Open a cached file, or write it with `write` on a miss
+        """
+        with self._key_locks[int(key[:8], 16) % len(self._key_locks)]:
+            cached = self.open(key)
+            if cached is not None:
+                return cached
+            return self.store(write, key)
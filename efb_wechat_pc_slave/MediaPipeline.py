@@ -0,0 +1,54 @@
+# coding: utf-8
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any
+
+logger = logging.getLogger(__name__)
+
+
+class MediaPipeline:
+    """
+    Bounded worker pool for blocking media work (decoding, sniffing, writing files).
+    At most `max_pending` jobs may be queued or running, submitters wait for a free
+    slot beforehand, which in turn stops the websocket handler from reading more frames.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_workers: int = 4, max_pending: int = 32,
+                 name: str = "wechatPc-media"):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_pending)
+
+    @property
+    def full(self) -> bool:
+        """
+        Whether `submit` would wait for a free slot
+        """
+        return self.pending >= self.max_pending
+
+    async def submit(self, func: Callable, *args: Any) -> asyncio.Future:
+        """
+        Schedule a blocking job once a slot is free
+        :param func: The blocking callable
+        :param args: Arguments of func
+        :return: A future of the result, await it to get the result of func
+        """
+        await self._slots.acquire()
+        try:
+            future = self.loop.run_in_executor(self.executor, func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.pending += 1
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _):
+        self.pending -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,123 @@
+# coding: utf-8
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Any
+
+from ehforwarderbot import MsgType, Chat
+from ehforwarderbot.chat import ChatMember
+from ehforwarderbot.message import Message, Substitutions
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    __slots__ = ('messages', 'length', 'timer')
+
+    def __init__(self):
+        self.messages: List[Message] = []
+        self.length = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MessageCoalescer:
+    """
+    Merge bursts of text messages in a chat into one message to the master.
+
+    Consecutive text messages of a chat are held for up to `window` seconds after the first
+    one, or until `max_messages` or `max_length` characters are reached, and forwarded as one
+    message. When the batch has more than one author, each line is prefixed with its author
+    and the message is sent as `mixed_author` of the chat.
+    Anything else (media, replies, messages mentioning the user) flushes the batch of its chat
+    and is forwarded right away, so the order within a chat is kept.
+    A `window` of 0 forwards every message as is.
+
+    Must be used from the event loop thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, forward: Callable[[str, Message, List[Message]], Any],
+                 window: float = 0, max_messages: int = 20, max_length: int = 4000,
+                 mixed_author: Callable[[Chat], ChatMember] = None):
+        """
+        :param forward: Called with the chat key, the message to send and the messages it replaces
+        """
+        self.loop = loop
+        self.forward = forward
+        self.window = window
+        self.max_messages = max_messages
+        self.max_length = max_length
+        self.mixed_author = mixed_author
+        self.merged = 0
+        self._batches: Dict[str, _Batch] = {}
+
+    def __len__(self):
+        return sum(len(batch.messages) for batch in self._batches.values())
+
+    def can_merge(self, efb_msg: Message) -> bool:
+        if efb_msg.type != MsgType.Text or efb_msg.target is not None or efb_msg.edit:
+            return False
+        return not (efb_msg.substitutions and efb_msg.substitutions.is_mentioned)
+
+    def put(self, key: str, efb_msg: Message):
+        """
+        :param key: The chat key, usually the chat uid
+        """
+        if not self.window or not self.can_merge(efb_msg):
+            self.flush(key)
+            self.forward(key, efb_msg, [efb_msg])
+            return
+        batch = self._batches.get(key, None)
+        if batch is not None and batch.length + len(efb_msg.text) > self.max_length:
+            self.flush(key)
+            batch = None
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timer = self.loop.call_later(self.window, self.flush, key)
+        batch.messages.append(efb_msg)
+        batch.length += len(efb_msg.text) + 1
+        if len(batch.messages) >= self.max_messages:
+            self.flush(key)
+
+    def flush(self, key: str):
+        """
+        Forward the held messages of a chat
+        """
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        if len(batch.messages) == 1:
+            self.forward(key, batch.messages[0], batch.messages)
+            return
+        self.merged += len(batch.messages) - 1
+        self.forward(key, self.merge(batch.messages), batch.messages)
+
+    def flush_all(self):
+        for key in list(self._batches):
+            self.flush(key)
+
+    def merge(self, messages: List[Message]) -> Message:
+        """
+        Join text messages into one, the merged message takes the uid of the last one
+        """
+        last = messages[-1]
+        prefixed = len({m.author.uid for m in messages}) > 1
+        parts = []
+        substitutions = {}
+        offset = 0
+        for m in messages:
+            prefix = f"{m.author.display_name}: " if prefixed else ""
+            if m.substitutions:
+                shift = offset + len(prefix)
+                for (begin, end), entity in m.substitutions.items():
+                    substitutions[(begin + shift, end + shift)] = entity
+            text = prefix + m.text
+            parts.append(text)
+            offset += len(text) + 1
+        merged = Message(type=MsgType.Text, text="\n".join(parts))
+        if substitutions:
+            merged.substitutions = Substitutions(substitutions)
+        merged.chat = last.chat
+        merged.author = self.mixed_author(last.chat) if prefixed and self.mixed_author else last.author
+        merged.uid = last.uid
+        merged.deliver_to = last.deliver_to
+        return merged
@@ -0,0 +1,129 @@
+# coding: utf-8
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+# Keys the hook may carry the WeChat message id in, most specific first
+WECHAT_MSG_ID_KEYS = ('msgSvrId', 'msgId')
+
+
+def wechat_msg_id(msg) -> Optional[str]:
+    """
+    :param msg: A raw message or a send result from the hook
+    :return: The WeChat message id, None if there's none
+    """
+    if not isinstance(msg, dict):
+        return None
+    for key in WECHAT_MSG_ID_KEYS:
+        if msg.get(key, None):
+            return str(msg[key])
+    return None
+
+
+class MessageRef(NamedTuple):
+    efb_uid: str
+    # None while the message is waiting to be sent
+    wechat_id: Optional[str]
+    chat_uid: str
+    created: float
+
+
+class MessageIndex:
+    """
+    Bidirectional index between EFB message ids and WeChat message ids of received and sent messages,
+    so quotes received from WeChat can refer to the message they quote.
+    Holds at most `max_entries` messages, least recently used first out, and forgets messages older than `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._by_efb: 'OrderedDict[str, MessageRef]' = OrderedDict()
+        self._by_wechat: Dict[str, str] = {}
+        # Uid of a merged message -> WeChat ids of the other messages merged into it
+        self._merged: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_efb)
+
+    def add(self, efb_uid: str, wechat_id: Optional[str], chat_uid: str):
+        """
+        Index a message, replacing what was known about either id
+        :param wechat_id: None if not sent yet, see `bind`
+        """
+        with self._lock:
+            self._remove(efb_uid)
+            if wechat_id is not None:
+                self._remove(self._by_wechat.get(wechat_id, None))
+                self._by_wechat[wechat_id] = efb_uid
+            self._by_efb[efb_uid] = MessageRef(efb_uid, wechat_id, chat_uid, time.monotonic())
+            while len(self._by_efb) > self.max_entries:
+                self._remove(next(iter(self._by_efb)))
+
+    def bind(self, efb_uid: str, wechat_id: str):
+        """
+        Attach the WeChat message id to a message indexed before it was sent, e.g. once the hook confirmed it
+        """
+        with self._lock:
+            ref = self._by_efb.get(efb_uid, None)
+            if ref is None:
+                return
+            if ref.wechat_id is not None:
+                self._by_wechat.pop(ref.wechat_id, None)
+            self._remove(self._by_wechat.get(wechat_id, None))
+            self._by_wechat[wechat_id] = efb_uid
+            self._by_efb[efb_uid] = ref._replace(wechat_id=wechat_id)
+
+    def merge(self, efb_uids: Iterable[str], merged_uid: str):
+        """
+        Point the WeChat ids of messages merged into one at the merged message, the merged ones are forgotten
+        :param efb_uids: Uids of the merged messages
+        :param merged_uid: Uid of the message they were merged into, usually one of them
+        """
+        with self._lock:
+            target = self._by_efb.get(merged_uid, None)
+            for efb_uid in efb_uids:
+                ref = self._by_efb.get(efb_uid, None) if efb_uid != merged_uid else None
+                if ref is None:
+                    continue
+                self._remove(efb_uid)
+                if target is None:
+                    target = self._by_efb[merged_uid] = MessageRef(merged_uid, None, ref.chat_uid, ref.created)
+                if ref.wechat_id is not None:
+                    self._by_wechat[ref.wechat_id] = merged_uid
+                    self._merged.setdefault(merged_uid, []).append(ref.wechat_id)
+
+    def by_efb(self, efb_uid: str) -> Optional[MessageRef]:
+        with self._lock:
+            return self._lookup(efb_uid)
+
+    def by_wechat(self, wechat_id: str) -> Optional[MessageRef]:
+        with self._lock:
+            return self._lookup(self._by_wechat.get(wechat_id, None))
+
+    def _lookup(self, efb_uid: Optional[str]) -> Optional[MessageRef]:
+        ref = self._by_efb.get(efb_uid, None) if efb_uid is not None else None
+        if ref is not None and time.monotonic() - ref.created > self.ttl:
+            self._remove(efb_uid)
+            ref = None
+        if ref is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._by_efb.move_to_end(efb_uid)
+        return ref
+
+    def _remove(self, efb_uid: Optional[str]):
+        if efb_uid is None:
+            return
+        ref = self._by_efb.pop(efb_uid, None)
+        wechat_ids = self._merged.pop(efb_uid, [])
+        if ref is not None and ref.wechat_id is not None:
+            wechat_ids.append(ref.wechat_id)
+        for wechat_id in wechat_ids:
+            if self._by_wechat.get(wechat_id, None) == efb_uid:
+                del self._by_wechat[wechat_id]
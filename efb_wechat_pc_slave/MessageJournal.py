@@ -0,0 +1,321 @@
+# coding: utf-8
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple, IO, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.log'
+DEAD_LETTER_FILE = 'dead_letter.jsonl'
+
+# Old segments are compacted only if at most 1 / CARRY_RATIO of their bytes are unacknowledged messages
+CARRY_RATIO = 4
+
+
+class JournalEntry(NamedTuple):
+    uid: str
+    chat_uid: str
+    timestamp: float
+    payload: dict
+
+
+class MessageJournal:
+    """
+    Append-only journal of received hook messages, split into numbered segment files.
+
+    Every message is written before it's processed and acknowledged once the master accepted it.
+    Unacknowledged messages are replayed on the next start. The newest `max_segments`
+    segments are kept for lookups by uid; older segments are deleted, after carrying
+    their few unacknowledged messages over to the current segment. Segments still mostly
+    unacknowledged, e.g. while the master is down, are kept until they're delivered.
+
+    Failed and replayed deliveries are counted per message, see `attempt`. A message that reached
+    `max_attempts` is moved to a dead letter file, so a message that can't be delivered isn't replayed forever.
+
+    With `threaded`, records are encoded and written in order by a thread of their own, which flushes
+    whenever it caught up, so callers on the event loop don't serialize payloads. Messages are then
+    readable once written, the state of acknowledgements and attempts is up to date right away.
+    Without it, every record is written and flushed by the caller.
+
+    Records are JSON lines, {"i": uid, "c": chat, "t": timestamp, "m": payload} for messages,
+    {"a": uid} for acknowledgements and {"r": uid, "n": attempts} for delivery attempts.
+    """
+
+    def __init__(self, path: Path, segment_bytes: int = 8 * 1024 * 1024, max_segments: int = 16,
+                 fsync: bool = False, threaded: bool = False, max_attempts: int = 5):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(max_segments, 2)
+        self.fsync = fsync
+        self.max_attempts = max(max_attempts, 1)
+        self.dead_letters = 0
+        self._lock = threading.RLock()
+        # uid -> (segment number, offset)
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._segment_ids: 'OrderedDict[int, List[str]]' = OrderedDict()
+        # Unacknowledged uid -> its segment, None until written
+        self._unacked: 'OrderedDict[str, Optional[int]]' = OrderedDict()
+        # Unacknowledged uid -> delivery attempts
+        self._attempts: Dict[str, int] = {}
+        # Messages to be moved to the dead letter file once the writer gets to them
+        self._dead: Set[str] = set()
+        self._writer: Optional[IO] = None
+        self._closed = False
+        self._current = 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load()
+        self._jobs: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        if threaded:
+            self._jobs = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="wechatPc-journal", daemon=True)
+            self._thread.start()
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def unacked(self) -> int:
+        return len(self._unacked)
+
+    def _segment_path(self, number: int) -> Path:
+        return self.path / f"{number:08d}{SEGMENT_SUFFIX}"
+
+    def _load(self):
+        numbers = sorted(int(p.stem) for p in self.path.glob('*' + SEGMENT_SUFFIX) if p.stem.isdigit())
+        for number in numbers:
+            ids = self._segment_ids[number] = []
+            offset = 0
+            with self._segment_path(number).open('rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of a segment
+                        logger.warning(f"Skipping broken journal record in segment {number} at {offset}")
+                        offset += len(line)
+                        continue
+                    if 'a' in record:
+                        self._unacked.pop(record['a'], None)
+                        self._attempts.pop(record['a'], None)
+                    elif 'r' in record:
+                        if record['r'] in self._unacked:
+                            self._attempts[record['r']] = record.get('n', 1)
+                    elif 'i' in record:
+                        uid = record['i']
+                        self._index[uid] = (number, offset)
+                        self._unacked[uid] = number
+                        ids.append(uid)
+                    offset += len(line)
+        self._current = numbers[-1] if numbers else 1
+        self._segment_ids.setdefault(self._current, [])
+        self._writer = self._segment_path(self._current).open('ab')
+        if self._unacked:
+            logger.info(f"{len(self._unacked)} unacknowledged messages in journal")
+
+    def _write(self, record: dict, roll: bool = True) -> Tuple[int, int]:
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+        if roll and self._writer.tell() + len(line) > self.segment_bytes and self._writer.tell():
+            self._roll()
+        offset = self._writer.tell()
+        self._writer.write(line)
+        return self._current, offset
+
+    def _flush(self):
+        if self._writer is None:
+            return
+        self._writer.flush()
+        if self.fsync:
+            os.fsync(self._writer.fileno())
+
+    def _submit(self, job: Callable[[], None]):
+        """
+        Run a write in order with the others, called with the lock held
+        """
+        if self._jobs is not None:
+            self._jobs.put(job)
+            return
+        job()
+        self._flush()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            with self._lock:
+                try:
+                    job()
+                except Exception:
+                    logger.exception("Failed to write to journal")
+                if self._jobs.empty():
+                    self._flush()
+
+    def append(self, chat_uid: str, payload: dict, uid: str = None) -> str:
+        """
+        Record a received message
+        :param chat_uid: The chat the message belongs to
+        :param payload: The raw hook message
+        :param uid: The uid of the message, a new one is generated if not given
+        :return: The uid of the message
+        """
+        uid = uid or str(uuid.uuid4())
+        # Copied, the caller may go on changing the message before it's written
+        record = {'i': uid, 'c': chat_uid, 't': time.time(), 'm': dict(payload)}
+
+        def write():
+            position = self._write(record)
+            self._index[uid] = position
+            self._segment_ids[position[0]].append(uid)
+            if uid in self._unacked:
+                self._unacked[uid] = position[0]
+
+        with self._lock:
+            if self._closed:
+                # Closed while the hook is still delivering, the message is processed without being journaled
+                logger.debug(f"Journal is closed, message {uid} is not journaled")
+                return uid
+            self._unacked[uid] = None
+            self._submit(write)
+        return uid
+
+    def ack(self, uid: str):
+        """
+        Mark a message as delivered
+        """
+        with self._lock:
+            if self._closed or uid not in self._unacked:
+                return
+            del self._unacked[uid]
+            self._attempts.pop(uid, None)
+            self._submit(lambda: self._write({'a': uid}))
+
+    def attempt(self, uid: str) -> bool:
+        """
+        Count a failed delivery of a message, or a replay of it. Once counted `max_attempts` times
+        the message is moved to the dead letter file and acknowledged.
+        :return: Whether the message may be delivered (again)
+        """
+        with self._lock:
+            if self._closed or uid not in self._unacked:
+                return False
+            attempts = self._attempts[uid] = self._attempts.get(uid, 0) + 1
+            if attempts < self.max_attempts:
+                self._submit(lambda: self._write({'r': uid, 'n': attempts}))
+                return True
+            self.dead_letters += 1
+            logger.warning(f"Message {uid} failed {attempts} times, moved to {DEAD_LETTER_FILE}")
+            del self._unacked[uid]
+            self._attempts.pop(uid, None)
+            self._dead.add(uid)
+            self._submit(lambda: self._dead_letter(uid))
+            return False
+
+    def _dead_letter(self, uid: str):
+        self._dead.discard(uid)
+        position = self._index.get(uid, None)
+        line = self._read(*position) if position is not None else None
+        if line:
+            with (self.path / DEAD_LETTER_FILE).open('ab') as f:
+                f.write(line)
+        self._write({'a': uid})
+
+    def get(self, uid: str) -> Optional[JournalEntry]:
+        """
+        Look up a message by uid
+        """
+        with self._lock:
+            position = self._index.get(uid, None)
+            if position is None:
+                return None
+            number, offset = position
+            try:
+                record = json.loads(self._read(number, offset))
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Failed to read message {uid} from journal: {e}")
+                return None
+        return JournalEntry(record['i'], record['c'], record['t'], record['m'])
+
+    def pending(self) -> List[JournalEntry]:
+        """
+        :return: Unacknowledged messages in the order they were received
+        """
+        with self._lock:
+            uids = list(self._unacked)
+        return [entry for entry in (self.get(uid) for uid in uids) if entry is not None]
+
+    def _roll(self):
+        self._writer.close()
+        self._current += 1
+        self._segment_ids[self._current] = []
+        self._writer = self._segment_path(self._current).open('ab')
+        self._compact()
+
+    def _compact(self):
+        """
+        Delete the oldest segments beyond max_segments, carrying over their unacknowledged messages
+        """
+        while len(self._segment_ids) > self.max_segments:
+            number, ids = next(iter(self._segment_ids.items()))
+            carried = [(uid, self._read(number, self._index[uid][1]))
+                       for uid in ids if self._unacked.get(uid, None) == number or
+                       uid in self._dead and self._index.get(uid, (None,))[0] == number]
+            carried = [(uid, line) for uid, line in carried if line]
+            try:
+                size = self._segment_path(number).stat().st_size
+            except OSError:
+                size = 0
+            if sum(len(line) for _, line in carried) * CARRY_RATIO > size:
+                break
+            del self._segment_ids[number]
+            for uid, line in carried:
+                entry = json.loads(line)
+                # May grow the current segment past segment_bytes, rolling here would compact again
+                position = self._write({'i': uid, 'c': entry['c'], 't': entry['t'], 'm': entry['m']}, roll=False)
+                self._index[uid] = position
+                if uid in self._unacked:
+                    self._unacked[uid] = position[0]
+                self._segment_ids[position[0]].append(uid)
+                if uid in self._attempts:
+                    self._write({'r': uid, 'n': self._attempts[uid]}, roll=False)
+            for uid in ids:
+                if self._index.get(uid, (None,))[0] == number:
+                    del self._index[uid]
+            try:
+                self._segment_path(number).unlink()
+            except OSError as e:
+                logger.warning(f"Failed to delete journal segment {number}: {e}")
+            logger.debug(f"Compacted journal segment {number}, {len(carried)} unacknowledged messages carried over")
+
+    def _read(self, number: int, offset: int) -> Optional[bytes]:
+        if number == self._current and self._writer is not None:
+            self._writer.flush()
+        try:
+            with self._segment_path(number).open('rb') as f:
+                f.seek(offset)
+                return f.readline()
+        except OSError:
+            return None
+
+    def close(self):
+        """
+        Write what is pending and close the journal, later writes are ignored
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+        with self._lock:
+            self._flush()
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,258 @@
+# coding: utf-8
+import asyncio
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "efb_wechat_pc_"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Histogram:
+    __slots__ = ('count', 'sum', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+# (host, port) -> the endpoint and the metrics of every channel instance served there
+_servers: Dict[Tuple[str, int], Tuple[ThreadingHTTPServer, List['Metrics']]] = {}
+_servers_lock = threading.Lock()
+
+
+def render_all(registries: List['Metrics']) -> str:
+    """
+    Render the metrics of several channel instances, samples of a metric are grouped under one TYPE line
+    """
+    families: Dict[str, Tuple[str, List[str]]] = {}
+    for registry in registries:
+        for metric, kind, samples in registry.families():
+            families.setdefault(metric, (kind, []))[1].extend(samples)
+    lines: List[str] = []
+    for metric, (kind, samples) in families.items():
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of the channel.
+    When disabled every call returns right away, and `timer` / `wrap` hand out no-op objects.
+    """
+
+    def __init__(self, enabled: bool = False, labels: Dict[str, str] = None):
+        self.enabled = enabled
+        self.labels = labels or {}
+        self._counters: Dict[str, float] = {}
+        self._histograms: Dict[str, _Histogram] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name, None)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name: str):
+        """
+        Context manager observing the time spent in its body
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        """
+        Time every call of a function or coroutine function, returns func itself when disabled
+        """
+        if not self.enabled:
+            return func
+        if asyncio.iscoroutinefunction(func) or isinstance(func, functools.partial) and \
+                asyncio.iscoroutinefunction(func.func):
+            @functools.wraps(func)
+            async def timed_async(*args, **kwargs):
+                with _Timer(self, name):
+                    return await func(*args, **kwargs)
+
+            return timed_async
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with _Timer(self, name):
+                return func(*args, **kwargs)
+
+        return timed
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        """
+        Register a value that is read when metrics are collected
+        """
+        if self.enabled:
+            self._gauges[name] = func
+
+    def collect(self) -> Tuple[Dict[str, float], Dict[str, _Histogram], Dict[str, float]]:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        gauges = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                gauges[name] = func()
+            except Exception as e:
+                logger.debug(f"Failed to read gauge {name}: {e}")
+        return counters, histograms, gauges
+
+    def _label_str(self, extra: Dict[str, str] = None) -> str:
+        labels = dict(self.labels, **(extra or {}))
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+    def families(self) -> List[Tuple[str, str, List[str]]]:
+        """
+        :return: (metric name, type, sample lines) of every metric
+        """
+        counters, histograms, gauges = self.collect()
+        labels = self._label_str()
+        families = []
+        for name, value in sorted(counters.items()):
+            families.append((f"{PREFIX}{name}_total", "counter", [f"{PREFIX}{name}_total{labels} {value}"]))
+        for name, value in sorted(gauges.items()):
+            families.append((f"{PREFIX}{name}", "gauge", [f"{PREFIX}{name}{labels} {value}"]))
+        for name, histogram in sorted(histograms.items()):
+            metric = f"{PREFIX}{name}_seconds"
+            samples = []
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.buckets):
+                cumulative += count
+                samples.append(f"{metric}_bucket{self._label_str({'le': str(bound)})} {cumulative}")
+            samples.append(f"{metric}_bucket{self._label_str({'le': '+Inf'})} {histogram.count}")
+            samples.append(f"{metric}_sum{labels} {histogram.sum}")
+            samples.append(f"{metric}_count{labels} {histogram.count}")
+            families.append((metric, "histogram", samples))
+        return families
+
+    def summary(self) -> str:
+        """
+        :return: A one-line-per-metric human readable summary
+        """
+        counters, histograms, gauges = self.collect()
+        lines = [f"{name}={value:g}" for name, value in sorted(counters.items())]
+        lines += [f"{name}={value:g}" for name, value in sorted(gauges.items())]
+        lines += [f"{name}: n={h.count} avg={h.sum / h.count * 1000:.1f}ms "
+                  f"p50<={h.quantile(0.5) * 1000:g}ms p99<={h.quantile(0.99) * 1000:g}ms max={h.max * 1000:.1f}ms"
+                  for name, h in sorted(histograms.items()) if h.count]
+        return '\n'.join(lines)
+
+    def serve(self, host: str = '127.0.0.1', port: int = 9464) -> Optional[ThreadingHTTPServer]:
+        """
+        Expose the metrics at http://host:port/metrics in a daemon thread.
+        Channel instances serving at the same address share one endpoint, told apart by their labels.
+        """
+        with _servers_lock:
+            if (host, port) in _servers:
+                server, registries = _servers[(host, port)]
+                registries.append(self)
+                return server
+            registries = [self]
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = render_all(list(registries)).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            try:
+                server = ThreadingHTTPServer((host, port), Handler)
+            except OSError as e:
+                logger.warning(f"Failed to start metrics endpoint on {host}:{port}: {e}")
+                return None
+            _servers[(host, port)] = (server, registries)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="wechatPc-metrics", daemon=True).start()
+        logger.info(f"Metrics are served at http://{host}:{port}/metrics")
+        return server
+
+    async def log_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("Metrics summary%s:\n%s", self._label_str(), self.summary())
@@ -1,9 +1,8 @@
 from typing import Mapping, Tuple, Union, IO
-import magic
 
 from ehforwarderbot import MsgType, Chat
 from ehforwarderbot.chat import ChatMember
-from ehforwarderbot.message import Substitutions, Message
+from ehforwarderbot.message import Substitutions, Message, LinkAttribute
 
 
 def efb_text_simple_wrapper(text: str, ats: Union[Mapping[Tuple[int, int], Union[Chat, ChatMember]], None] = None) -> Message:
@@ -23,17 +22,20 @@ def efb_text_simple_wrapper(text: str, ats: Union[Mapping[Tuple[int, int], Union
     return efb_msg
 
 
-def efb_image_wrapper(file: IO, filename: str = None, text: str = None) -> Message:
+def efb_image_wrapper(file: IO, filename: str = None, text: str = None, mime: str = None) -> Message:
     """
     A EFB message wrapper for images.
     :param file: The file handle
     :param filename: The actual filename
     :param text: The attached text
+    :param mime: The MIME type if already known, otherwise it's sniffed from the file
     :return: EFB Message
     """
     efb_msg = Message()
     efb_msg.file = file
-    mime = magic.from_file(file.name, mime=True)
+    if not mime:
+        import magic
+        mime = magic.from_file(file.name, mime=True)
     if isinstance(mime, bytes):
         mime = mime.decode()
 
@@ -53,4 +55,56 @@ def efb_image_wrapper(file: IO, filename: str = None, text: str = None) -> Messa
 
     efb_msg.path = efb_msg.file.name
     efb_msg.mime = mime
-    return efb_msg
\ No newline at end of file
+    return efb_msg
+
+
+def efb_voice_wrapper(file: IO, filename: str = None, text: str = None, mime: str = None) -> Message:
+    """
+    A EFB message wrapper for voice messages.
+    :param file: The file handle
+    :param filename: The actual filename
+    :param text: The attached text
+    :param mime: The MIME type of the audio, OGG/Opus is expected by most masters
+    :return: EFB Message
+    """
+    efb_msg = efb_file_wrapper(file, filename=filename, text=text, mime=mime)
+    efb_msg.type = MsgType.Voice
+    return efb_msg
+
+
+def efb_file_wrapper(file: IO, filename: str = None, text: str = None, mime: str = None) -> Message:
+    """
+    A EFB message wrapper for files.
+    :param file: The file handle
+    :param filename: The actual filename
+    :param text: The attached text
+    :param mime: The MIME type if known
+    :return: EFB Message
+    """
+    efb_msg = Message()
+    efb_msg.type = MsgType.File
+    efb_msg.file = file
+    efb_msg.filename = filename or file.name
+    if text:
+        efb_msg.text = text
+    efb_msg.path = efb_msg.file.name
+    efb_msg.mime = mime or 'application/octet-stream'
+    return efb_msg
+
+
+def efb_link_wrapper(title: str, url: str, description: str = None, image: str = None, text: str = None) -> Message:
+    """
+    A EFB message wrapper for shared links.
+    :param title: The title of the linked page
+    :param url: The link
+    :param description: A summary of the page
+    :param image: URL of the thumbnail
+    :param text: The attached text
+    :return: EFB Message
+    """
+    efb_msg = Message(
+        type=MsgType.Link,
+        text=text or "",
+        attributes=LinkAttribute(title=title, description=description, image=image, url=url)
+    )
+    return efb_msg
@@ -0,0 +1,102 @@
+# coding: utf-8
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class OutboundQueueFull(Exception):
+    pass
+
+
+class OutboundDispatcher:
+    """
+    Send jobs to the hook without blocking the caller.
+    Jobs of the same chat run one after another in submission order, different chats run concurrently.
+    All jobs share a token bucket of `rate` sends per second with bursts of up to `burst`, 0 disables the limit.
+    While paused, e.g. when the hook is disconnected, jobs are queued and run once resumed.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, rate: float = 2, burst: int = 5):
+        self.loop = loop
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # Jobs submitted and not finished yet, counted when submitted
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._last_refill = None
+        self._queues: Dict[str, Deque[Tuple[Job, concurrent.futures.Future]]] = {}
+        self._running = asyncio.Event()
+        self._running.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def pause(self):
+        """
+        Hold queued jobs, must be called from the event loop (or before it runs)
+        """
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def submit(self, key: str, job: Job, max_pending: Optional[int] = None) -> concurrent.futures.Future:
+        """
+        Queue a send job, safe to call from any thread
+        :param key: The ordering key, usually the chat uid
+        :param job: Returns the awaitable doing the actual send, it's called on the event loop when it's the job's turn
+        :param max_pending: Jobs that may be pending at most, including this one
+        :return: A future of the result of the job
+        :raise OutboundQueueFull: If `max_pending` jobs are pending already
+        """
+        with self._pending_lock:
+            if max_pending is not None and self.pending >= max_pending:
+                raise OutboundQueueFull(f"{self.pending} jobs are pending")
+            self.pending += 1
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._enqueue, key, job, future)
+        return future
+
+    def _enqueue(self, key: str, job: Job, future: concurrent.futures.Future):
+        queue = self._queues.get(key, None)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self.loop.create_task(self._drain(key, queue))
+        queue.append((job, future))
+
+    async def _drain(self, key: str, queue: Deque[Tuple[Job, concurrent.futures.Future]]):
+        while queue:
+            job, future = queue[0]
+            try:
+                await self._running.wait()
+                await self._throttle()
+                future.set_result(await job())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                queue.popleft()
+                with self._pending_lock:
+                    self.pending -= 1
+        del self._queues[key]
+
+    async def _throttle(self):
+        if not self.rate:
+            return
+        while True:
+            now = self.loop.time()
+            if self._last_refill is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
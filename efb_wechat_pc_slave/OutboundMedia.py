@@ -0,0 +1,161 @@
+# coding: utf-8
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Optional
+
+from .MediaCache import MediaCache, CachedMedia
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+KIND_IMAGE = 'image'
+KIND_VOICE = 'voice'
+KIND_FILE = 'file'
+
+
+class PreparedMedia(NamedTuple):
+    path: Path
+    mime: Optional[str]
+    key: str
+
+
+class _Unchanged(Exception):
+    """
+    Raised by a conversion when the source can be sent as it is
+    """
+
+
+def own_handle(file: BinaryIO, path: Optional[Path] = None) -> BinaryIO:
+    """
+    Open a handle of a file sent by the master that stays usable after the master closes its own,
+    the file is read in background after send_message returned.
+    """
+    if path is not None:
+        try:
+            return open(str(path), 'rb')
+        except OSError:
+            pass
+    try:
+        return os.fdopen(os.dup(file.fileno()), 'rb')
+    except (AttributeError, OSError, ValueError):
+        # In-memory files have no descriptor
+        return file
+
+
+class OutboundMedia:
+    """
+    Prepare media sent from the master for the hook, blocking, meant to run in the media pipeline.
+
+    The file is streamed into the media cache in chunks and addressed by the hash of its content.
+    Images larger than `max_image_bytes` or `max_image_side` pixels are scaled down and re-encoded as JPEG
+    (needs Pillow), voice larger than `max_voice_bytes` is re-encoded at a low bitrate (needs ffmpeg).
+    Converted files are cached under a key derived from the source hash, so identical uploads are
+    copied and converted only once.
+    """
+
+    def __init__(self, cache: MediaCache, max_image_bytes: int = 5 * 1024 * 1024, max_image_side: int = 4096,
+                 max_voice_bytes: int = 2 * 1024 * 1024, transcode_timeout: float = 60):
+        self.cache = cache
+        self.max_image_bytes = max_image_bytes
+        self.max_image_side = max_image_side
+        self.max_voice_bytes = max_voice_bytes
+        self.transcode_timeout = transcode_timeout
+        self.deduplicated = 0
+        self._missing_tools = set()
+
+    def prepare(self, file: BinaryIO, kind: str = KIND_FILE, mime: Optional[str] = None) -> PreparedMedia:
+        """
+        :param file: Read from its start and closed afterwards
+        :param kind: One of KIND_*, decides how an oversized file is converted
+        :param mime: MIME type given by the master
+        """
+        try:
+            source = self._store(file, mime)
+        finally:
+            file.close()
+        size = source.path.stat().st_size
+        if kind == KIND_IMAGE and (size > self.max_image_bytes or self.max_image_side):
+            return self._convert(source, KIND_IMAGE, self._shrink_image)
+        if kind == KIND_VOICE and size > self.max_voice_bytes:
+            return self._convert(source, KIND_VOICE, self._encode_voice)
+        return source
+
+    def _store(self, file: BinaryIO, mime: Optional[str]) -> PreparedMedia:
+        def write(out: BinaryIO) -> Optional[str]:
+            shutil.copyfileobj(file, out, CHUNK_SIZE)
+            return mime
+
+        if file.seekable():
+            # Hash first, a file sent before is not copied again
+            file.seek(0)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+            key = digest.hexdigest()
+            file.seek(0)
+            if key in self.cache:
+                self.deduplicated += 1
+            return self._prepared(self.cache.get_or_store(key, write))
+        return self._prepared(self.cache.store(write))
+
+    def _convert(self, source: PreparedMedia, kind: str, convert) -> PreparedMedia:
+        # Derived from the source and the limits, a converted file is reused only if converted the same way
+        key = MediaCache.key(f"{source.key}:{kind}:{self.max_image_side}:{self.max_image_bytes}:"
+                             f"{self.max_voice_bytes}")
+        if key in self.cache:
+            self.deduplicated += 1
+        try:
+            return self._prepared(self.cache.get_or_store(key, lambda out: convert(source, out)))
+        except _Unchanged:
+            return source
+        except Exception as e:
+            logger.warning(f"Failed to convert {kind} {source.key}, sending the original: {e!r}")
+            return source
+
+    @staticmethod
+    def _prepared(cached: CachedMedia) -> PreparedMedia:
+        cached.file.close()
+        return PreparedMedia(Path(cached.file.name), cached.mime, cached.key)
+
+    def _shrink_image(self, source: PreparedMedia, out: BinaryIO) -> str:
+        try:
+            from PIL import Image  # Optional, oversized images are sent as they are without it
+        except ImportError:
+            self._missing('Pillow')
+            raise _Unchanged()
+        with Image.open(str(source.path)) as image:
+            side = self.max_image_side or max(image.size)
+            if getattr(image, 'is_animated', False) or \
+                    max(image.size) <= side and source.path.stat().st_size <= self.max_image_bytes:
+                raise _Unchanged()
+            image.thumbnail((side, side))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(out, 'JPEG', quality=85, optimize=True)
+        return 'image/jpeg'
+
+    def _encode_voice(self, source: PreparedMedia, out: BinaryIO) -> str:
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            self._missing('ffmpeg')
+            raise _Unchanged()
+        with tempfile.TemporaryDirectory(prefix='wechatPc-outbound-') as tmp:
+            # Written to a file, so ffmpeg is killed once the timeout passes however far it got
+            output = os.path.join(tmp, 'voice.mp3')
+            subprocess.run([ffmpeg, '-v', 'error', '-y', '-i', str(source.path), '-ac', '1', '-b:a', '32k',
+                            '-f', 'mp3', output], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, check=True, timeout=self.transcode_timeout)
+            with open(output, 'rb') as f:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+        return 'audio/mpeg'
+
+    def _missing(self, tool: str):
+        if tool not in self._missing_tools:
+            self._missing_tools.add(tool)
+            logger.info(f"{tool} is not available, oversized media is sent without conversion")
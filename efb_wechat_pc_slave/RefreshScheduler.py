@@ -0,0 +1,184 @@
+# coding: utf-8
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from .ContactStore import ContactDiff
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """
+    Decide when the friend list is reloaded, instead of reloading it at a fixed interval.
+
+    After a reload that changed nothing the interval doubles, from `min_interval` up to `max_interval`,
+    a reload with changes brings it back to `min_interval`. A due reload waits for `quiet_period` seconds
+    without messages, but at most `max_defer` seconds.
+    Signs that the list is stale, i.e. contacts the hook could not look up and room members missing from
+    their room, bring the reload forward to `min_interval` after the last one once `signal_threshold` of them
+    were seen. A room with members missing is looked up on its own first, at most once per `min_interval`.
+    `request` reloads right away, e.g. after login.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, refresh: Callable[[], Awaitable[ContactDiff]],
+                 lookup: Optional[Callable[[str], Awaitable[bool]]] = None, ready: Callable[[], bool] = None,
+                 min_interval: float = 300, max_interval: float = 6 * 3600, quiet_period: float = 30,
+                 max_defer: float = 900, signal_threshold: int = 5, max_rooms: int = 1000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param refresh: Reloads the whole friend list
+        :param lookup: Looks up a single contact again, whether it's known afterwards
+        :param ready: Whether the list can be reloaded now, e.g. WeChat is logged in
+        :param clock: Current time in seconds, the intervals are measured with it
+        """
+        self.loop = loop
+        self.refresh = refresh
+        self.lookup = lookup
+        self.ready = ready or (lambda: True)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.quiet_period = quiet_period
+        self.max_defer = max_defer
+        self.signal_threshold = signal_threshold
+        self.max_rooms = max_rooms
+        self.clock = clock
+        self.interval = min_interval
+        self.refreshes = 0
+        self.unchanged = 0
+        self.signals = 0
+        self.targeted = 0
+        self._stale_signals = 0
+        self._requested = False
+        self._last_refresh = self.clock()
+        self._last_activity = 0.0
+        # Rooms looked up on their own -> when they may be looked up again
+        self._rooms: 'OrderedDict[str, float]' = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def due(self) -> float:
+        """
+        When the next reload is due, in `clock` time
+        """
+        if self._stale_signals >= self.signal_threshold:
+            return self._last_refresh + min(self.interval, self.min_interval)
+        return self._last_refresh + self.interval
+
+    def start(self):
+        """
+        Start scheduling reloads, must be called from the event loop
+        """
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def note_activity(self):
+        """
+        Called for every received message, reloads wait for a pause
+        """
+        self._last_activity = self.clock()
+
+    def request(self):
+        """
+        Reload as soon as possible
+        """
+        self._requested = True
+        self._wakeup.set()
+
+    def signal(self):
+        """
+        Count a sign that the friend list is stale
+        """
+        self.signals += 1
+        self._stale_signals += 1
+        if self._stale_signals == self.signal_threshold:
+            self._wakeup.set()
+
+    def on_unknown_member(self, room_id: str):
+        """
+        A message came from someone not in the member list of its room
+        """
+        now = self.clock()
+        if self.lookup is None or self._rooms.get(room_id, 0) > now:
+            self.signal()
+            return
+        self._rooms[room_id] = now + self.min_interval
+        self._rooms.move_to_end(room_id)
+        while len(self._rooms) > self.max_rooms:
+            self._rooms.popitem(last=False)
+        self.targeted += 1
+        self.loop.create_task(self._look_up_room(room_id))
+
+    def on_refreshed(self, diff: ContactDiff):
+        """
+        Called for every completed reload, whoever started it
+        """
+        self.refreshes += 1
+        self._last_refresh = self.clock()
+        self._requested = False
+        self._stale_signals = 0
+        if diff:
+            self.interval = self.min_interval
+        else:
+            self.unchanged += 1
+            self.interval = min(self.interval * 2, self.max_interval)
+        logger.debug(f"Next friend list reload in {self.interval:.0f} s")
+        self._wakeup.set()
+
+    async def _look_up_room(self, room_id: str):
+        try:
+            if not await self.lookup(room_id):
+                self.signal()
+        except Exception as e:
+            logger.debug(f"Looking up room {room_id} failed: {e!r}")
+            self.signal()
+
+    def _delay(self) -> Optional[float]:
+        """
+        :return: Seconds until the next reload, 0 to reload now, None to wait for a change
+        """
+        if not self.ready():
+            return None
+        if self._requested:
+            return 0
+        now = self.clock()
+        due = self.due
+        if now < due:
+            return due - now
+        # Due, wait for a pause in the messages
+        start = max(self._last_activity + self.quiet_period, now)
+        return max(min(start, due + self.max_defer) - now, 0)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._delay()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.debug("Reloading friend list")
+            self._requested = False
+            refreshes = self.refreshes
+            try:
+                diff = await self.refresh()
+                if self.refreshes == refreshes:
+                    # Not reported by the owner of the list
+                    self.on_refreshed(diff)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to reload friend list: {e!r}")
+                # Tried again after the shortest interval
+                self._last_refresh = self.clock()
+                self.interval = self.min_interval
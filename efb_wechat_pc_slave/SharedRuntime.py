@@ -0,0 +1,48 @@
+# coding: utf-8
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_session: Optional[requests.Session] = None
+
+
+def shared_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop shared by all channel instances of the process, running in a daemon thread.
+    It's also set as the event loop of the calling thread, so asyncio primitives created there
+    are bound to it on Python < 3.10.
+    """
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+
+            def run():
+                asyncio.set_event_loop(_loop)
+                _loop.run_forever()
+
+            threading.Thread(target=run, name="wechatPc-loop", daemon=True).start()
+    asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def shared_session(pool_size: int = 8, retry: int = 3) -> requests.Session:
+    """
+    The HTTP session shared by all channel instances, the pool options apply when it's created
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
@@ -0,0 +1,150 @@
+# coding: utf-8
+import concurrent.futures
+import concurrent.futures.process
+import importlib.util
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Optional
+
+from .MediaCache import MediaCache, CachedMedia
+
+logger = logging.getLogger(__name__)
+
+VOICE_MIME = 'audio/ogg'
+CODEC_SILK = 'silk'
+CODEC_AMR = 'amr'
+# Sample rate SILK voice is decoded at
+SILK_RATE = 24000
+CHUNK_SIZE = 64 * 1024
+# Seconds a job may take beyond its timeout before its worker process is given up,
+# e.g. for starting the process
+GRACE_PERIOD = 5
+# pilk has no timeout of its own, it's run in a subprocess that can be killed
+PILK_DECODE = "import sys, pilk; pilk.decode(sys.argv[1], sys.argv[2], pcm_rate=int(sys.argv[3]))"
+
+
+def sniff_codec(head: bytes) -> Optional[str]:
+    """
+    Tell the codec of a WeChat voice file from its first bytes
+    :return: CODEC_SILK, CODEC_AMR or None if unknown
+    """
+    if head.startswith(b'#!AMR'):
+        return CODEC_AMR
+    # WeChat prefixes its SILK files with 0x02
+    if head.lstrip(b'\x02').startswith(b'#!SILK'):
+        return CODEC_SILK
+    return None
+
+
+def transcode(source: str, output: str, codec: str, timeout: float):
+    """
+    Convert a voice file to OGG/Opus, runs in a worker process
+    :param source: Path of the SILK or AMR file
+    :param output: Path the OGG file is written to
+    :param timeout: Seconds for the whole conversion, decoding and encoding are killed once exceeded
+    """
+    deadline = time.monotonic() + timeout
+
+    def run(args):
+        subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       check=True, timeout=max(deadline - time.monotonic(), 0))
+
+    args = [shutil.which('ffmpeg') or 'ffmpeg', '-v', 'error', '-y']
+    with tempfile.TemporaryDirectory(prefix='wechatPc-voice-') as tmp:
+        if codec == CODEC_SILK:
+            # Optional, SILK voice is passed on as a file without pilk
+            pcm = os.path.join(tmp, 'voice.pcm')
+            run([sys.executable, '-c', PILK_DECODE, source, pcm, str(SILK_RATE)])
+            args += ['-f', 's16le', '-ar', str(SILK_RATE), '-ac', '1', '-i', pcm]
+        else:
+            args += ['-i', source]
+        args += ['-c:a', 'libopus', '-b:a', '24k', '-f', 'ogg', output]
+        run(args)
+
+
+class VoiceTranscoder:
+    """
+    Convert WeChat SILK / AMR voice to OGG/Opus in a pool of `max_workers` processes, results are cached
+    by the hash of the source. Each job is given up after `timeout` seconds, the decoder and encoder it runs
+    are killed then. A worker still busy shortly after is left behind and the pool is replaced.
+    AMR needs ffmpeg, SILK needs ffmpeg and pilk. Without them `can_convert` is False for the codec.
+    """
+
+    def __init__(self, cache: MediaCache, max_workers: int = 2, timeout: float = 30):
+        self.cache = cache
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.converted = 0
+        self.failed = 0
+        self._has_ffmpeg = shutil.which('ffmpeg') is not None
+        self._has_pilk = importlib.util.find_spec('pilk') is not None
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        if not self._has_ffmpeg:
+            logger.info("ffmpeg is not available, voice messages are passed on without conversion")
+
+    def can_convert(self, codec: Optional[str]) -> bool:
+        if codec == CODEC_AMR:
+            return self._has_ffmpeg
+        if codec == CODEC_SILK:
+            return self._has_ffmpeg and self._has_pilk
+        return False
+
+    def _pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Not forked, the channel process runs several threads
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def convert(self, source: CachedMedia, codec: str) -> CachedMedia:
+        """
+        Convert a cached voice file, blocking
+        :param source: The voice file in the media cache
+        :param codec: Codec of the source, see `sniff_codec`
+        :return: The OGG file in the media cache
+        """
+
+        def write(out: BinaryIO) -> str:
+            with tempfile.TemporaryDirectory(prefix='wechatPc-voice-') as tmp:
+                output = os.path.join(tmp, 'voice.ogg')
+                pool = self._pool()
+                job = pool.submit(transcode, source.file.name, output, codec, self.timeout)
+                try:
+                    job.result(self.timeout + GRACE_PERIOD)
+                except BaseException as e:
+                    self.failed += 1
+                    cancelled = job.cancel()
+                    # A job still running after its timeout holds up its worker
+                    if isinstance(e, concurrent.futures.process.BrokenProcessPool) or \
+                            isinstance(e, concurrent.futures.TimeoutError) and not cancelled:
+                        self._reset(pool)
+                    raise
+                with open(output, 'rb') as f:
+                    shutil.copyfileobj(f, out, CHUNK_SIZE)
+            self.converted += 1
+            return VOICE_MIME
+
+        return self.cache.get_or_store(MediaCache.key(f"{source.key}:ogg"), write)
+
+    def _reset(self, pool: concurrent.futures.ProcessPoolExecutor):
+        """
+        Replace a pool whose worker died or hangs, the next job starts a new one
+        """
+        with self._lock:
+            if self._executor is pool:
+                self._executor = None
+        pool.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
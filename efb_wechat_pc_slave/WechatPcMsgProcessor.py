@@ -1,24 +1,114 @@
-import base64
-import tempfile
-from urllib.request import urlopen
+import logging
+from pathlib import Path
+from typing import IO, Optional
 
-from efb_wechat_pc_slave.MsgDecorator import efb_text_simple_wrapper, efb_image_wrapper
+from efb_wechat_pc_slave.AppMsgParser import AppMsgParser, parse_app_msg, APP_MSG_FILE, APP_MSG_QUOTE, \
+    APP_MSG_RECORD, APP_MSG_MINI_PROGRAM, APP_MSG_MINI_PROGRAM_SHARE
+from efb_wechat_pc_slave.MediaCache import MediaCache
+from efb_wechat_pc_slave.MsgDecorator import efb_text_simple_wrapper, efb_image_wrapper, efb_voice_wrapper, \
+    efb_file_wrapper, efb_link_wrapper
+from efb_wechat_pc_slave.VoiceTranscoder import VoiceTranscoder, sniff_codec
+from efb_wechat_pc_slave.utils import decode_data_url
+
+logger = logging.getLogger(__name__)
+
+# Key in `vendor_specific` of a received reply: (WeChat id, sender wxid, sender name, text) of the message it quotes
+QUOTE_KEY = 'wechat_quote'
 
 
 class MsgProcessor:
-    @staticmethod
-    def text_msg(msg: dict):
+    def __init__(self, media_cache: MediaCache, voice: VoiceTranscoder = None, app_msgs: AppMsgParser = None):
+        self.media_cache = media_cache
+        self.voice = voice
+        self.app_msgs = app_msgs if app_msgs is not None else AppMsgParser()
+
+    def text_msg(self, msg: dict):
         return efb_text_simple_wrapper(msg['content'])
 
-    @staticmethod
-    def image_msg(msg: dict):
+    def image_msg(self, msg: dict):
+        """
+        Decode the image carried in the message. This is blocking, run it in the media pipeline.
+        Identical images (e.g. stickers forwarded to many groups) are decoded once and served from the media cache.
+        """
         if 'imageFile' in msg and 'base64Content' in msg['imageFile']:
+            data_url = msg['imageFile']['base64Content']
+
+            def write(file: IO) -> Optional[str]:
+                import magic  # Loads libmagic, deferred to the first image
+                declared_mime, head = decode_data_url(data_url, file)
+                return magic.from_buffer(head, mime=True) or declared_mime
+
             try:
-                file = tempfile.NamedTemporaryFile()
-                with urlopen(msg['imageFile']['base64Content']) as response:
-                    data = response.read()
-                    file.write(data)
-                return efb_image_wrapper(file)
+                cached = self.media_cache.get_or_store(MediaCache.key(data_url), write)
+                return efb_image_wrapper(cached.file, filename=Path(cached.file.name).name, mime=cached.mime)
             except Exception as e:
-                print(e)
+                logger.warning(f"Failed to decode image: {e}")
         return efb_text_simple_wrapper("Image received. Please check it on your phone.")
+
+    def voice_msg(self, msg: dict, convert: bool = True):
+        """
+        Decode the voice carried in the message and convert it to OGG/Opus.
+        This is blocking, run it in the voice pipeline.
+        When it can't be converted, the original SILK / AMR file is passed on as a file.
+        :param convert: False to pass on the original file right away, e.g. when too many voice messages are waiting
+        """
+        if 'voiceFile' in msg and 'base64Content' in msg['voiceFile']:
+            data_url = msg['voiceFile']['base64Content']
+            head = b''
+
+            def write(file: IO) -> Optional[str]:
+                nonlocal head
+                declared_mime, head = decode_data_url(data_url, file)
+                return declared_mime
+
+            try:
+                source = self.media_cache.get_or_store(MediaCache.key(data_url), write)
+            except Exception as e:
+                logger.warning(f"Failed to decode voice: {e}")
+                return efb_text_simple_wrapper("Voice received. Please check it on your phone.")
+            if not head:
+                head = source.file.read(16)
+                source.file.seek(0)
+            codec = sniff_codec(head)
+            if convert and self.voice is not None and self.voice.can_convert(codec):
+                try:
+                    converted = self.voice.convert(source, codec)
+                    source.file.close()
+                    return efb_voice_wrapper(converted.file, filename=Path(converted.file.name).name,
+                                             mime=converted.mime)
+                except Exception as e:
+                    logger.warning(f"Failed to convert voice: {e!r}")
+            return efb_file_wrapper(source.file, filename=f"{source.key[:16]}.{codec or 'voice'}",
+                                    text="Voice message", mime=source.mime)
+        return efb_text_simple_wrapper("Voice received. Please check it on your phone.")
+
+    def app_msg(self, msg: dict):
+        """
+        Convert an app message (link, mini program, file, chat record, quote) from its XML content.
+        Parses of identical payloads are memoized, see `AppMsgParser`.
+        """
+        app = self.app_msgs.parse(msg['content'])
+        if app is None:
+            return efb_text_simple_wrapper(msg['content'])
+        if app.type == APP_MSG_QUOTE:
+            efb_msg = efb_text_simple_wrapper(app.title)
+            quoted = app.quote_text
+            if quoted.lstrip().startswith('<'):
+                # Quoting an app message, its title stands for it
+                quoted_app = parse_app_msg(quoted, self.app_msgs.max_length)
+                quoted = quoted_app.title if quoted_app is not None else ''
+            efb_msg.vendor_specific = {QUOTE_KEY: (app.quote_id, app.quote_sender, app.quote_name, quoted)}
+            return efb_msg
+        if app.type == APP_MSG_FILE:
+            size = f" ({app.file_size / 1024 / 1024:.2f} MiB)" if app.file_size else ""
+            return efb_text_simple_wrapper(f"File received: {app.title}{size}. Please check it on your phone.")
+        if app.type == APP_MSG_RECORD:
+            # The records themselves are not parsed, the description previews the first of them
+            return efb_text_simple_wrapper(f"{app.title}\n{app.description}\n\n"
+                                           "Chat record received. Please check it on your phone.")
+        if app.url:
+            return efb_link_wrapper(app.title, app.url, description=app.description or None,
+                                    image=app.thumb_url or None, text=app.source or None)
+        if app.type in (APP_MSG_MINI_PROGRAM, APP_MSG_MINI_PROGRAM_SHARE):
+            return efb_text_simple_wrapper(f"Mini program received: {app.title}\n{app.source}".rstrip())
+        return efb_text_simple_wrapper(app.title or msg['content'])
@@ -1,16 +1,14 @@
 import asyncio
+import concurrent.futures
 import logging
-import queue
-import threading
+import time
 import uuid
-from traceback import print_exc
 
-import yaml
 import hashlib
-from ehforwarderbot.chat import PrivateChat
-from pyqrcode import QRCode
-from typing import Optional, Collection, BinaryIO, Dict, Any
+from ehforwarderbot.chat import PrivateChat, ChatMember, SelfChatMember, SystemChatMember
+from typing import Optional, Collection, BinaryIO, Dict, Any, List, Union, Awaitable
 from datetime import datetime
+from functools import partial
 
 from ehforwarderbot import MsgType, Chat, Message, Status, coordinator
 from wechatPc import WechatPc, WechatPcClient
@@ -20,21 +18,80 @@ from . import __version__ as version
 from ehforwarderbot.channel import SlaveChannel
 from ehforwarderbot.types import MessageID, ChatID, InstanceID
 from ehforwarderbot import utils as efb_utils
-from ehforwarderbot.exceptions import EFBException
+from ehforwarderbot.exceptions import EFBException, EFBMessageError, EFBOperationNotSupported, \
+    EFBMessageTypeNotSupported
+from ehforwarderbot.message import Substitutions
+from ehforwarderbot.status import ChatUpdates, MessageRemoval
 from wechatPc.models.websocket import *
-from cachetools import TTLCache
 
+from .AppMsgParser import AppMsgParser
+from .AvatarService import AvatarService
 from .ChatMgr import ChatMgr
-from .CustomTypes import EFBGroupChat, EFBPrivateChat, EFBGroupMember
+from .ChatSequencer import ChatSequencer
+from .ContactCache import ContactCache
+from .ContactResolver import ContactResolver
+from .ConnectionManager import ConnectionManager, STATE_LOGGED_IN
+from .ContactStore import ContactStore, ContactDiff, is_room
+from .FriendListPager import FriendListPager
+from .CustomTypes import EFBPrivateChat
+from .DedupFilter import DedupFilter
+from .IdentityCache import IdentityCache
+from .IngestQueue import IngestQueue, OVERFLOW_BLOCK, OVERFLOW_DROP
+from .MediaCache import MediaCache
+from .MediaPipeline import MediaPipeline
+from .MessageCoalescer import MessageCoalescer
+from .MessageIndex import MessageIndex, wechat_msg_id
+from .MessageJournal import MessageJournal, JournalEntry
+from .Metrics import Metrics
 from .MsgDecorator import efb_text_simple_wrapper
-from .WechatPcMsgProcessor import MsgProcessor
-from .utils import process_quote_text, download_file
+from .RefreshScheduler import RefreshScheduler
+from .OutboundDispatcher import OutboundDispatcher, OutboundQueueFull
+from .OutboundMedia import OutboundMedia, PreparedMedia, own_handle, KIND_FILE, KIND_IMAGE, KIND_VOICE
+from .SharedRuntime import shared_loop, shared_session
+from .WechatPcMsgProcessor import MsgProcessor, QUOTE_KEY
+from .utils import process_quote_text, find_mention
+from .VoiceTranscoder import VoiceTranscoder
 
 TYPE_HANDLERS = {
     1: MsgProcessor.text_msg,
+    49: MsgProcessor.app_msg,
+}
+
+# Messages with a longer content are converted in the media pipeline instead of on the event loop
+INLINE_CONTENT_LENGTH = 16 * 1024
+
+# Handlers that block on decoding or file IO, run off the event loop
+MEDIA_HANDLERS = {
     3: MsgProcessor.image_msg
 }
 
+# Handlers converting voice, run in a pipeline of their own so a burst of voice doesn't hold up other media
+VOICE_HANDLERS = {
+    34: MsgProcessor.voice_msg
+}
+
+# Media sent from master: the hook client method sending it as `method(wxid, path)`,
+# and how oversized files are converted. Only types whose method the hook client has are supported.
+OUTBOUND_MEDIA = {
+    MsgType.Image: ('send_image', KIND_IMAGE),
+    MsgType.Sticker: ('send_image', KIND_FILE),
+    MsgType.Animation: ('send_image', KIND_FILE),
+    MsgType.Voice: ('send_file', KIND_VOICE),
+    MsgType.Video: ('send_file', KIND_FILE),
+    MsgType.File: ('send_file', KIND_FILE),
+}
+
+SYSTEM_MEMBER_UID = "__system__"
+
+# Key of the journal uid in raw hook messages
+JOURNAL_UID_KEY = "_efb_uid"
+
+# Ordering key in the ingest queue of the chat list updates sent to the master
+CHAT_UPDATES_KEY = "__chat_updates__"
+
+# Key of the wxids mentioned in a room message, if the hook sends them
+AT_LIST_KEY = "atUserList"
+
 
 class WechatPcChannel(SlaveChannel):
     channel_name: str = "Wechat Pc Slave"
@@ -44,76 +101,169 @@ class WechatPcChannel(SlaveChannel):
     wechatPc: WechatPc
     client: WechatPcClient
 
-    config: Dict[str, Any] = {}
+    config: Dict[str, Any]
 
-    # info_list = TTLCache(maxsize=2, ttl=600)
-    # info_dict = TTLCache(maxsize=2, ttl=600)
+    contacts: ContactStore
+    contact_cache: ContactCache
+    connection: ConnectionManager
 
-    info_list = {}
-    info_dict = {}
-
-    update_friend_event = threading.Event()
-    async_update_friend_event = asyncio.Event()
-    update_friend_lock = threading.Lock()
-    async_update_friend_lock = asyncio.Lock()
-
-    update_friend_queue = queue.Queue()
+    # Whether the master asked for chats before the friend list was loaded
+    chats_requested_early: bool = False
 
     __version__ = version.__version__
 
     logger: logging.Logger = logging.getLogger(
         "plugins.%s.WeChatPcChannel" % channel_id)
 
-    supported_message_types = {MsgType.Text, MsgType.Sticker, MsgType.Image,
-                                MsgType.Link, MsgType.Voice, MsgType.Animation}
+    # Media types are added per instance, for the ones the hook client can send
+    supported_message_types = {MsgType.Text, MsgType.Link}
 
     def __init__(self, instance_id: InstanceID = None):
         super().__init__(instance_id)
+        # Everything below is per instance, several accounts can run in one process
+        self.logger = logging.getLogger("plugins.%s.WeChatPcChannel" % self.channel_id)
+        self.config = {}
 
         self.load_config()
         if 'uri' not in self.config:
             raise EFBException("wechatPc uri not found in config")
-        uri = self.config['uri']
-        if 'APP_ID' in self.config and "APP_KEY" in self.config:
-            ts = int(datetime.timestamp(datetime.now()) * 1000)
-            sign = hashlib.sha256(f"app_id={self.config['APP_ID']}&timestamp={ts}&app_key{self.config['APP_KEY']}".encode())\
-                .hexdigest()
-            uri += f'?app_id={self.config["APP_ID"]}&timestamp={ts}&hash={sign}'
-        self.wechatPc = WechatPc(uri)
-        self.client = self.wechatPc.register_client("abcd")  # dummy id
-        self.loop = asyncio.get_event_loop()
-        self.isLogon = False
-
-        connected_event = threading.Event()
-        login_event = threading.Event()
-
-        self.info_list['friend'] = []
-        self.info_dict['friend'] = {}
-
-        ChatMgr.slave_channel = self
+        # The user's own nickname and wxid, to tell when the user is mentioned in a room
+        self.self_nickname: Optional[str] = self.config.get('self_nickname', None)
+        self.self_wxid: Optional[str] = self.config.get('self_wxid', None)
+        self.wechatPc = WechatPc(self.sign_uri())
+        self.client = self.wechatPc.register_client(self.config.get('client_id', self.instance_id or "abcd"))
+        self.supported_message_types = self.supported_message_types | {
+            msg_type for msg_type, (method, _) in OUTBOUND_MEDIA.items()
+            if callable(getattr(self.client, method, None))}
+        # One event loop for all instances
+        self.loop = shared_loop()
+        metrics_config = self.config.get('metrics', {}) or {}
+        self.metrics = Metrics(enabled=metrics_config.get('enabled', False),
+                               labels={'instance': self.instance_id} if self.instance_id else None)
+        self.media = MediaPipeline(self.loop,
+                                   max_workers=self.config.get('media_workers', 4),
+                                   max_pending=self.config.get('media_queue_size', 32))
+        self.sequencer = ChatSequencer()
+        self.outbound = OutboundDispatcher(self.loop,
+                                           rate=self.config.get('send_rate', 2),
+                                           burst=self.config.get('send_burst', 5))
+        # Sends are held until logged in
+        self.outbound.pause()
+        cache_config = self.config.get('media_cache', {}) or {}
+        self.media_cache = MediaCache(efb_utils.get_data_path(self.channel_id) / "media",
+                                      max_bytes=cache_config.get('max_bytes', 256 * 1024 * 1024),
+                                      max_entries=cache_config.get('max_entries', 4096),
+                                      ttl=cache_config.get('ttl', 7 * 24 * 3600))
+        voice_config = self.config.get('voice', {}) or {}
+        self.voice = VoiceTranscoder(self.media_cache,
+                                     max_workers=voice_config.get('workers', 2),
+                                     timeout=voice_config.get('timeout', 30))
+        self.voice_pipeline = MediaPipeline(self.loop,
+                                            max_workers=voice_config.get('workers', 2),
+                                            max_pending=voice_config.get('queue_size', 8),
+                                            name="wechatPc-voice")
+        app_msg_config = self.config.get('app_message', {}) or {}
+        self.app_msgs = AppMsgParser(max_length=app_msg_config.get('max_length', 256 * 1024),
+                                     max_entries=app_msg_config.get('cache_entries', 1024))
+        self.processor = MsgProcessor(self.media_cache, self.voice, self.app_msgs)
+        outbound_media_config = self.config.get('outbound_media', {}) or {}
+        self.outbound_media = OutboundMedia(self.media_cache,
+                                            max_image_bytes=outbound_media_config.get('max_image_bytes',
+                                                                                      5 * 1024 * 1024),
+                                            max_image_side=outbound_media_config.get('max_image_side', 4096),
+                                            max_voice_bytes=outbound_media_config.get('max_voice_bytes',
+                                                                                      2 * 1024 * 1024))
+        index_config = self.config.get('message_index', {}) or {}
+        self.messages = MessageIndex(max_entries=index_config.get('max_entries', 10000),
+                                     ttl=index_config.get('ttl', 24 * 3600))
+        dedup_config = self.config.get('dedup', {}) or {}
+        self.dedup = DedupFilter(window=dedup_config.get('window', 600),
+                                 fingerprint_window=dedup_config.get('fingerprint_window', None),
+                                 max_entries=dedup_config.get('max_entries', 20000))
+        journal_config = self.config.get('journal', {}) or {}
+        self.journal = MessageJournal(efb_utils.get_data_path(self.channel_id) / "journal",
+                                      segment_bytes=journal_config.get('segment_bytes', 8 * 1024 * 1024),
+                                      max_segments=journal_config.get('max_segments', 16),
+                                      fsync=journal_config.get('fsync', False),
+                                      threaded=True,
+                                      max_attempts=journal_config.get('max_attempts', 5))
+        # Received but not delivered in the last run
+        unacked = self.journal.pending()
+        for entry in unacked:
+            # The hook may send them again after the restart, they are delivered from the journal only
+            self.dedup.remember(entry.payload)
+        self.avatars = AvatarService(self.media_cache, session=shared_session())
+
+        self.chat_mgr = ChatMgr(self)
+        self.contacts = ContactStore(self.chat_mgr)
+        self.identities = IdentityCache(self.contacts,
+                                        on_unknown_member=lambda room_id, wxid:
+                                        self.refresher.on_unknown_member(room_id))
+        paging_config = self.config.get('friend_list', {}) or {}
+        self.pager = FriendListPager(self.client, self.contacts,
+                                     concurrency=paging_config.get('concurrency', 4),
+                                     page_timeout=paging_config.get('page_timeout', 10),
+                                     retries=paging_config.get('retries', 3))
+        lookup_config = self.config.get('contact_lookup', {}) or {}
+        get_contact = getattr(self.client, 'get_contact', None)
+        self.resolver = ContactResolver(self.loop, self.contacts,
+                                        fetch=get_contact if callable(get_contact) else None,
+                                        on_resolved=partial(self.on_contacts_updated, initial=False),
+                                        replies_by_message='OPCODE_FRIEND_INFO' in globals(),
+                                        timeout=lookup_config.get('timeout', 10),
+                                        negative_ttl=lookup_config.get('negative_ttl', 300))
+        refresh_config = self.config.get('friend_refresh', {}) or {}
+        self.refresher = RefreshScheduler(self.loop, self.pager.refresh,
+                                          lookup=partial(self.resolver.resolve, refresh=True)
+                                          if self.resolver.fetch is not None else None,
+                                          ready=lambda: self.isLogon,
+                                          min_interval=refresh_config.get('min_interval', 300),
+                                          max_interval=refresh_config.get('max_interval', 6 * 3600),
+                                          quiet_period=refresh_config.get('quiet_period', 30),
+                                          max_defer=refresh_config.get('max_defer', 900),
+                                          signal_threshold=refresh_config.get('signal_threshold', 5))
+        self.contact_cache = ContactCache(efb_utils.get_data_path(self.channel_id) / "contacts.db")
+        # One thread, so snapshots are written in the order they were taken
+        self.contact_cache_writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="wechatPc-contacts")
+        cached_friends, cached_chats = self.contact_cache.load()
+        if cached_friends:
+            self.contacts.restore(cached_friends, cached_chats)
+            self.logger.info(f"Loaded {len(cached_chats)} chats from contact cache")
+
+        if self.metrics.enabled:
+            self.register_gauges()
+            if metrics_config.get('port', None):
+                self.metrics.serve(metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+        refresh_started: Optional[float] = None
 
         @self.client.add_handler(OPCODE_FRIEND_LIST)
         async def on_friend_list(msg: dict):
+            nonlocal refresh_started
             self.logger.debug(f"on_friend_list: {msg}")
             if 'friendList' in msg:
-                total = msg['total']
-                current_page = msg['page']
-                #Prevent the list from being emptied every time
-                self.page = current_page
-                if total % 100 == 0:
-                    total_page = total // 100
-                else:
-                    total_page = total // 100 + 1
-                self.info_list['friend'] = msg['friendList']
-                self.process_friend_info()
-   
-                if str(total_page) == str(msg['page']):
-                    self.update_friend_event.set()
-            # self.async_update_friend_event.set()
+                self.metrics.inc('friend_list_pages')
+                if refresh_started is None:
+                    refresh_started = time.perf_counter()
+                initial = not self.contacts.ready.is_set()
+                diff = self.pager.on_page(msg)
+                if diff is not None:
+                    self.metrics.observe('friend_list_refresh', time.perf_counter() - refresh_started)
+                    refresh_started = None
+                    self.refresher.on_refreshed(diff)
+                    self.on_contacts_updated(diff, initial)
+
+        if 'OPCODE_FRIEND_INFO' in globals():
+            # Hooks answering contact lookups with a message of their own
+            @self.client.add_handler(OPCODE_FRIEND_INFO)
+            async def on_friend_info(msg: dict):
+                if 'wxid' in msg:
+                    self.resolver.on_contact(msg)
 
         @self.client.add_handler(OPCODE_WECHAT_QRCODE)
         async def on_qr_code(msg: dict):
             if 'loginQrcode' in msg:
+                from pyqrcode import QRCode  # Only needed when not logged in
                 qr_obj = QRCode(msg['loginQrcode'])
                 qr = qr_obj.terminal()
                 qr += "\n" + "If the QR code was not shown correctly, please generate the qrcode for the link\n" \
@@ -126,11 +276,13 @@ class WechatPcChannel(SlaveChannel):
             if 'loginStatus' in msg:
                 if msg['loginStatus'] == 1:
                     self.logger.info("Login Success")
-                    login_event.set()
-                    self.isLogon = True
+                    # Taken from the login status if the hook sends them and they are not configured
+                    self.self_wxid = self.self_wxid or msg.get('wxid', None)
+                    self.self_nickname = self.self_nickname or msg.get('nickname', None)
+                    self.connection.on_login_status(True)
                 elif msg['loginStatus'] == 0:
                     self.logger.info("Wechat Pc Account Logout")
-                    self.isLogon = False
+                    self.connection.on_login_status(False)
 
         @self.client.add_handler(OPCODE_MESSAGE_RECEIVE)
         async def on_msg_receive(msg: dict):
@@ -138,65 +290,183 @@ class WechatPcChannel(SlaveChannel):
                 return
             if msg.get('isOwner', 1) == 1:
                 return
-            username = await self.async_get_friend_info('nickname', msg['wxid'])
-            remark_name = await self.async_get_friend_info('remark', msg['wxid'])
-            chat = None
-            author = None
-
-            if 'roomId' in msg and msg['roomId'] != '':
-                group_name = await self.async_get_friend_info('username', msg['roomId'])
-                group_remark_name = await self.async_get_friend_info('nickname', msg['roomId'])
-                chat = ChatMgr.build_efb_chat_as_group(EFBGroupChat(
-                    uid=msg['roomId'],
-                    name=group_name or group_remark_name or msg['roomId']
-                ))
-                author = ChatMgr.build_efb_chat_as_member(chat, EFBGroupMember(
-                    name=username,
-                    alias=remark_name,
-                    uid=msg['wxid']
-                ))
-            else:
-                chat = ChatMgr.build_efb_chat_as_private(EFBPrivateChat(
-                    uid=msg['wxid'],
-                    name= remark_name or username or msg['wxid'],
-                ))
-                author = chat.other
-
-            if 'msgType' in msg and msg['msgType'] in TYPE_HANDLERS:
-                efb_msg = TYPE_HANDLERS[msg['msgType']](msg)
-            else:
-                efb_msg = efb_text_simple_wrapper(msg['content'])
-            efb_msg.author = author
-            efb_msg.chat = chat
-            efb_msg.deliver_to = coordinator.master
-            coordinator.send_message(efb_msg)
-
-        async def cron_update_friends():
-            while True:
-                await asyncio.sleep(60 * 10)
-                self.logger.debug("Start updating friends")
-                await self.client.get_friend_list()
-
-        def connect():
-            nonlocal self
-            asyncio.set_event_loop(self.loop)
-            self.loop.run_until_complete(self.wechatPc.connect())
-            connected_event.set()
-            self.loop.create_task(self.wechatPc.run())
-            self.loop.create_task(cron_update_friends())
-            self.loop.run_forever()
-
-        try:
-            t = threading.Thread(target=connect)
-            t.daemon = True
-            t.start()
-            # self.loop.run_until_complete(self.updater.run_task(shutdown_hook=self.shutdown_hook.wait))
-        except:
-            print_exc()
+            self.metrics.inc('messages_received')
+            self.refresher.note_activity()
+            if self.dedup.is_duplicate(msg):
+                # Sent again by the hook, e.g. after a reconnect, the first copy is on its way already
+                self.metrics.inc('messages_duplicate')
+                return
+            # Journaled before anything else, so it's replayed if it never reaches the master
+            msg[JOURNAL_UID_KEY] = self.journal.append(msg.get('roomId', None) or msg['wxid'], msg)
+            await ingest_msg(msg)
+
+        async def ingest_msg(msg: dict):
+            if not await self.ingest.admit(msg):
+                if self.ingest.overflow == OVERFLOW_DROP:
+                    self.journal.ack(msg[JOURNAL_UID_KEY])
+                return
+            with self.metrics.timer('msg_receive'):
+                await process_msg(msg)
+
+        async def process_msg(msg: dict):
+            """
+            Process a message admitted by the ingest queue
+            """
+            chat_uid = msg.get('roomId', None) or msg['wxid']
+            def on_error():
+                self.ingest.release()
+                self.on_delivery_failed(msg.get(JOURNAL_UID_KEY, None))
+
+            try:
+                produced = await self.produce_message(msg)
+                if self.resolver.fetch is not None and self.contacts.ready.is_set() and chat_uid not in self.contacts:
+                    # A new room or a stranger, looked up on its own before the message is delivered.
+                    # Without a lookup in the hook client, it stays unknown until the next reload.
+                    produced = self.after_lookup(chat_uid, produced)
+            except BaseException:
+                on_error()
+                raise
+
+            def deliver(efb_msg: Message):
+                chat, author = self.identities.resolve(msg['wxid'], msg.get('roomId', None))
+                efb_msg.author = author
+                efb_msg.chat = chat
+                efb_msg.uid = msg.get(JOURNAL_UID_KEY, None) or str(uuid.uuid4())
+                efb_msg.deliver_to = coordinator.master
+                # Only meant for this channel, not passed on to the master
+                quote = (getattr(efb_msg, 'vendor_specific', None) or {}).pop(QUOTE_KEY, None)
+                if quote is not None:
+                    self.attach_quote(efb_msg, msg.get('roomId', None), *quote)
+                if msg.get('roomId', None) and efb_msg.type == MsgType.Text:
+                    self.mark_mention(efb_msg, msg.get(AT_LIST_KEY, None))
+                wechat_id = wechat_msg_id(msg)
+                if wechat_id is not None:
+                    self.messages.add(efb_msg.uid, wechat_id, chat.uid)
+                self.coalescer.put(chat.uid, efb_msg)
+
+            self.sequencer.submit(chat_uid, produced, deliver, on_error)
+
+        ingest_config = self.config.get('ingest', {}) or {}
+        self.ingest = IngestQueue(self.loop, self.deliver_to_master,
+                                  workers=ingest_config.get('workers', 2),
+                                  max_size=ingest_config.get('max_size', 1000),
+                                  overflow=ingest_config.get('overflow', OVERFLOW_BLOCK),
+                                  spill_path=efb_utils.get_data_path(self.channel_id) / "ingest_spill.jsonl",
+                                  replay=process_msg,
+                                  drop_notice=self.build_drop_notice,
+                                  # Spilled messages are unacknowledged in the journal and replayed from there
+                                  resume_spill=False,
+                                  on_failed=lambda efb_msg: self.on_delivery_failed(getattr(efb_msg, 'uid', None)))
+
+        coalesce_config = self.config.get('coalesce', {}) or {}
+        self.coalescer = MessageCoalescer(self.loop, self.forward_to_ingest,
+                                          window=coalesce_config.get('window', 0),
+                                          max_messages=coalesce_config.get('max_messages', 20),
+                                          max_length=coalesce_config.get('max_length', 4000),
+                                          mixed_author=self.make_system_member)
+        # Uid of a merged message -> uids of the other messages it replaces
+        self.merged_uids: Dict[str, List[str]] = {}
+
+        async def replay_journal():
+            if unacked:
+                self.logger.info(f"Replaying {len(unacked)} undelivered messages from journal")
+            while unacked:
+                entry = unacked.pop(0)
+                if not self.journal.attempt(entry.uid):
+                    # Failed too often, or delivered meanwhile
+                    continue
+                entry.payload[JOURNAL_UID_KEY] = entry.uid
+                await ingest_msg(entry.payload)
+
+        async def connect():
+            # The signature carries a timestamp, sign again for every attempt
+            self.wechatPc.uri = self.sign_uri()
+            await self.wechatPc.connect()
+            self.metrics.inc('websocket_connects')
+
+        def on_connection_state(old: str, new: str):
+            if new != STATE_LOGGED_IN:
+                self.outbound.pause()
+                return
+            self.outbound.resume()
+            # Chats are served from the contact cache until then, or may have changed while disconnected.
+            # Reconcile with the live list in background, only changes are applied and sent to the master.
+            self.refresher.request()
+            if unacked:
+                self.loop.create_task(replay_journal())
+
+        # Connecting and login happen in background, the channel is usable (from cache) right away
+        reconnect_config = self.config.get('reconnect', {}) or {}
+        self.connection = ConnectionManager(self.loop, connect, self.wechatPc.run, self.client.open,
+                                            on_state_change=on_connection_state,
+                                            initial_delay=reconnect_config.get('initial_delay', 1),
+                                            max_delay=reconnect_config.get('max_delay', 60))
+
+        self.connection.start()
+        self.loop.call_soon_threadsafe(self.refresher.start)
+        if self.metrics.enabled and metrics_config.get('log_interval', None):
+            asyncio.run_coroutine_threadsafe(self.metrics.log_periodically(metrics_config['log_interval']), self.loop)
+
+    @property
+    def isLogon(self) -> bool:
+        return self.connection.logged_in.is_set()
+
+    def sign_uri(self) -> str:
+        """
+        The hook uri, signed with APP_ID and APP_KEY if configured
+        """
+        uri = self.config['uri']
+        if 'APP_ID' in self.config and "APP_KEY" in self.config:
+            ts = int(datetime.timestamp(datetime.now()) * 1000)
+            sign = hashlib.sha256(f"app_id={self.config['APP_ID']}&timestamp={ts}&app_key{self.config['APP_KEY']}".encode())\
+                .hexdigest()
+            uri += f'?app_id={self.config["APP_ID"]}&timestamp={ts}&hash={sign}'
+        return uri
 
-        connected_event.wait()
-        asyncio.run_coroutine_threadsafe(self.client.open(), self.loop).result()
-        login_event.wait()
+    def register_gauges(self):
+        """
+        Expose queue depths and cache statistics of the channel components
+        """
+        gauges = {
+            'contacts': lambda: len(self.contacts),
+            'media_pipeline_pending': lambda: self.media.pending,
+            'voice_pipeline_pending': lambda: self.voice_pipeline.pending,
+            'voice_converted': lambda: self.voice.converted,
+            'voice_convert_failed': lambda: self.voice.failed,
+            'outbound_pending': lambda: self.outbound.pending,
+            'reconnects': lambda: self.connection.reconnects,
+            'ordered_chats_pending': lambda: len(self.sequencer),
+            'ingest_pending': lambda: self.ingest.pending,
+            'ingest_spilled': lambda: self.ingest.spilled,
+            'ingest_spill_size': lambda: self.ingest.spill_size,
+            'ingest_dropped': lambda: self.ingest.dropped,
+            'coalescer_held': lambda: len(self.coalescer),
+            'coalescer_merged': lambda: self.coalescer.merged,
+            'journal_entries': lambda: len(self.journal),
+            'journal_unacked': lambda: self.journal.unacked,
+            'journal_dead_letters': lambda: self.journal.dead_letters,
+            'media_cache_bytes': lambda: self.media_cache.size,
+            'media_cache_hits': lambda: self.media_cache.hits,
+            'media_cache_misses': lambda: self.media_cache.misses,
+            'outbound_media_deduplicated': lambda: self.outbound_media.deduplicated,
+            'identity_cache_hits': lambda: self.identities.hits,
+            'identity_cache_misses': lambda: self.identities.misses,
+            'contact_lookups': lambda: self.resolver.lookups,
+            'contact_lookup_misses': lambda: self.resolver.misses,
+            'friend_list_reloads': lambda: self.refresher.refreshes,
+            'friend_list_reloads_unchanged': lambda: self.refresher.unchanged,
+            'friend_list_reload_interval': lambda: self.refresher.interval,
+            'friend_list_stale_signals': lambda: self.refresher.signals,
+            'room_lookups': lambda: self.refresher.targeted,
+            'message_index_size': lambda: len(self.messages),
+            'dedup_entries': lambda: len(self.dedup),
+            'dedup_hits': lambda: self.dedup.hits,
+            'app_msg_parse_hits': lambda: self.app_msgs.hits,
+            'app_msg_parse_misses': lambda: self.app_msgs.misses,
+            'avatar_revalidated': lambda: self.avatars.revalidated,
+        }
+        for name, func in gauges.items():
+            self.metrics.gauge(name, func)
 
     def load_config(self):
         """
@@ -206,6 +476,7 @@ class WechatPcChannel(SlaveChannel):
         config_path = efb_utils.get_config_path(self.channel_id)
         if not config_path.exists():
             return
+        import yaml
         with config_path.open() as f:
             d = yaml.full_load(f)
             if not d:
@@ -216,182 +487,352 @@ class WechatPcChannel(SlaveChannel):
         url = self.get_friend_info('headUrl', chat.uid)
         if not url:
             url = "https://pic2.zhimg.com/50/v2-6afa72220d29f045c15217aa6b275808_720w.jpg"  # temp workaround
-        return download_file(url)
+        return self.avatars.get(url)
 
     def get_chat(self, chat_uid: ChatID) -> 'Chat':
-        if 'chat' not in self.info_list or not self.info_list['chat']:
+        if not self.contacts.ready.is_set():
             self.logger.debug("Chat list is empty. Fetching...")
+            self.chats_requested_early = True
             self.update_friend_info()
-        for chat in self.info_list['chat']:
-            if chat_uid == chat.uid:
-                return chat
-        return None
+        elif chat_uid not in self.contacts:
+            self.resolver.resolve_threadsafe(chat_uid, self.resolver.timeout)
+        return self.contacts.get_chat(chat_uid)
 
     def get_chats(self) -> Collection['Chat']:
-        if 'chat' not in self.info_list or not self.info_list['chat']:
+        if not self.contacts.ready.is_set():
             self.logger.debug("Chat list is empty. Fetching...")
+            self.chats_requested_early = True
             self.update_friend_info()
-        return self.info_list['chat']
+        return self.contacts.get_chats()
 
     def send_message(self, msg: 'Message') -> 'Message':
         chat_uid = msg.chat.uid
-        if msg.edit:
-            pass  # todo
-
+        # Checked again when queued, this only avoids converting media that can't be queued
+        max_pending = None if self.isLogon else self.config.get('offline_send_buffer', 100)
+        if max_pending is not None and self.outbound.pending >= max_pending:
+            raise self.offline_buffer_full()
+        prepared = None
         if msg.type in [MsgType.Text, MsgType.Link]:
             if isinstance(msg.target, Message):  # Reply to message
-                max_length = 50
-                tgt_text = process_quote_text(msg.target.text, max_length)
-                msg.text = "%s\n\n%s" % (tgt_text, msg.text)
-                # self.iot_send_text_message(chat_type, chat_uid, msg.text
-                asyncio.run_coroutine_threadsafe(self.client.at_room_member(
-                    room_id=chat_uid,
-                    wxid=msg.target.author.uid,
-                    nickname=msg.target.author.name,
-                    message=msg.text
-                ), self.loop).result()
+                job = partial(self.send_reply, chat_uid, msg.target, msg.text)
             else:
-                asyncio.run_coroutine_threadsafe(self.client.send_text(
-                    wxid=msg.chat.uid,
-                    content=msg.text
-                ), self.loop).result()
+                job = partial(self.client.send_text,
+                              wxid=chat_uid,
+                              content=msg.text)
+        elif msg.type in OUTBOUND_MEDIA and msg.type in self.supported_message_types and msg.file is not None:
+            method, kind = OUTBOUND_MEDIA[msg.type]
+            send = getattr(self.client, method)
+            # Converting starts right away and runs alongside other sends, only the send itself waits for its turn
+            prepared = asyncio.run_coroutine_threadsafe(
+                self.prepare_media(own_handle(msg.file, getattr(msg, 'path', None)), kind, msg.mime), self.loop)
+            job = partial(self.send_media, send, chat_uid, prepared, msg.text)
+        else:
+            raise EFBMessageTypeNotSupported(f"{msg.type.name} messages can't be sent to WeChat")
+
+        job = self.metrics.wrap('send_round_trip', job)
+        try:
+            sent = self.outbound.submit(chat_uid, job, max_pending=max_pending)
+        except OutboundQueueFull:
+            if prepared is not None:
+                prepared.cancel()
+            raise self.offline_buffer_full()
+        if not msg.edit:
+            # Provisional id, the message is sent in background
             msg.uid = str(uuid.uuid4())
-            self.logger.debug('[%s] Sent as a text message. %s', msg.uid, msg.text)
+        # WeChat messages can't be edited, an edit is sent as a new message, which its id then refers to
+        self.messages.add(msg.uid, None, chat_uid)
+        sent.add_done_callback(partial(self.on_message_sent, msg))
+        self.logger.debug('[%s] Queued as a %s message. %s', msg.uid, msg.type.name, msg.text)
         return msg
 
+    def offline_buffer_full(self) -> EFBMessageError:
+        return EFBMessageError(f"WeChat is not logged in ({self.connection.state}) and too many messages "
+                               "are waiting, the message was not sent.")
+
+    async def prepare_media(self, file: BinaryIO, kind: str, mime: Optional[str]) -> PreparedMedia:
+        """
+        Copy and convert a file from master in the media pipeline
+        """
+        return await (await self.media.submit(
+            self.metrics.wrap('media_prepare', self.outbound_media.prepare), file, kind, mime))
+
+    async def send_media(self, send, chat_uid: str, prepared: 'concurrent.futures.Future', caption: str):
+        """
+        Send a prepared file, followed by its caption
+        :param send: The hook client method sending this kind of media
+        """
+        media: PreparedMedia = await asyncio.wrap_future(prepared)
+        result = await send(chat_uid, str(media.path))
+        if caption:
+            await self.client.send_text(wxid=chat_uid, content=caption)
+        return result
+
+    async def send_reply(self, chat_uid: str, target: Message, text: str):
+        """
+        Send a reply with the quoted text prefixed, mentioning the author of the target if it's a room member
+        """
+        text = "%s\n\n%s" % (process_quote_text(target.text, 50), text)
+        author = target.author
+        # Not the user, nor the system member of merged and notice messages
+        if is_room(chat_uid) and author is not None and \
+                not isinstance(author, (SelfChatMember, SystemChatMember)) and author.uid != SYSTEM_MEMBER_UID:
+            return await self.client.at_room_member(room_id=chat_uid,
+                                                    wxid=target.author.uid,
+                                                    nickname=target.author.name,
+                                                    message=text)
+        return await self.client.send_text(wxid=chat_uid, content=text)
+
+    def attach_quote(self, efb_msg: Message, room_id: Optional[str], wechat_id: Optional[str], sender: str,
+                     name: str, text: str):
+        """
+        Make a received reply refer to the message it quotes, if that one went through the bridge,
+        otherwise prefix the quoted text
+        """
+        ref = self.messages.by_wechat(wechat_id) if wechat_id else None
+        if ref is not None and ref.chat_uid == efb_msg.chat.uid:
+            author = self.identities.resolve(sender, room_id)[1] if sender \
+                else self.make_system_member(efb_msg.chat)
+            efb_msg.target = Message(type=MsgType.Text, text=text, uid=ref.efb_uid, chat=efb_msg.chat,
+                                     author=author, deliver_to=coordinator.master)
+            return
+        quoted = f"{name}: {text}" if name else text
+        efb_msg.text = "%s\n\n%s" % (process_quote_text(quoted, 50), efb_msg.text)
+
+    def mark_mention(self, efb_msg: Message, at_list):
+        """
+        Substitute the mention of the user in a room message, so the master can notify and the coalescer
+        doesn't hold it back
+        """
+        span = find_mention(efb_msg.text, self.self_nickname, self.self_wxid, at_list)
+        if span is None or getattr(efb_msg.chat, 'self', None) is None:
+            return
+        substitutions = dict(efb_msg.substitutions or {})
+        substitutions[span] = efb_msg.chat.self
+        efb_msg.substitutions = Substitutions(substitutions)
+
+    def deliver_to_master(self, efb_msg: Union[Message, Status]):
+        """
+        Hand a message or status to the master, called from the ingest workers
+        """
+        if isinstance(efb_msg, Status):
+            coordinator.send_status(efb_msg)
+            return
+        with self.metrics.timer('master_delivery'):
+            coordinator.send_message(efb_msg)
+        # The journal is written from the event loop only
+        self.loop.call_soon_threadsafe(self.journal.ack, efb_msg.uid)
+        for uid in self.merged_uids.pop(efb_msg.uid, ()):
+            self.loop.call_soon_threadsafe(self.journal.ack, uid)
+
+    def on_delivery_failed(self, uid: Optional[str]):
+        """
+        Count a failed delivery in the journal, a message failing too often is not replayed again
+        """
+        if uid is None:
+            return
+        for failed in [uid] + self.merged_uids.pop(uid, []):
+            self.journal.attempt(failed)
+
+    def forward_to_ingest(self, key: str, efb_msg: Message, sources: List[Message]):
+        """
+        Queue a message from the coalescer for delivery
+        :param sources: The received messages it's made of
+        """
+        if len(sources) > 1:
+            self.merged_uids[efb_msg.uid] = [m.uid for m in sources if m.uid != efb_msg.uid]
+            # Only the merged message reaches the master, quotes of any of its parts refer to it
+            self.messages.merge(self.merged_uids[efb_msg.uid], efb_msg.uid)
+        self.ingest.put(key, efb_msg, slots=len(sources))
+
+    def make_system_member(self, chat: Chat) -> ChatMember:
+        return chat.make_system_member(uid=SYSTEM_MEMBER_UID, name=self.channel_name)
+
+    def build_drop_notice(self, efb_msg: Message, dropped: int) -> Message:
+        notice = efb_text_simple_wrapper(f"{dropped} message(s) in this chat were dropped as the bridge was overloaded. "
+                                         "Please check them on your phone.")
+        notice.chat = efb_msg.chat
+        notice.author = self.make_system_member(efb_msg.chat)
+        notice.uid = str(uuid.uuid4())
+        notice.deliver_to = coordinator.master
+        return notice
+
+    def on_message_sent(self, msg: 'Message', future: 'concurrent.futures.Future'):
+        """
+        Called once the outbound dispatcher finished sending a message from master
+        """
+        e = future.exception()
+        if e is None:
+            self.metrics.inc('messages_sent')
+            wechat_id = wechat_msg_id(future.result())
+            if wechat_id is not None:
+                self.messages.bind(msg.uid, wechat_id)
+            self.logger.debug('[%s] Sent.', msg.uid)
+            return
+        self.metrics.inc('messages_send_failed')
+        self.logger.warning(f'[{msg.uid}] Failed to send message to {msg.chat.uid}: {e!r}')
+        notice = efb_text_simple_wrapper(f"Failed to deliver message: {e}")
+        notice.chat = msg.chat
+        notice.author = self.make_system_member(msg.chat)
+        notice.target = msg
+        notice.uid = str(uuid.uuid4())
+        notice.deliver_to = coordinator.master
+        # Called on whichever thread completed the send, queued from the loop like received messages
+        self.loop.call_soon_threadsafe(partial(self.ingest.put, msg.chat.uid, notice, slots=0))
+
     def poll(self):
         pass
 
     def send_status(self, status: 'Status'):
-        pass
+        if isinstance(status, MessageRemoval):
+            raise EFBOperationNotSupported("Recalling messages is not supported by the WeChat PC hook")
 
     def stop_polling(self):
-        pass
+        self.loop.call_soon_threadsafe(self.refresher.stop)
+        self.connection.stop()
 
-    def get_message_by_id(self, chat: 'Chat', msg_id: MessageID) -> Optional['Message']:
-        pass
+        async def flush_held():
+            self.coalescer.flush_all()
 
-    def process_friend_info(self):
-        if self.page == 1:
-            self.info_dict['friend'] = {}
-            self.info_dict['chat'] = {}
-            self.info_list['chat'] = []
-        # For the first iteration, we don't care about the group chat
-        for friend in self.info_list['friend']:
-            self.info_dict['friend'][friend['wxid']] = friend
-
-            friend_name = friend.get('nickname', '')
-            friend_remark = friend.get('remark', '')
-
-            if '@chatroom' not in friend['wxid']:
-                new_entity = EFBPrivateChat(
-                    uid=friend['wxid'],
-                    name=friend_name,
-                    alias=friend_remark
-                )
-                self.info_list['chat'].append(ChatMgr.build_efb_chat_as_private(new_entity))
-                self.info_dict['chat'][friend['wxid']] = new_entity
-
-        # For the second iteration, we check if there's a name given to a group
-        # If not, we have to use member name as temp name
-        for friend in self.info_list['friend']:
-            group_name = friend.get('username', None)
-            group_remark = friend.get('nickname', None)
-            group_wxid_list: str = friend.get('roomWxidList', '')
-
-            if '@chatroom' in friend['wxid']:
-                if not group_name and not group_remark and friend.get('roomWxidList', ''):
-                    wxids = group_wxid_list.split("^G")
-                    if len(wxids) <= 1:
-                        continue
-                    group_name_arr = []
-                    for wxid in wxids:
-                        if wxid not in self.info_dict['friend']:
-                            continue
-                        contact = self.info_dict['friend'][wxid]
-                        group_name_arr.append(contact['username'] or contact['nickname'])
-                    group_name = '、'.join(group_name_arr)
-                    self.info_dict['friend'][friend['wxid']]['nickname'] = group_name
-                    new_entity = EFBGroupChat(
-                        uid=friend['wxid'],
-                        name=group_name or group_remark or friend['wxid']
-                    )
-                else:
-                    new_entity = EFBGroupChat(
-                        uid=friend['wxid'],
-                        name=group_name or group_remark or friend['wxid']
-                    )
-                self.info_list['chat'].append(ChatMgr.build_efb_chat_as_group(new_entity))
-                self.info_dict['chat'][friend['wxid']] = new_entity
+        # Messages held for merging are queued before the ingest workers stop
+        try:
+            asyncio.run_coroutine_threadsafe(flush_held(), self.loop).result(5)
+        except concurrent.futures.TimeoutError:
+            self.logger.warning("Timed out flushing held messages, they are replayed from the journal on start")
+        if not self.ingest.shutdown(timeout=10):
+            self.logger.warning("Timed out delivering queued messages, they are replayed from the journal on start")
+        self.media.shutdown()
+        self.voice_pipeline.shutdown()
+        self.voice.shutdown()
+        self.avatars.shutdown()
+        # Pending snapshots are still written
+        self.contact_cache_writer.shutdown(wait=True)
+
+        async def close_journal():
+            self.journal.close()
+
+        # Closed on the loop after the acks the ingest workers scheduled there
+        try:
+            asyncio.run_coroutine_threadsafe(close_journal(), self.loop).result(5)
+        except concurrent.futures.TimeoutError:
+            self.journal.close()
 
-    def update_friend_info(self):
-        with self.update_friend_lock:
-            if 'friend' in self.info_list and self.info_list['friend']:
-                return
-            self.logger.debug('Updating friend info...')
-            self.update_friend_event.clear()
-            asyncio.run_coroutine_threadsafe(self.client.get_friend_list(), self.loop).result()
-            self.update_friend_event.wait()
-            self.logger.debug('Friend retrieved. Start processing...')
-            self.process_friend_info()
-            self.update_friend_event.clear()
-
-    async def async_update_friend_info(self):
-        async with self.async_update_friend_lock:
-            if 'friend' in self.info_list and self.info_list['friend']:
-                return
-            self.logger.debug('Updating friend info...')
-            self.async_update_friend_event.clear()
-            await self.client.get_friend_list()
-            self.logger.debug('Friend retrieved. Start processing...')
-            await self.async_update_friend_event.wait()
-            self.process_friend_info()
-            self.async_update_friend_event.clear()
-
-    async def async_get_chat_info(self, wechat_id: int) -> Union[None, Chat]:
-        # logging.getLogger(__name__).info('async_get_friend_remark called')
-        count = 0
-        while count <= 1:
-            if not self.info_dict.get('chat', None):
-                await self.async_update_friend_info()
-                count += 1
-            else:
-                break
-        if count > 1:  # Failure or friend not found
-            raise Exception("Failed to update friend list!")  # todo Optimize error handling
-        # logging.getLogger(__name__).info('async_get_friend_remark returned')
-        if not self.info_dict.get('chat', None) or wechat_id not in self.info_dict['chat']:
-            return None
-        return self.info_dict['chat'][wechat_id]
-
-    def get_friend_info(self, item: str, wechat_id: int) -> Union[None, str]:
-        # logging.getLogger(__name__).info('async_get_friend_remark called')
-        count = 0
-        while count <= 1:
-            if not self.info_dict.get('friend', None):
-                self.update_friend_info()
-                count += 1
-            else:
-                break
-        if count > 1:  # Failure or friend not found
-            raise Exception("Failed to update friend list!")  # todo Optimize error handling
-        # logging.getLogger(__name__).info('async_get_friend_remark returned')
-        if not self.info_dict.get('friend', None) or wechat_id not in self.info_dict['friend']:
+    def get_message_by_id(self, chat: 'Chat', msg_id: MessageID) -> Optional['Message']:
+        entry = self.journal.get(msg_id)
+        if entry is None or entry.chat_uid != chat.uid:
             return None
-        return self.info_dict['friend'][wechat_id].get(item, None)
-
-    async def async_get_friend_info(self, item: str, wechat_id: int) -> Union[None, str]:
-        # logging.getLogger(__name__).info('async_get_friend_remark called')
-        # count = 0
-        # while count <= 1:
-        #     if not self.info_dict.get('friend', None):
-        #         await self.async_update_friend_info()
-        #         count += 1
-        #     else:
-        #         break
-        # if count > 1:  # Failure or friend not found
-        #     raise Exception("Failed to update friend list!")  # todo Optimize error handling
-        # logging.getLogger(__name__).info('async_get_friend_remark returned')
-        if not self.info_dict.get('friend', None) or wechat_id not in self.info_dict['friend']:
+        try:
+            return asyncio.run_coroutine_threadsafe(self.async_build_message(entry), self.loop).result()
+        except Exception as e:
+            self.logger.warning(f"Failed to rebuild message {msg_id} from journal: {e!r}")
             return None
-        return self.info_dict['friend'][wechat_id].get(item, None)
+
+    async def produce_message(self, msg: dict) -> asyncio.Future:
+        """
+        Start converting a raw hook message
+        :return: Future of the EFB message
+        """
+        if 'msgType' in msg and msg['msgType'] in MEDIA_HANDLERS:
+            # Blocking handlers run in the media pipeline, this waits only when the pipeline is full
+            return await self.media.submit(
+                self.metrics.wrap('media_decode', MEDIA_HANDLERS[msg['msgType']]), self.processor, msg)
+        if 'msgType' in msg and msg['msgType'] in VOICE_HANDLERS:
+            handler = self.metrics.wrap('voice_convert', VOICE_HANDLERS[msg['msgType']])
+            if not self.voice_pipeline.full:
+                return await self.voice_pipeline.submit(handler, self.processor, msg)
+            # Too much voice waiting, pass this one on unconverted instead of holding up the hook
+            self.metrics.inc('voice_unconverted')
+            return await self.media.submit(partial(handler, convert=False), self.processor, msg)
+        if 'msgType' in msg and msg['msgType'] in TYPE_HANDLERS and \
+                len(msg.get('content', None) or '') > INLINE_CONTENT_LENGTH:
+            # e.g. a forwarded chat record, too long to be parsed on the event loop
+            return await self.media.submit(TYPE_HANDLERS[msg['msgType']], self.processor, msg)
+        produced = self.loop.create_future()
+        if 'msgType' in msg and msg['msgType'] in TYPE_HANDLERS:
+            produced.set_result(TYPE_HANDLERS[msg['msgType']](self.processor, msg))
+        else:
+            produced.set_result(efb_text_simple_wrapper(msg['content']))
+        return produced
+
+    async def after_lookup(self, chat_uid: str, produced: Awaitable) -> Message:
+        """
+        Wait for a message and the lookup of its unknown chat, without holding up other chats
+        """
+        if not await self.resolver.resolve(chat_uid):
+            # Not even the hook could tell, the friend list is likely out of date
+            self.refresher.signal()
+        return await produced
+
+    async def async_build_message(self, entry: JournalEntry) -> Message:
+        """
+        Rebuild a received message from its journal entry
+        """
+        msg = entry.payload
+        chat, author = self.identities.resolve(msg['wxid'], msg.get('roomId', None))
+        efb_msg = await (await self.produce_message(msg))
+        efb_msg.author = author
+        efb_msg.chat = chat
+        efb_msg.uid = entry.uid
+        efb_msg.deliver_to = coordinator.master
+        quote = (getattr(efb_msg, 'vendor_specific', None) or {}).pop(QUOTE_KEY, None)
+        if quote is not None:
+            self.attach_quote(efb_msg, msg.get('roomId', None), *quote)
+        return efb_msg
+
+    def on_contacts_updated(self, diff: ContactDiff, initial: bool):
+        """
+        Propagate a completed friend list refresh to caches, the master and the contact cache
+        :param diff: The changes against the previous list
+        :param initial: Whether this is the first list since startup (and without contact cache)
+        """
+        self.logger.debug(f"Friend list updated: {diff}")
+        if diff:
+            self.identities.invalidate(diff.added | diff.changed | diff.removed)
+        # The master has been told about the initial list only if it asked before the list was loaded
+        if diff and (not initial or self.chats_requested_early) and getattr(coordinator, 'master', None):
+            # Not sent from the event loop, the master may take its time
+            self.ingest.put(CHAT_UPDATES_KEY, ChatUpdates(
+                channel=self,
+                new_chats=diff.added,
+                removed_chats=diff.removed,
+                modified_chats=diff.changed
+            ), slots=0)
+        if diff or initial:
+            friends, entities = self.contacts.export()
+            self.loop.run_in_executor(
+                self.contact_cache_writer, self.contact_cache.save, friends, entities,
+                None if initial else diff.added | diff.changed, diff.removed)
+            updated = friends.keys() if initial else diff.added | diff.changed
+            self.avatars.prefetch((friends[i].get('headUrl', None) for i in updated if i in friends),
+                                  self.config.get('avatar_prefetch', 200))
+
+    def update_friend_info(self):
+        """
+        Load the friend list if it's not loaded yet, blocks until it's done
+        """
+        if self.contacts.ready.is_set():
+            return
+        if not self.isLogon:
+            self.logger.debug(f"WeChat is not logged in ({self.connection.state}), serving chats from cache")
+            return
+        self.logger.debug('Updating friend info...')
+        try:
+            asyncio.run_coroutine_threadsafe(self.pager.refresh(), self.loop).result()
+        except Exception as e:
+            self.logger.warning(f"Failed to load friend list: {e!r}")
+            return
+        self.logger.debug('Friend retrieved.')
+
+    async def async_get_chat_info(self, wechat_id: str) -> Union[None, EFBPrivateChat]:
+        return self.contacts.get_entity(wechat_id)
+
+    def get_friend_info(self, item: str, wechat_id: str) -> Union[None, str]:
+        if not self.contacts.ready.is_set():
+            self.update_friend_info()
+        elif wechat_id not in self.contacts:
+            self.resolver.resolve_threadsafe(wechat_id, self.resolver.timeout)
+        return self.contacts.get_friend_info(item, wechat_id)
+
+    async def async_get_friend_info(self, item: str, wechat_id: str) -> Union[None, str]:
+        if self.contacts.ready.is_set():
+            await self.resolver.resolve(wechat_id)
+        return self.contacts.get_friend_info(item, wechat_id)
@@ -1,9 +1,11 @@
-import logging
-import tempfile
-import threading
+import base64
+from typing import IO, Iterable, Optional, Tuple, Union
+from urllib.parse import unquote_to_bytes
 
 import requests as requests
 
+SNIFF_LENGTH = 2048
+
 
 def process_quote_text(text: str, max_length: int) -> str:
     """
@@ -25,28 +27,68 @@ def process_quote_text(text: str, max_length: int) -> str:
     return tgt_text
 
 
-def download_file(url: str, retry: int = 3) -> tempfile:
-    """
-    A function that downloads files from given URL
-    Remember to close the file once you are done with the file!
-    :param retry: The max retries before giving up
-    :param url: The URL that points to the file
-    """
-    count = 1
-    while True:
-        try:
-            file = tempfile.NamedTemporaryFile()
-            r = requests.get(url, stream=True, timeout=10)
-            r.raise_for_status()  # Replace this with better error handling.
-
-            for chunk in r.iter_content(1024):
-                file.write(chunk)
-        except Exception as e:
-            logging.getLogger(__name__).warning(f"Error occurred when downloading {url}. {e}")
-            if count >= retry:
-                logging.getLogger(__name__).warning(f"Maximum retry reached. Giving up.")
-                raise e
-            count += 1
-        else:
-            break
-    return file
+def find_mention(text: str, nickname: Optional[str] = None, wxid: Optional[str] = None,
+                 at_list: Union[str, Iterable[str], None] = None) -> Optional[Tuple[int, int]]:
+    """
+    Find where the user is mentioned in the text of a room message
+    :param nickname: The user's own nickname, mentions are written as @nickname
+    :param wxid: The user's own wxid, looked for in `at_list`
+    :param at_list: wxids mentioned in the message, if the hook sends them, as a list or comma separated
+    :return: The range of the mention in the text, None if the user is not mentioned
+    """
+    if nickname:
+        begin = text.find(f"@{nickname}")
+        if begin >= 0:
+            return begin, begin + len(nickname) + 1
+    if not wxid or not at_list:
+        return None
+    if isinstance(at_list, str):
+        at_list = at_list.split(',')
+    if wxid not in (i.strip() for i in at_list):
+        return None
+    # Mentioned under another name, e.g. the room alias, mentions end with a quarter em space
+    begin = text.find('@')
+    if begin < 0:
+        return (0, len(text)) if text else None
+    end = min((i for i in (text.find('\u2005', begin), text.find(' ', begin)) if i > begin), default=len(text))
+    return begin, end
+
+
+def write_response(response: requests.Response, file: IO) -> Optional[str]:
+    """
+    Write the body of a streamed response into a file
+    :return: The MIME type given by the server
+    """
+    for chunk in response.iter_content(64 * 1024):
+        file.write(chunk)
+    mime = response.headers.get('Content-Type', None)
+    return mime.split(';')[0].strip() if mime else None
+
+
+def decode_data_url(data_url: str, file: IO, chunk_size: int = 64 * 1024) -> Tuple[Optional[str], bytes]:
+    """
+    Decode a data URL straight into a file, chunk by chunk
+    :param data_url: The data URL, e.g. data:image/png;base64,....
+    :param file: The file to write into
+    :param chunk_size: The number of base64 characters decoded at a time
+    :return: The MIME type declared in the URL (if any) and the first bytes of the payload for sniffing
+    """
+    header, sep, payload = data_url.partition(',')
+    if not sep or not header.startswith('data:'):
+        raise ValueError("Not a data URL")
+    params = header[5:].split(';')
+    mime = params[0] or None
+    if 'base64' not in params[1:]:
+        data = unquote_to_bytes(payload)
+        file.write(data)
+        return mime, data[:SNIFF_LENGTH]
+    if any(c in payload for c in '\r\n '):
+        payload = ''.join(payload.split())
+    chunk_size -= chunk_size % 4
+    head = b''
+    for i in range(0, len(payload), chunk_size):
+        data = base64.b64decode(payload[i:i + chunk_size])
+        if len(head) < SNIFF_LENGTH:
+            head += data[:SNIFF_LENGTH - len(head)]
+        file.write(data)
+    return mime, head
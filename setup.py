@@ -26,10 +26,13 @@ setup(
         "ehforwarderbot",
         "pyqrcode",
         "PyYaml>=5.3",
-        "cachetools",
         "requests",
         "python-magic"
     ],
+    extras_require={
+        # Scaling down oversized images sent from master
+        "media": ["Pillow"],
+    },
     long_description=long_description,
     long_description_content_type="text/markdown",
     classifiers=[
@@ -43,4 +46,4 @@ setup(
     entry_points={
         'ehforwarderbot.slave': 'tedrolin.wechatPc = efb_wechat_pc_slave:WechatPcChannel',
     }
-)
\ No newline at end of file
+)
@@ -0,0 +1,56 @@
+from efb_wechat_pc_slave.AppMsgParser import APP_MSG_FILE, APP_MSG_LINK, APP_MSG_QUOTE, AppMsgParser, parse_app_msg
+
+LINK = ('wxid_sender:\n<?xml version="1.0"?><msg><appmsg appid="" sdkver="0"><title>Title</title>'
+        '<des>Description</des><type>5</type><url>https://example.com/a</url>'
+        '<thumburl>https://example.com/t.jpg</thumburl></appmsg><fromusername>wxid_sender</fromusername></msg>')
+
+QUOTE = ('<msg><appmsg><title>reply</title><type>57</type><refermsg><type>1</type><svrid>123</svrid>'
+         '<fromusr>room@chatroom</fromusr><chatusr>wxid_quoted</chatusr><displayname>Quoted</displayname>'
+         '<content>original</content></refermsg></appmsg></msg>')
+
+
+def test_link_in_room():
+    app = parse_app_msg(LINK)
+    assert app.type == APP_MSG_LINK
+    assert (app.title, app.description, app.url) == ('Title', 'Description', 'https://example.com/a')
+    assert app.thumb_url == 'https://example.com/t.jpg'
+    assert not app.truncated
+
+
+def test_quote():
+    app = parse_app_msg(QUOTE)
+    assert app.type == APP_MSG_QUOTE
+    assert (app.quote_id, app.quote_sender, app.quote_name, app.quote_text) == \
+        ('123', 'wxid_quoted', 'Quoted', 'original')
+
+
+def test_file_in_large_payload():
+    content = ('<msg><appmsg><title>report.pdf</title><type>6</type><appattach><totallen>1024</totallen>'
+               '<fileext>pdf</fileext></appattach></appmsg><extra>' + 'x' * 100000 + '</extra></msg>')
+    app = parse_app_msg(content, max_length=1024)
+    assert app.type == APP_MSG_FILE
+    assert (app.file_size, app.file_ext) == (1024, 'pdf')
+    # Everything needed was before the cap
+    assert not app.truncated
+
+
+def test_truncated_payload():
+    content = '<msg><appmsg><title>long</title><des>' + 'x' * 100000 + '</des><type>5</type></appmsg></msg>'
+    app = parse_app_msg(content, max_length=1024)
+    assert app.title == 'long'
+    assert app.truncated
+
+
+def test_not_an_app_message():
+    assert parse_app_msg('just text') is None
+    assert parse_app_msg('<msg><img/></msg>') is None
+    assert parse_app_msg('<msg><appmsg><title>broken') is None
+
+
+def test_parsed_payloads_are_memoized():
+    parser = AppMsgParser(max_entries=1)
+    assert parser.parse(LINK) is parser.parse(LINK)
+    assert (parser.hits, parser.misses) == (1, 1)
+    parser.parse(QUOTE)
+    parser.parse(LINK)
+    assert (parser.hits, parser.misses, len(parser)) == (1, 3, 1)
@@ -0,0 +1,28 @@
+import asyncio
+
+from efb_wechat_pc_slave.ConnectionManager import ConnectionManager, STATE_LOGGED_IN
+
+
+def make_manager(**kwargs):
+    async def nothing():
+        pass
+
+    return ConnectionManager(asyncio.new_event_loop(), nothing, nothing, nothing, **kwargs)
+
+
+def test_backoff_doubles_up_to_max_delay():
+    manager = make_manager(initial_delay=1, max_delay=8)
+    for attempt, delay in enumerate([1, 2, 4, 8, 8]):
+        manager._attempt = attempt
+        for _ in range(20):
+            # Jittered down to half of it at most
+            assert delay / 2 <= manager.backoff() <= delay
+    manager.loop.close()
+
+
+def test_backoff_is_reset_once_logged_in():
+    manager = make_manager(initial_delay=1, max_delay=8)
+    manager._attempt = 5
+    manager._set_state(STATE_LOGGED_IN)
+    assert manager.backoff() <= 1
+    manager.loop.close()
@@ -0,0 +1,108 @@
+import asyncio
+
+from efb_wechat_pc_slave.ConnectionManager import ConnectionManager, STATE_CONNECTING, STATE_DISCONNECTED, \
+    STATE_LOGGED_IN, STATE_LOGIN_PENDING
+
+
+def run(test):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop))
+    finally:
+        loop.close()
+
+
+class FakeHook:
+    def __init__(self, loop, failures=0):
+        self.failures = failures
+        self.connects = 0
+        self.closed = loop.create_future()
+
+    async def connect(self):
+        self.connects += 1
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionRefusedError()
+
+    async def serve(self):
+        await self.closed
+
+    async def open_client(self):
+        pass
+
+
+def make_manager(loop, hook, **kwargs):
+    states = []
+    options = dict(initial_delay=0.01, max_delay=0.04)
+    options.update(kwargs)
+    manager = ConnectionManager(loop, hook.connect, hook.serve, hook.open_client,
+                                on_state_change=lambda old, new: states.append(new), **options)
+    return manager, states
+
+
+async def wait_for_state(manager, state):
+    for _ in range(500):
+        if manager.state == state:
+            return
+        await asyncio.sleep(0.001)
+    assert manager.state == state
+
+
+async def stop(manager):
+    manager.stop()
+    await asyncio.sleep(0)
+    await asyncio.gather(manager._task, return_exceptions=True)
+
+
+def test_login_goes_through_each_state():
+    async def test(loop):
+        hook = FakeHook(loop)
+        manager, states = make_manager(loop, hook)
+        # Reported before connecting is ignored
+        manager.on_login_status(True)
+        assert manager.state == STATE_DISCONNECTED
+        manager.start()
+        await asyncio.sleep(0.01)
+        assert manager.state == STATE_LOGIN_PENDING
+        assert not manager.logged_in.is_set()
+        manager.on_login_status(True)
+        assert manager.logged_in.is_set()
+        manager.on_login_status(False)
+        assert not manager.logged_in.is_set()
+        await stop(manager)
+        assert states == [STATE_CONNECTING, STATE_LOGIN_PENDING, STATE_LOGGED_IN, STATE_LOGIN_PENDING,
+                          STATE_DISCONNECTED]
+
+    run(test)
+
+
+def test_failed_connects_are_retried():
+    async def test(loop):
+        hook = FakeHook(loop, failures=2)
+        manager, states = make_manager(loop, hook)
+        manager.start()
+        await wait_for_state(manager, STATE_LOGIN_PENDING)
+        assert hook.connects == 3
+        assert manager.reconnects == 2
+        await stop(manager)
+        assert states[:4] == [STATE_CONNECTING, STATE_DISCONNECTED, STATE_CONNECTING, STATE_DISCONNECTED]
+
+    run(test)
+
+
+def test_dropped_connection_reconnects():
+    async def test(loop):
+        hook = FakeHook(loop)
+        manager, _ = make_manager(loop, hook)
+        manager.start()
+        await asyncio.sleep(0.01)
+        manager.on_login_status(True)
+        hook.closed.set_result(None)
+        hook.closed = loop.create_future()
+        await wait_for_state(manager, STATE_DISCONNECTED)
+        assert not manager.logged_in.is_set()
+        await wait_for_state(manager, STATE_LOGIN_PENDING)
+        assert hook.connects == 2
+        await stop(manager)
+
+    run(test)
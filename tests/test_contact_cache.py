@@ -0,0 +1,65 @@
+import sqlite3
+
+from efb_wechat_pc_slave.ContactCache import ContactCache
+from efb_wechat_pc_slave.ContactRecord import ContactRecord, WxidTable
+from efb_wechat_pc_slave.CustomTypes import EFBGroupChat, EFBPrivateChat
+
+
+def record(wxid, nickname, **extra):
+    return ContactRecord.from_dict(dict(wxid=wxid, nickname=nickname, **extra), WxidTable())
+
+
+def make_tables():
+    friends = {'alice': record('alice', 'Alice'), 'room@chatroom': record('room@chatroom', 'Room')}
+    entities = {'alice': EFBPrivateChat(uid='alice', name='Alice', alias='A'),
+                'room@chatroom': EFBGroupChat(uid='room@chatroom', name='Room')}
+    return friends, entities
+
+
+def test_missing_cache_loads_empty(tmp_path):
+    assert ContactCache(tmp_path / 'contacts.db').load() == ([], [])
+
+
+def test_saved_tables_are_loaded(tmp_path):
+    cache = ContactCache(tmp_path / 'contacts.db')
+    cache.save(*make_tables())
+    friends, entities = cache.load()
+    assert sorted(friend['wxid'] for friend in friends) == ['alice', 'room@chatroom']
+    by_uid = {entity['uid']: entity for entity in entities}
+    assert isinstance(by_uid['alice'], EFBPrivateChat) and by_uid['alice']['alias'] == 'A'
+    assert type(by_uid['room@chatroom']) is EFBGroupChat
+
+
+def test_incremental_save_touches_only_changed(tmp_path):
+    cache = ContactCache(tmp_path / 'contacts.db')
+    friends, entities = make_tables()
+    cache.save(friends, entities)
+    friends['bob'] = record('bob', 'Bob')
+    entities['bob'] = EFBPrivateChat(uid='bob', name='Bob', alias=None)
+    # Renamed, but not part of the change, so the old name stays
+    entities['alice'] = EFBPrivateChat(uid='alice', name='Alicia', alias=None)
+    del friends['room@chatroom'], entities['room@chatroom']
+    cache.save(friends, entities, changed=['bob'], removed=['room@chatroom'])
+    loaded, entities = cache.load()
+    assert sorted(friend['wxid'] for friend in loaded) == ['alice', 'bob']
+    assert {entity['uid']: entity['name'] for entity in entities} == {'alice': 'Alice', 'bob': 'Bob'}
+
+
+def test_outdated_schema_is_rebuilt(tmp_path):
+    path = tmp_path / 'contacts.db'
+    conn = sqlite3.connect(str(path))
+    conn.executescript("CREATE TABLE friends (wxid TEXT, nickname TEXT); PRAGMA user_version = 0;")
+    conn.close()
+    cache = ContactCache(path)
+    assert cache.load() == ([], [])
+    cache.save(*make_tables())
+    assert len(cache.load()[0]) == 2
+    conn = sqlite3.connect(str(path))
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == ContactCache.SCHEMA_VERSION
+    conn.close()
+
+
+def test_corrupt_cache_loads_empty(tmp_path):
+    path = tmp_path / 'contacts.db'
+    path.write_bytes(b'not a database' * 100)
+    assert ContactCache(path).load() == ([], [])
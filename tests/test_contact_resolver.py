@@ -0,0 +1,109 @@
+import asyncio
+from types import SimpleNamespace
+
+from efb_wechat_pc_slave.ChatMgr import ChatMgr
+from efb_wechat_pc_slave.ContactResolver import ContactResolver
+from efb_wechat_pc_slave.ContactStore import ContactStore
+
+
+def run(test):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop))
+    finally:
+        loop.close()
+
+
+def make_store():
+    channel = SimpleNamespace(channel_id='tests', channel_name='Tests', channel_emoji='')
+    return ContactStore(ChatMgr(channel))
+
+
+class FakeHook:
+    def __init__(self, known=()):
+        self.known = set(known)
+        self.fetched = []
+
+    async def fetch(self, wxid):
+        self.fetched.append(wxid)
+        await asyncio.sleep(0.01)
+        if wxid in self.known:
+            return dict(wxid=wxid, nickname=wxid.title())
+        return None
+
+
+def test_concurrent_lookups_share_a_request():
+    async def test(loop):
+        hook = FakeHook(known=['alice'])
+        resolved = []
+        resolver = ContactResolver(loop, make_store(), hook.fetch, on_resolved=resolved.append)
+        assert await asyncio.gather(*(resolver.resolve('alice') for _ in range(5))) == [True] * 5
+        assert hook.fetched == ['alice']
+        assert [diff.added for diff in resolved] == [{'alice'}]
+        assert resolver.store.get_friend_info('nickname', 'alice') == 'Alice'
+        # Known now, not looked up again
+        assert await resolver.resolve('alice')
+        assert resolver.lookups == 1
+
+    run(test)
+
+
+def test_unknown_contact_is_not_asked_for_again():
+    async def test(loop):
+        hook = FakeHook()
+        resolver = ContactResolver(loop, make_store(), hook.fetch, negative_ttl=0.05)
+        assert not await resolver.resolve('stranger')
+        assert resolver.is_known_missing('stranger')
+        assert not await resolver.resolve('stranger')
+        assert hook.fetched == ['stranger']
+        await asyncio.sleep(0.06)
+        assert not resolver.is_known_missing('stranger')
+        assert not await resolver.resolve('stranger')
+        assert hook.fetched == ['stranger', 'stranger']
+        assert resolver.misses == 2
+
+    run(test)
+
+
+def test_negative_cache_is_bounded():
+    async def test(loop):
+        resolver = ContactResolver(loop, make_store(), FakeHook().fetch, max_negative=2)
+        for wxid in ('a', 'b', 'c'):
+            await resolver.resolve(wxid)
+        assert not resolver.is_known_missing('a')
+        assert resolver.is_known_missing('c')
+
+    run(test)
+
+
+def test_reply_by_message():
+    async def test(loop):
+        async def fetch(wxid):
+            loop.call_later(0.01, resolver.on_contact, dict(wxid=wxid, nickname='Bob'))
+
+        resolver = ContactResolver(loop, make_store(), fetch, replies_by_message=True)
+        assert await resolver.resolve('bob')
+        assert resolver.store.get_friend_info('nickname', 'bob') == 'Bob'
+
+    run(test)
+
+
+def test_lookup_times_out():
+    async def test(loop):
+        async def fetch(wxid):
+            pass
+
+        resolver = ContactResolver(loop, make_store(), fetch, replies_by_message=True, timeout=0.01)
+        assert not await resolver.resolve('bob')
+        assert resolver.is_known_missing('bob')
+
+    run(test)
+
+
+def test_without_fetch_every_lookup_misses():
+    async def test(loop):
+        resolver = ContactResolver(loop, make_store(), None)
+        assert not await resolver.resolve('alice')
+        assert resolver.lookups == 0
+
+    run(test)
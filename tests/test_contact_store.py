@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+from efb_wechat_pc_slave.ChatMgr import ChatMgr
+from efb_wechat_pc_slave.ContactStore import ContactStore
+
+
+def make_store():
+    channel = SimpleNamespace(channel_id='tests', channel_name='Tests', channel_emoji='')
+    return ContactStore(ChatMgr(channel))
+
+
+def friend(wxid, nickname, **extra):
+    return dict(wxid=wxid, nickname=nickname, **extra)
+
+
+ROOM = friend('room@chatroom', '', roomWxidList='alice^Gbob')
+
+
+def test_pages_in_any_order_are_committed_at_once():
+    store = make_store()
+    assert store.apply_page(2, 2, [friend('bob', 'Bob'), ROOM]) is None
+    # Nothing is visible before the last page
+    assert len(store) == 0
+    assert not store.ready.is_set()
+    assert store.missing_pages() == [1]
+    diff = store.apply_page(1, 2, [friend('alice', 'Alice')])
+    assert diff.added == {'alice', 'bob', 'room@chatroom'}
+    assert store.ready.is_set()
+    assert store.get_friend_info('nickname', 'bob') == 'Bob'
+    assert store.is_room_member('room@chatroom', 'alice')
+    assert not store.is_room_member('room@chatroom', 'carol')
+
+
+def test_size_change_drops_staged_pages():
+    store = make_store()
+    store.apply_page(1, 3, [friend('alice', 'Alice')])
+    assert store.apply_page(1, 2, [friend('bob', 'Bob')]) is None
+    assert store.missing_pages() == [2]
+    diff = store.apply_page(2, 2, [friend('carol', 'Carol')])
+    assert diff.added == {'bob', 'carol'}
+
+
+def test_refresh_diff():
+    store = make_store()
+    store.apply_page(1, 1, [friend('alice', 'Alice'), friend('bob', 'Bob')])
+    alice = store.get_chat('alice')
+    diff = store.apply_page(1, 1, [friend('alice', 'Alice'), friend('bob', 'Robert'), friend('carol', 'Carol')])
+    assert (diff.added, diff.changed, diff.removed) == ({'carol'}, {'bob'}, set())
+    # Chats of unchanged contacts are kept
+    assert store.get_chat('alice') is alice
+    assert store.get_chat('bob').name == 'Robert'
+    diff = store.apply_page(1, 1, [friend('bob', 'Robert'), friend('carol', 'Carol')])
+    assert (diff.added, diff.changed, diff.removed) == (set(), set(), {'alice'})
+    assert store.get_chat('alice') is None
+
+
+def test_identical_refresh_is_unchanged():
+    store = make_store()
+    page = [friend('alice', 'Alice'), ROOM]
+    store.apply_page(1, 1, page)
+    assert not store.apply_page(1, 1, list(page))
+
+
+def test_rooms_are_named_and_populated_when_asked_for():
+    store = make_store()
+    store.apply_page(1, 1, [friend('alice', 'Alice'), friend('bob', 'Bob'), ROOM])
+    # Nothing is built by the refresh itself
+    assert not store._snapshot.chats
+    assert not store._snapshot.room_names
+    room = store.get_chat('room@chatroom')
+    assert room.name == 'Alice、Bob'
+    assert sorted(member.uid for member in room.members) == ['alice', 'bob']
+    assert store.get_chat('room@chatroom') is room
+    assert len(room.members) == 2
+
+
+def test_named_room_is_not_named_after_members():
+    store = make_store()
+    store.apply_page(1, 1, [friend('alice', 'Alice'), dict(ROOM, nickname='Book club')])
+    assert store.get_entity('room@chatroom')['name'] == 'Book club'
+    assert not store._snapshot.room_names
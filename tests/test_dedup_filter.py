@@ -0,0 +1,66 @@
+from efb_wechat_pc_slave.DedupFilter import DedupFilter
+
+
+def test_message_with_id_is_dropped_once_seen():
+    dedup = DedupFilter()
+    msg = {'msgId': '1', 'wxid': 'alice', 'content': 'hi'}
+    assert not dedup.is_duplicate(msg)
+    # Told apart by id, whatever else changed
+    assert dedup.is_duplicate(dict(msg, content='edited'))
+    assert not dedup.is_duplicate(dict(msg, msgId='2'))
+    assert (dedup.checked, dedup.hits) == (3, 1)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_message_without_id_is_remembered_briefly():
+    clock = Clock()
+    dedup = DedupFilter(fingerprint_window=5, clock=clock)
+    msg = {'wxid': 'alice', 'content': 'hi'}
+    assert not dedup.is_duplicate(msg)
+    clock.now = 4
+    assert dedup.is_duplicate(dict(msg))
+    clock.now = 10
+    # The same text may be sent again later
+    assert not dedup.is_duplicate(msg)
+
+
+def test_fingerprint_ignores_volatile_fields():
+    dedup = DedupFilter()
+    msg = {'wxid': 'alice', 'roomId': 'room@chatroom', 'msgType': 1, 'content': 'hi', 'timestamp': 1}
+    assert not dedup.is_duplicate(msg)
+    assert dedup.is_duplicate(dict(msg, timestamp=2))
+    assert not dedup.is_duplicate(dict(msg, content='hi again'))
+    assert not dedup.is_duplicate(dict(msg, roomId='other@chatroom'))
+
+
+def test_message_with_id_is_forgotten_after_window():
+    clock = Clock()
+    dedup = DedupFilter(window=60, clock=clock)
+    assert not dedup.is_duplicate({'msgId': '1'})
+    clock.now = 61
+    assert not dedup.is_duplicate({'msgId': '1'})
+    assert len(dedup) == 1
+
+
+def test_remembered_messages_are_not_counted():
+    dedup = DedupFilter()
+    msg = {'msgId': '1'}
+    assert not dedup.remember(msg)
+    assert dedup.checked == 0
+    assert dedup.is_duplicate(msg)
+
+
+def test_oldest_entries_are_forgotten():
+    dedup = DedupFilter(max_entries=2)
+    for i in range(3):
+        dedup.is_duplicate({'msgId': str(i)})
+    assert len(dedup) == 2
+    assert not dedup.is_duplicate({'msgId': '0'})
+    assert dedup.is_duplicate({'msgId': '2'})
@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from efb_wechat_pc_slave.ChatMgr import ChatMgr
+from efb_wechat_pc_slave.ContactStore import ContactStore
+from efb_wechat_pc_slave.FriendListPager import FriendListPager, PAGE_SIZE
+
+FRIENDS = [dict(wxid=f'friend{i}', nickname=f'Friend {i}') for i in range(PAGE_SIZE * 2 + 50)]
+
+
+def run(test):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop))
+    finally:
+        loop.close()
+
+
+def make_store():
+    channel = SimpleNamespace(channel_id='tests', channel_name='Tests', channel_emoji='')
+    return ContactStore(ChatMgr(channel))
+
+
+def page_message(page):
+    return dict(total=len(FRIENDS), page=page, friendList=FRIENDS[(page - 1) * PAGE_SIZE:page * PAGE_SIZE])
+
+
+class PagedClient:
+    """
+    Answers page requests, except for the first `lose` requests of each page in `lossy`
+    """
+
+    def __init__(self, lossy=(), lose=1):
+        self.pager = None
+        self.requests = []
+        self.lost = {page: lose for page in lossy}
+
+    async def get_friend_list(self, page=1):
+        self.requests.append(page)
+        if self.lost.get(page, 0):
+            self.lost[page] -= 1
+            return
+        asyncio.get_event_loop().call_soon(self.pager.on_page, page_message(page))
+
+
+class WholeListClient:
+    """
+    Sends all pages for each request, stalling after `stall_after` pages of the first one
+    """
+
+    def __init__(self, stall_after=None):
+        self.pager = None
+        self.requests = 0
+        self.stall_after = stall_after
+
+    async def get_friend_list(self):
+        self.requests += 1
+        pages = range(3, 0, -1)
+        if self.requests == 1 and self.stall_after is not None:
+            pages = pages[:self.stall_after]
+        for page in pages:
+            asyncio.get_event_loop().call_soon(self.pager.on_page, page_message(page))
+
+
+def make_pager(client, **kwargs):
+    options = dict(page_timeout=0.05, retries=2)
+    options.update(kwargs)
+    client.pager = FriendListPager(client, make_store(), **options)
+    return client.pager
+
+
+def test_pages_are_requested_after_the_first():
+    async def test(loop):
+        client = PagedClient()
+        pager = make_pager(client)
+        diff = await pager.refresh()
+        assert client.requests == [1, 2, 3]
+        assert len(diff.added) == len(FRIENDS)
+        assert pager.store.ready.is_set()
+
+    run(test)
+
+
+def test_lost_page_is_requested_again():
+    async def test(loop):
+        client = PagedClient(lossy=[2])
+        pager = make_pager(client)
+        diff = await pager.refresh()
+        assert sorted(client.requests) == [1, 2, 2, 3]
+        assert len(diff.added) == len(FRIENDS)
+
+    run(test)
+
+
+def test_page_lost_beyond_retries_fails_refresh():
+    async def test(loop):
+        client = PagedClient(lossy=[3], lose=3)
+        pager = make_pager(client)
+        with pytest.raises(TimeoutError):
+            await pager.refresh()
+        assert client.requests.count(3) == 3
+
+    run(test)
+
+
+def test_concurrent_refreshes_are_shared():
+    async def test(loop):
+        client = PagedClient()
+        pager = make_pager(client)
+        first, second = await asyncio.gather(pager.refresh(), pager.refresh())
+        assert first is second
+        assert client.requests == [1, 2, 3]
+
+    run(test)
+
+
+def test_unchanged_list_gives_empty_diff():
+    async def test(loop):
+        pager = make_pager(PagedClient())
+        await pager.refresh()
+        assert not await pager.refresh()
+
+    run(test)
+
+
+def test_whole_list_is_requested_again_once_stalled():
+    async def test(loop):
+        client = WholeListClient(stall_after=1)
+        pager = make_pager(client)
+        diff = await pager.refresh()
+        assert client.requests == 2
+        assert len(diff.added) == len(FRIENDS)
+
+    run(test)
@@ -0,0 +1,160 @@
+import asyncio
+import threading
+
+import pytest
+
+from efb_wechat_pc_slave.IngestQueue import IngestQueue, OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_SPILL
+
+
+def run(test):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop))
+    finally:
+        loop.close()
+
+
+async def settle(ingest, timeout=2.0):
+    """
+    Wait until the workers delivered everything and the loop released the slots
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while ingest.pending and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    assert ingest.pending == 0
+
+
+def test_unknown_policy_is_refused():
+    async def test(loop):
+        with pytest.raises(ValueError):
+            IngestQueue(loop, print, overflow='sometimes')
+        with pytest.raises(ValueError):
+            IngestQueue(loop, print, overflow=OVERFLOW_SPILL)
+
+    run(test)
+
+
+def test_slot_is_released_once_delivered():
+    async def test(loop):
+        delivered = []
+        ingest = IngestQueue(loop, delivered.append, max_size=1, overflow=OVERFLOW_DROP)
+        assert await ingest.admit({'wxid': 'alice'})
+        # Taken until the worker handed the message over
+        assert not await ingest.admit({'wxid': 'alice'})
+        ingest.put('alice', 'first')
+        await settle(ingest)
+        assert delivered == ['first']
+        assert await ingest.admit({'wxid': 'alice'})
+        ingest.release()
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_failed_delivery_frees_the_slot():
+    async def test(loop):
+        failed = []
+
+        def deliver(msg):
+            raise RuntimeError(msg)
+
+        ingest = IngestQueue(loop, deliver, max_size=1, on_failed=failed.append)
+        assert await ingest.admit({})
+        ingest.put('alice', 'lost')
+        await settle(ingest)
+        await asyncio.sleep(0)
+        assert failed == ['lost']
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_block_waits_for_a_free_slot():
+    async def test(loop):
+        ingest = IngestQueue(loop, lambda msg: None, max_size=1, overflow=OVERFLOW_BLOCK)
+        assert await ingest.admit({})
+        waiting = loop.create_task(ingest.admit({}))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        ingest.put('alice', 'first')
+        assert await asyncio.wait_for(waiting, 2)
+        ingest.release()
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_drop_sends_a_notice_with_the_next_message():
+    async def test(loop):
+        delivered = []
+        ingest = IngestQueue(loop, delivered.append, max_size=1, overflow=OVERFLOW_DROP,
+                             drop_notice=lambda msg, count: f"{count} dropped")
+        assert await ingest.admit({'wxid': 'alice'})
+        assert not await ingest.admit({'wxid': 'bob'})
+        assert not await ingest.admit({'wxid': 'bob'})
+        assert ingest.dropped == 2
+        ingest.put('alice', 'alice 1')
+        await settle(ingest)
+        assert await ingest.admit({'wxid': 'bob'})
+        ingest.put('bob', 'bob 3')
+        await settle(ingest)
+        assert delivered == ['alice 1', '2 dropped', 'bob 3']
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_spill_replays_in_order(tmp_path):
+    async def test(loop):
+        delivered = []
+        ingest = None
+
+        async def replay(msg):
+            ingest.put(msg['wxid'], msg['content'])
+
+        ingest = IngestQueue(loop, delivered.append, max_size=1, overflow=OVERFLOW_SPILL,
+                             spill_path=tmp_path / 'spill.jsonl', replay=replay)
+        assert await ingest.admit({'wxid': 'alice', 'content': '1'})
+        for i in (2, 3):
+            assert not await ingest.admit({'wxid': 'alice', 'content': str(i)})
+        assert ingest.spill_size == 2
+        ingest.put('alice', '1')
+        while ingest.spill_size or ingest.pending:
+            await asyncio.sleep(0.01)
+        assert delivered == ['1', '2', '3']
+        assert not (tmp_path / 'spill.jsonl').exists()
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_messages_of_a_chat_stay_on_one_worker():
+    async def test(loop):
+        threads = {}
+
+        def deliver(msg):
+            threads.setdefault(msg[0], set()).add(threading.current_thread().name)
+
+        ingest = IngestQueue(loop, deliver, workers=4)
+        for i in range(20):
+            for key in ('alice', 'bob', 'room@chatroom'):
+                await ingest.admit({})
+                ingest.put(key, (key, i))
+        await settle(ingest)
+        assert all(len(names) == 1 for names in threads.values())
+        assert ingest.shutdown(1)
+
+    run(test)
+
+
+def test_shutdown_delivers_what_is_queued():
+    async def test(loop):
+        delivered = []
+        ingest = IngestQueue(loop, delivered.append, workers=2)
+        for i in range(10):
+            ingest.put(str(i), i, slots=0)
+        assert ingest.shutdown(1)
+        assert sorted(delivered) == list(range(10))
+
+    run(test)
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+from efb_wechat_pc_slave.MediaCache import MediaCache
+
+
+def writer(data, mime='image/png', calls=None):
+    def write(f):
+        if calls is not None:
+            calls.append(data)
+        f.write(data)
+        return mime
+    return write
+
+
+def test_stored_file_is_addressed_by_content(tmp_path):
+    cache = MediaCache(tmp_path)
+    stored = cache.store(writer(b'png'))
+    stored.file.close()
+    assert stored.key == MediaCache.key(b'png')
+    assert stored.key in cache
+    cached = cache.open(stored.key)
+    with cached.file:
+        assert cached.file.read() == b'png'
+    assert cached.mime == 'image/png'
+    assert cache.open(MediaCache.key(b'other')) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = MediaCache(tmp_path, max_entries=2)
+    keys = []
+    for data in (b'1', b'2'):
+        stored = cache.store(writer(data))
+        stored.file.close()
+        keys.append(stored.key)
+    cache.open(keys[0]).file.close()
+    cache.store(writer(b'3')).file.close()
+    assert keys[0] in cache
+    assert keys[1] not in cache
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_size_limit_evicts(tmp_path):
+    cache = MediaCache(tmp_path, max_bytes=10)
+    first = cache.store(writer(b'x' * 6))
+    first.file.close()
+    cache.store(writer(b'y' * 6)).file.close()
+    assert first.key not in cache
+    assert cache.size == 6
+
+
+def test_expired_entries_are_missed(tmp_path):
+    cache = MediaCache(tmp_path, ttl=0)
+    stored = cache.store(writer(b'png'))
+    stored.file.close()
+    time.sleep(0.01)
+    assert stored.key not in cache
+    assert cache.open(stored.key) is None
+
+
+def test_files_of_last_run_are_kept(tmp_path):
+    cache = MediaCache(tmp_path)
+    stored = cache.store(writer(b'png'))
+    stored.file.close()
+    # Left behind half written
+    (tmp_path / '.tmp').write_bytes(b'p')
+    cache = MediaCache(tmp_path)
+    assert stored.key in cache
+    assert cache.size == 3
+
+
+def test_files_of_last_run_beyond_ttl_are_removed(tmp_path):
+    cache = MediaCache(tmp_path)
+    stored = cache.store(writer(b'png'))
+    stored.file.close()
+    path = next(tmp_path.iterdir())
+    os.utime(str(path), (0, 0))
+    cache = MediaCache(tmp_path, ttl=3600)
+    assert stored.key not in cache
+    assert not path.exists()
+
+
+def test_concurrent_misses_write_once(tmp_path):
+    cache = MediaCache(tmp_path)
+    key = MediaCache.key('https://example.com/image')
+    calls = []
+    started = threading.Barrier(8)
+    results = []
+
+    def fetch():
+        started.wait()
+        cached = cache.get_or_store(key, writer(b'png', calls=calls))
+        with cached.file:
+            results.append(cached.file.read())
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [b'png']
+    assert results == [b'png'] * 8
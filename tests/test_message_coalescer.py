@@ -0,0 +1,125 @@
+import asyncio
+from types import SimpleNamespace
+
+from ehforwarderbot import MsgType
+from ehforwarderbot.chat import GroupChat
+from ehforwarderbot.message import Message, Substitutions
+
+from efb_wechat_pc_slave import WechatPcChannel
+from efb_wechat_pc_slave.MessageCoalescer import MessageCoalescer
+from efb_wechat_pc_slave.MessageIndex import MessageIndex
+from efb_wechat_pc_slave.utils import find_mention
+
+
+def make_room():
+    chat = GroupChat(module_id='tests', module_name='Tests', channel_emoji='', uid='room@chatroom', name='Room')
+    return chat, chat.add_member(name='Alice', uid='alice'), chat.add_member(name='Bob', uid='bob')
+
+
+def make_text(chat, author, text, uid, substitutions=None):
+    msg = Message(type=MsgType.Text, text=text, chat=chat, author=author, uid=uid)
+    if substitutions:
+        msg.substitutions = Substitutions(substitutions)
+    return msg
+
+
+def run_coalescer(messages, window=10.0):
+    loop = asyncio.new_event_loop()
+    forwarded = []
+    try:
+        coalescer = MessageCoalescer(loop, lambda key, msg, sources: forwarded.append((msg, sources)),
+                                     window=window, mixed_author=lambda chat: chat.make_system_member(
+                                         uid='__system__', name='System'))
+        for msg in messages:
+            coalescer.put(msg.chat.uid, msg)
+        return coalescer, forwarded
+    finally:
+        loop.close()
+
+
+def test_text_is_held_and_merged():
+    chat, alice, _ = make_room()
+    coalescer, forwarded = run_coalescer([make_text(chat, alice, 'one', '1'), make_text(chat, alice, 'two', '2')])
+    assert forwarded == []
+    assert len(coalescer) == 2
+    coalescer.flush_all()
+    (merged, sources), = forwarded
+    assert merged.text == 'one\ntwo'
+    assert merged.uid == '2'
+    assert [m.uid for m in sources] == ['1', '2']
+
+
+def test_mention_flushes_batch_and_is_delivered_alone():
+    chat, alice, bob = make_room()
+    text = 'hi @me look'
+    mention = make_text(chat, bob, text, '3', {find_mention(text, nickname='me'): chat.self})
+    assert mention.substitutions.is_mentioned
+    coalescer, forwarded = run_coalescer([make_text(chat, alice, 'one', '1'), make_text(chat, alice, 'two', '2'),
+                                          mention])
+    assert len(coalescer) == 0
+    assert [sources for _, sources in forwarded][1] == [mention]
+    assert forwarded[0][0].text == 'one\ntwo'
+    assert forwarded[1][0] is mention
+
+
+def test_merged_substitutions_are_shifted():
+    chat, alice, bob = make_room()
+    first = make_text(chat, alice, 'hello', '1')
+    second = make_text(chat, bob, 'hey @Alice', '2', {(4, 10): alice})
+    coalescer, forwarded = run_coalescer([first, second])
+    coalescer.flush_all()
+    merged, _ = forwarded[0]
+    (begin, end), = merged.substitutions.keys()
+    assert merged.text[begin:end] == '@Alice'
+    assert merged.author.uid == '__system__'
+
+
+def test_find_mention():
+    assert find_mention('hi @me', nickname='me') == (3, 6)
+    assert find_mention('hi @someone else', nickname='me') is None
+    text = 'hi @Boss look'
+    assert text[slice(*find_mention(text, nickname='me', wxid='wxid_me', at_list='wxid_a,wxid_me'))] == '@Boss'
+    assert find_mention('hi @Boss', nickname='me', wxid='wxid_me', at_list=['wxid_a']) is None
+
+
+def test_quote_of_merged_message_refers_to_it():
+    chat, alice, bob = make_room()
+    index = MessageIndex()
+    messages = [make_text(chat, alice, 'one', '1'), make_text(chat, bob, 'two', '2'),
+                make_text(chat, alice, 'three', '3')]
+    for i, msg in enumerate(messages):
+        index.add(msg.uid, f'wx{i}', chat.uid)
+    coalescer, forwarded = run_coalescer(messages)
+    coalescer.flush_all()
+    (merged, sources), = forwarded
+    # As the channel does when a merged message is forwarded
+    index.merge([m.uid for m in sources if m.uid != merged.uid], merged.uid)
+    # Quoting any part of the batch on WeChat refers to the message the master got
+    assert {index.by_wechat(f'wx{i}').efb_uid for i in range(3)} == {merged.uid}
+    assert index.by_efb('1') is None and index.by_efb('2') is None
+
+
+class FakeClient:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, wxid, content):
+        self.sent.append(('text', wxid, None, content))
+
+    async def at_room_member(self, room_id, wxid, nickname, message):
+        self.sent.append(('at', room_id, wxid, message))
+
+
+def test_reply_to_merged_message_mentions_nobody():
+    chat, alice, bob = make_room()
+    coalescer, forwarded = run_coalescer([make_text(chat, alice, 'one', '1'), make_text(chat, bob, 'two', '2')])
+    coalescer.flush_all()
+    (merged, _), = forwarded
+    channel = SimpleNamespace(client=FakeClient())
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(WechatPcChannel.send_reply(channel, chat.uid, merged, 'ok'))
+        loop.run_until_complete(WechatPcChannel.send_reply(channel, chat.uid, make_text(chat, bob, 'hi', '3'), 'ok'))
+    finally:
+        loop.close()
+    assert [(kind, wxid) for kind, _, wxid, _ in channel.client.sent] == [('text', None), ('at', 'bob')]
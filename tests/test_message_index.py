@@ -0,0 +1,65 @@
+from efb_wechat_pc_slave.MessageIndex import MessageIndex, wechat_msg_id
+
+
+def test_sent_message_is_bound_to_its_wechat_id():
+    index = MessageIndex()
+    index.add('efb', None, 'chat')
+    assert index.by_efb('efb').wechat_id is None
+    index.bind('efb', 'wx')
+    assert index.by_wechat('wx').efb_uid == 'efb'
+    assert index.by_efb('efb').chat_uid == 'chat'
+
+
+def test_readding_a_wechat_id_replaces_the_old_message():
+    index = MessageIndex()
+    index.add('old', 'wx', 'chat')
+    index.add('new', 'wx', 'chat')
+    assert index.by_wechat('wx').efb_uid == 'new'
+    assert index.by_efb('old') is None
+
+
+def test_least_recently_used_is_evicted():
+    index = MessageIndex(max_entries=2)
+    index.add('1', 'wx1', 'chat')
+    index.add('2', 'wx2', 'chat')
+    assert index.by_efb('1') is not None
+    index.add('3', 'wx3', 'chat')
+    assert len(index) == 2
+    assert index.by_wechat('wx2') is None
+    assert index.by_wechat('wx1').efb_uid == '1'
+
+
+def test_old_messages_expire():
+    index = MessageIndex(ttl=0)
+    index.add('efb', 'wx', 'chat')
+    assert index.by_wechat('wx') is None
+    assert len(index) == 0
+
+
+def test_wechat_msg_id():
+    assert wechat_msg_id({'msgSvrId': 1, 'msgId': 2}) == '1'
+    assert wechat_msg_id({'msgId': 2}) == '2'
+    assert wechat_msg_id({'content': 'hi'}) is None
+    assert wechat_msg_id(None) is None
+
+
+def test_merged_messages_point_at_the_merged_one():
+    index = MessageIndex()
+    index.add('1', 'wx1', 'chat')
+    index.add('2', 'wx2', 'chat')
+    index.add('3', 'wx3', 'chat')
+    index.merge(['1', '2'], '3')
+    assert [index.by_wechat(w).efb_uid for w in ('wx1', 'wx2', 'wx3')] == ['3', '3', '3']
+    assert index.by_efb('1') is None
+    assert len(index) == 1
+    # Forgetting the merged message forgets all of its WeChat ids
+    index.add('3', None, 'chat')
+    assert index.by_wechat('wx1') is None
+
+
+def test_merge_into_message_without_wechat_id():
+    index = MessageIndex()
+    index.add('1', 'wx1', 'chat')
+    index.merge(['1', '2'], '2')
+    assert index.by_wechat('wx1').efb_uid == '2'
+    assert index.by_efb('2').chat_uid == 'chat'
@@ -0,0 +1,91 @@
+import json
+
+from efb_wechat_pc_slave.MessageJournal import MessageJournal, DEAD_LETTER_FILE
+
+
+def test_unacked_messages_are_replayed(tmp_path):
+    journal = MessageJournal(tmp_path)
+    first = journal.append('chat', {'content': 'one'})
+    second = journal.append('chat', {'content': 'two'})
+    journal.ack(first)
+    journal.close()
+
+    journal = MessageJournal(tmp_path)
+    assert [entry.uid for entry in journal.pending()] == [second]
+    assert journal.get(first).payload == {'content': 'one'}
+    assert journal.get(second).chat_uid == 'chat'
+    journal.close()
+
+
+def test_compaction_carries_unacked_messages(tmp_path):
+    journal = MessageJournal(tmp_path, segment_bytes=1000, max_segments=2)
+    kept = journal.append('chat', {'content': 'kept'})
+    for i in range(100):
+        journal.ack(journal.append('chat', {'content': f'message {i}'}))
+    assert len(list(tmp_path.glob('*.log'))) <= 3
+    assert [entry.uid for entry in journal.pending()] == [kept]
+    journal.close()
+
+    journal = MessageJournal(tmp_path, segment_bytes=1000, max_segments=2)
+    assert [entry.payload for entry in journal.pending()] == [{'content': 'kept'}]
+    journal.close()
+
+
+def test_failing_message_is_moved_to_dead_letter(tmp_path):
+    journal = MessageJournal(tmp_path, max_attempts=3)
+    uid = journal.append('chat', {'content': 'poison'})
+    assert journal.attempt(uid)
+    journal.close()
+
+    # Attempts survive restarts
+    journal = MessageJournal(tmp_path, max_attempts=3)
+    assert journal.attempt(uid)
+    assert not journal.attempt(uid)
+    assert journal.pending() == []
+    assert journal.dead_letters == 1
+    journal.close()
+
+    record = json.loads((tmp_path / DEAD_LETTER_FILE).read_text().splitlines()[0])
+    assert record['i'] == uid
+    assert record['m'] == {'content': 'poison'}
+    assert MessageJournal(tmp_path, max_attempts=3).pending() == []
+
+
+def test_attempt_of_acked_message_is_ignored(tmp_path):
+    journal = MessageJournal(tmp_path)
+    uid = journal.append('chat', {'content': 'one'})
+    journal.ack(uid)
+    assert not journal.attempt(uid)
+    assert not (tmp_path / DEAD_LETTER_FILE).exists()
+    journal.close()
+
+
+def test_append_after_close_is_not_journaled(tmp_path):
+    journal = MessageJournal(tmp_path)
+    journal.close()
+    uid = journal.append('chat', {'content': 'late'})
+    assert uid
+    assert journal.get(uid) is None
+    journal.ack(uid)
+    assert MessageJournal(tmp_path).pending() == []
+
+
+def test_threaded_writes_keep_their_order(tmp_path):
+    journal = MessageJournal(tmp_path, segment_bytes=1000, max_segments=2, threaded=True, max_attempts=2)
+    kept = journal.append('chat', {'content': 'kept'})
+    poison = journal.append('chat', {'content': 'poison'})
+    for i in range(100):
+        payload = {'content': f'message {i}'}
+        uid = journal.append('chat', payload)
+        # Changes after appending are not journaled
+        payload['content'] = 'changed'
+        journal.ack(uid)
+    assert journal.attempt(poison)
+    assert not journal.attempt(poison)
+    assert journal.unacked == 1
+    journal.close()
+
+    journal = MessageJournal(tmp_path, segment_bytes=1000, max_segments=2)
+    assert [entry.uid for entry in journal.pending()] == [kept]
+    assert json.loads((tmp_path / DEAD_LETTER_FILE).read_text())['m'] == {'content': 'poison'}
+    journal.close()
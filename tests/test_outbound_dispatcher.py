@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from efb_wechat_pc_slave.OutboundDispatcher import OutboundDispatcher, OutboundQueueFull
+
+
+def run(test, **kwargs):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop, OutboundDispatcher(loop, **kwargs)))
+    finally:
+        loop.close()
+
+
+def recorder(log, name, delay=0.0):
+    async def job():
+        await asyncio.sleep(delay)
+        log.append(name)
+        return name
+    return job
+
+
+async def results(*futures):
+    return [await asyncio.wrap_future(f) for f in futures]
+
+
+def test_jobs_of_a_chat_run_in_order():
+    async def test(loop, outbound):
+        log = []
+        # The first job of chat a is slow, chat b isn't held up by it
+        futures = [outbound.submit('a', recorder(log, 'a1', 0.05)),
+                   outbound.submit('a', recorder(log, 'a2')),
+                   outbound.submit('b', recorder(log, 'b1'))]
+        assert await results(*futures) == ['a1', 'a2', 'b1']
+        assert log == ['b1', 'a1', 'a2']
+
+    run(test, rate=0)
+
+
+def test_failed_job_does_not_stop_the_chat():
+    async def test(loop, outbound):
+        async def fail():
+            raise ValueError()
+        failed = outbound.submit('a', fail)
+        sent = outbound.submit('a', recorder([], 'a2'))
+        with pytest.raises(ValueError):
+            await asyncio.wrap_future(failed)
+        assert await asyncio.wrap_future(sent) == 'a2'
+        assert outbound.pending == 0
+
+    run(test, rate=0)
+
+
+def test_pending_is_reserved_on_submit():
+    async def test(loop, outbound):
+        outbound.submit('a', recorder([], 'a1'), max_pending=2)
+        # Counted before the loop had a chance to queue it
+        assert outbound.pending == 1
+        last = outbound.submit('b', recorder([], 'b1'), max_pending=2)
+        with pytest.raises(OutboundQueueFull):
+            outbound.submit('c', recorder([], 'c1'), max_pending=2)
+        assert outbound.pending == 2
+        await asyncio.wrap_future(last)
+        assert outbound.pending == 0
+        await asyncio.wrap_future(outbound.submit('c', recorder([], 'c1'), max_pending=2))
+
+    run(test, rate=0)
+
+
+def test_paused_jobs_run_once_resumed():
+    async def test(loop, outbound):
+        log = []
+        outbound.pause()
+        future = outbound.submit('a', recorder(log, 'a1'))
+        await asyncio.sleep(0.05)
+        assert log == [] and outbound.paused
+        outbound.resume()
+        assert await asyncio.wrap_future(future) == 'a1'
+
+    run(test, rate=0)
+
+
+def test_token_bucket_limits_rate_after_burst():
+    async def test(loop, outbound):
+        started = loop.time()
+        futures = [outbound.submit(str(i), recorder([], i)) for i in range(4)]
+        await results(*futures)
+        # 2 in the burst, then one every 1/20 s
+        assert 0.09 <= loop.time() - started < 0.3
+
+    run(test, rate=20, burst=2)
@@ -0,0 +1,205 @@
+import asyncio
+
+from efb_wechat_pc_slave.ContactStore import ContactDiff
+from efb_wechat_pc_slave.RefreshScheduler import RefreshScheduler
+
+CHANGED = ContactDiff({'new'}, set(), set())
+UNCHANGED = ContactDiff(set(), set(), set())
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def run(test):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(test(loop))
+    finally:
+        # Let stopped schedulers finish cancelling
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+async def yields(count=5):
+    for _ in range(count):
+        await asyncio.sleep(0)
+
+
+def make_scheduler(loop, diffs, lookup=None, **kwargs):
+    refreshes = []
+    clock = Clock()
+
+    async def refresh():
+        refreshes.append(clock())
+        return diffs.pop(0) if diffs else UNCHANGED
+
+    options = dict(min_interval=1, max_interval=4, quiet_period=0, max_defer=0, signal_threshold=2)
+    options.update(kwargs)
+    return RefreshScheduler(loop, refresh, lookup=lookup, clock=clock, **options), refreshes
+
+
+def test_interval_backs_off_while_unchanged():
+    async def test(loop):
+        scheduler, _ = make_scheduler(loop, [])
+        intervals = []
+        for _ in range(4):
+            scheduler.on_refreshed(UNCHANGED)
+            intervals.append(scheduler._delay())
+        assert intervals == [2, 4, 4, 4]
+        assert scheduler.unchanged == 4
+
+    run(test)
+
+
+def test_change_resets_interval():
+    async def test(loop):
+        scheduler, _ = make_scheduler(loop, [])
+        scheduler.interval = scheduler.max_interval
+        scheduler.on_refreshed(CHANGED)
+        assert scheduler.interval == scheduler.min_interval
+        scheduler.on_refreshed(UNCHANGED)
+        assert scheduler.interval == scheduler.min_interval * 2
+
+    run(test)
+
+
+def test_reload_is_reported_once():
+    async def test(loop):
+        scheduler, refreshes = make_scheduler(loop, [CHANGED])
+        scheduler.start()
+        await yields()
+        assert refreshes == []
+        scheduler.clock.advance(1)
+        scheduler.request()
+        await yields()
+        scheduler.stop()
+        assert refreshes == [1]
+        assert scheduler.refreshes == 1
+        assert scheduler.due == 2
+
+    run(test)
+
+
+def test_reload_reported_by_the_list_owner_is_not_counted_again():
+    async def test(loop):
+        scheduler = None
+
+        async def refresh():
+            # Reported as the pager would, at the same clock reading
+            scheduler.on_refreshed(CHANGED)
+            return CHANGED
+
+        scheduler = RefreshScheduler(loop, refresh, clock=Clock())
+        scheduler.start()
+        scheduler.request()
+        await yields()
+        scheduler.stop()
+        assert scheduler.refreshes == 1
+
+    run(test)
+
+
+def test_request_reloads_right_away():
+    async def test(loop):
+        scheduler, refreshes = make_scheduler(loop, [], min_interval=10, max_interval=10)
+        scheduler.start()
+        await yields()
+        assert refreshes == []
+        scheduler.request()
+        await yields()
+        scheduler.stop()
+        assert len(refreshes) == 1
+
+    run(test)
+
+
+def test_not_ready_waits():
+    async def test(loop):
+        scheduler, _ = make_scheduler(loop, [], ready=lambda: False)
+        scheduler.request()
+        assert scheduler._delay() is None
+
+    run(test)
+
+
+def test_due_reload_waits_for_quiet():
+    async def test(loop):
+        scheduler, _ = make_scheduler(loop, [], quiet_period=2, max_defer=5)
+        clock = scheduler.clock
+        assert scheduler._delay() == 1
+        clock.advance(1)
+        scheduler.note_activity()
+        assert scheduler._delay() == 2
+        clock.advance(1.5)
+        scheduler.note_activity()
+        assert scheduler._delay() == 2
+        # Deferred by the traffic, but not beyond max_defer
+        clock.advance(3)
+        scheduler.note_activity()
+        assert scheduler._delay() == 0.5
+        clock.advance(0.5)
+        assert scheduler._delay() == 0
+
+    run(test)
+
+
+def test_unknown_member_looks_up_room_then_signals():
+    async def test(loop):
+        looked_up = []
+
+        async def lookup(room_id):
+            looked_up.append(room_id)
+            return True
+
+        scheduler, refreshes = make_scheduler(loop, [], lookup=lookup, min_interval=10, max_interval=10)
+        scheduler.start()
+        scheduler.on_unknown_member('room@chatroom')
+        await yields()
+        assert looked_up == ['room@chatroom']
+        assert scheduler.signals == 0
+        # Looked up once per interval, after that it's a sign the list is stale
+        scheduler.on_unknown_member('room@chatroom')
+        scheduler.on_unknown_member('room@chatroom')
+        assert looked_up == ['room@chatroom']
+        assert scheduler.signals == 2
+        # Brought forward to min_interval after the last reload, which is 10 s away
+        assert scheduler._delay() == 10
+        scheduler.clock.advance(10)
+        scheduler.on_unknown_member('room@chatroom')
+        await yields()
+        assert looked_up == ['room@chatroom'] * 2
+        scheduler.stop()
+
+    run(test)
+
+
+def test_signals_bring_reload_forward():
+    async def test(loop):
+        scheduler, refreshes = make_scheduler(loop, [], max_interval=10)
+        scheduler.interval = 10
+        scheduler.clock.advance(5)
+        scheduler.start()
+        await yields()
+        assert refreshes == []
+        scheduler.signal()
+        await yields()
+        assert refreshes == []
+        # The second one reaches the threshold, and the reload is overdue since the last one
+        scheduler.signal()
+        await yields()
+        scheduler.stop()
+        assert refreshes == [5]
+
+    run(test)